@@ -6,63 +6,95 @@ e recuperare i dati estratti.
 
 from apify_client import ApifyClient
 import os
+import time
+from concurrent.futures import Future, as_completed
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
+from api.apify_runs import actor_runs
+from api.quota import QuotaExceeded, get_quota
 from db.models import Place
+from db.profile_cache import get_profile_cache
+from metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS, timed
 
 load_dotenv()
 
 APIFY_API_TOKEN = os.getenv('APIFY_API_TOKEN')
 TASK_IDs = {"FindProfile": "eLhqgdpeZhnhVArft",
             "FindPostsFromURLS": "ZDiUAjexvWt4t2NSh"}
+# Tentativi per ogni luogo (il numero di run in parallelo è limitato da `actor_runs`)
+PROFILE_LOOKUP_RETRIES = int(os.getenv('APIFY_PROFILE_RETRIES', '3'))
+RETRY_BACKOFF_S = float(os.getenv('APIFY_RETRY_BACKOFF_S', '2'))
+# Elementi letti dal dataset per ogni richiesta: il dataset non viene mai caricato tutto in memoria
+DATASET_PAGE_SIZE = int(os.getenv('APIFY_DATASET_PAGE_SIZE', '100'))
+# Profili per run dell'Actor dei post: run più grandi finiscono più tardi e falliscono tutte insieme
+POSTS_CHUNK_SIZE = int(os.getenv('APIFY_POSTS_CHUNK_SIZE', '20'))
 
 
-class ApifyApiInterface:
-    def __init__(self):
-        try:
-            self.apify_client = ApifyClient(APIFY_API_TOKEN)
-            print("✅ Client di Apify inizializzato correttamente.")
-        except Exception as e:
-            print(f"❌ Errore durante l'inizializzazione del client: {e}")
-            exit()
+def instagram_username(url: str) -> Optional[str]:
+    """ nome utente da un URL di profilo Instagram (es. https://www.instagram.com/nome/ -> nome) """
+    path_segments = [segment for segment in urlparse(url or "").path.split('/') if segment]
+    return path_segments[0].lower() if len(path_segments) == 1 else None
+
 
-    def get_posts(self, urls: list):
+class ApifyApiInterface:
+    def __init__(self, client: Optional[ApifyClient] = None):
+        # `client` sostituisce il client di Apify (es. con un backend finto per i benchmark)
+        self.apify_client = client or ApifyClient(APIFY_API_TOKEN)
+        print("✅ Client di Apify inizializzato correttamente.")
+
+    def iter_dataset(self, dataset_id: str, page_size: int = DATASET_PAGE_SIZE) -> Iterator[dict]:
+        """ scorre il dataset una pagina alla volta """
+        offset = 0
+        while True:
+            with timed(UPSTREAM_SECONDS, UPSTREAM_ERRORS, service="apify", operation="dataset_page"):
+                items = self.apify_client.dataset(dataset_id).list_items(offset=offset, limit=page_size).items
+            yield from items
+            if len(items) < page_size:
+                return
+            offset += len(items)
+
+    @staticmethod
+    def _posts_input(urls: list, newer_than: Optional[str] = None) -> dict:
         task_input = {
             "resultsLimit": 10,
             "resultsType": "posts",
             "searchType": "url",
             "urls": urls
         }
-        TASK_ID = TASK_IDs["FindPostsFromURLS"]
+        if newer_than:
+            # L'Actor accetta una data (YYYY-MM-DD): i post più vecchi non vengono scaricati
+            task_input["onlyPostsNewerThan"] = newer_than
+        return task_input
 
+    def get_posts(self, urls: list, newer_than: Optional[str] = None) -> Iterator[dict]:
+        """ post dei profili in `urls`, letti dal dataset pagina per pagina mentre vengono consumati """
         print(f"\n🚀 Esecuzione del task...")
 
         try:
-            # Esegue l'Actor e attende il suo completamento
-            run_actor = self.apify_client.task(TASK_ID).call(task_input=task_input)
+            # Avvia l'Actor e attende il suo completamento
+            run_actor = self.start_task("FindPostsFromURLS", self._posts_input(urls, newer_than)).result()
             print(f"✅ Actor eseguito con successo. ID dell'esecuzione (Run ID): {run_actor['id']}")
         except Exception as e:
+            # Nessun post: i profili verranno riprovati al prossimo aggiornamento
             print(f"❌ Errore durante l'esecuzione dell'Actor: {e}")
-            exit()
+            return
 
+        count = 0
         try:
             # Itera sugli elementi presenti nel dataset dell'esecuzione appena conclusa
-            dataset_items = self.apify_client.dataset(run_actor["defaultDatasetId"]).list_items().items
-
-            print(f"✅ Risultati ottenuti! Trovati {len(dataset_items)} elementi.")
-
-            # Stampa i risultati ottenuti
-            for item in dataset_items:
-                # Questo esempio stampa l'URL e il titolo della pagina estratta
-                print(f"  - URL: {item.get('url')}, Titolo: {item.get('title')}")
+            for item in self.iter_dataset(run_actor["defaultDatasetId"]):
+                count += 1
+                yield item
+            print(f"✅ Risultati ottenuti! Trovati {count} elementi.")
 
         except Exception as e:
-            print(f"❌ Errore durante il recupero dei risultati: {e}")
-
-        print("\n🎉 Script terminato.")
+            print(f"❌ Errore durante il recupero dei risultati dopo {count} elementi: {e}")
 
-    def get_profile(self, research_text: str):
-        task_input = {
+    @staticmethod
+    def _profile_input(research_text: str) -> dict:
+        return {
             "addParentData": False,
             "enhanceUserSearchWithFacebookPage": False,
             "isUserReelFeedURL": False,
@@ -71,28 +103,117 @@ class ApifyApiInterface:
             "searchLimit": 1,
             "searchType": "user"
         }
-        TASK_ID = TASK_IDs["FindProfile"]
 
+    def start_task(self, task_name: str, task_input: dict) -> Future:
+        """
+        avvia il task senza attenderlo: il Future ritorna la run quando è terminata.
+        Ogni run consuma la quota "apify"; se il budget è esaurito il Future solleva `QuotaExceeded`
+        """
+        try:
+            get_quota().acquire("apify")
+        except QuotaExceeded as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+        return actor_runs.submit(self.apify_client, TASK_IDs[task_name], task_input, name=task_name)
+
+    def get_profile(self, research_text: str):
         print(f"\n🚀 Esecuzione del task...")
 
         try:
-            # Esegue l'Actor e attende il suo completamento
-            run_actor = self.apify_client.task(TASK_ID).call(task_input=task_input)
+            # Avvia l'Actor e attende il suo completamento
+            run_actor = self.start_task("FindProfile", self._profile_input(research_text)).result()
             print(f"✅ Actor eseguito con successo. ID dell'esecuzione (Run ID): {run_actor['id']}")
         except Exception as e:
             print(f"❌ Errore durante l'esecuzione dell'Actor: {e}")
-            exit()
+            raise
 
-        try:
-            # Itera sugli elementi presenti nel dataset dell'esecuzione appena conclusa
-            dataset_items = self.apify_client.dataset(run_actor["defaultDatasetId"]).list_items().items
-            return dataset_items[0] if len(dataset_items) > 0 else None
+        return self._first_profile(run_actor)
 
-        except Exception as e:
-            print(f"❌ Errore durante il recupero dei risultati: {e}")
+    def _first_profile(self, run_actor: dict) -> Optional[dict]:
+        """
+        primo profilo del dataset della run; None se la ricerca non ha trovato niente.
+        Gli errori di lettura vengono propagati: non vanno confusi con "nessun profilo"
+        """
+        # Serve solo il primo risultato: si legge una pagina da un elemento
+        return next(self.iter_dataset(run_actor["defaultDatasetId"], page_size=1), None)
 
     def get_profile_from_place(self, place: Place):
         return self.get_profile(place.name + " " + place.address)
 
-    def get_posts_from_places(self, places: list[Place]):
-        self.get_posts([place.instagram_URL for place in places])
+    def get_profiles_from_places(self, places: List[Place], retries: int = PROFILE_LOOKUP_RETRIES
+                                 ) -> Dict[str, Optional[str]]:
+        """
+        Cerca i profili di tutti i luoghi, prima nella cache e poi su Apify: le run partono
+        tutte insieme (fino al limite di `actor_runs`) e vengono lette man mano che finiscono.
+        I luoghi falliti vengono riprovati con backoff esponenziale.
+        Ritorna un dict place.id -> URL del profilo (None se non trovato).
+        """
+        cache = get_profile_cache()
+        urls, to_lookup = {}, []
+        for place in places:
+            found, url = cache.get("apify", place.name, place.address)
+            if found:
+                urls[place.id] = url
+            else:
+                to_lookup.append(place)
+
+        for attempt in range(retries):
+            futures = {self.start_task("FindProfile", self._profile_input(place.name + " " + place.address)): place
+                       for place in to_lookup}
+            failed = []
+            for future in as_completed(futures):
+                place = futures[future]
+                try:
+                    profile = self._first_profile(future.result())
+                except QuotaExceeded as e:
+                    # Inutile riprovare: il luogo resta fuori dalla cache e verrà cercato in una prossima raccolta
+                    print(f"⚠️  Profilo di '{place.name}' non cercato: {e}")
+                    urls[place.id] = None
+                    continue
+                except Exception as e:
+                    print(f"⚠️  Tentativo {attempt + 1} fallito per '{place.name}': {e}")
+                    failed.append(place)
+                    continue
+                urls[place.id] = profile.get("url") if profile else None
+                # Il risultato (anche "nessun profilo") viene salvato in cache, gli errori no
+                cache.put("apify", place.name, place.address, urls[place.id])
+            if not (to_lookup := failed):
+                break
+            if attempt < retries - 1:
+                time.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+
+        for place in to_lookup:
+            print(f"❌ Profilo non trovato per '{place.name}' dopo {retries} tentativi.")
+            urls[place.id] = None
+        return urls
+
+    def get_posts_from_places(self, places: List[Place], newer_than: Optional[str] = None,
+                              chunk_size: int = POSTS_CHUNK_SIZE) -> Iterator[dict]:
+        """
+        Post dei profili dei luoghi, in streaming. I luoghi senza profilo vengono saltati e i
+        profili ripetuti richiesti una volta sola; i profili sono divisi in gruppi da `chunk_size`,
+        scaricati con run in parallelo e letti man mano che le run finiscono.
+        Ogni post riceve in `place_id` l'id del luogo da cui proviene (una copia per ogni luogo,
+        se più luoghi condividono lo stesso profilo).
+        """
+        by_username: Dict[str, List[Place]] = {}
+        for place in places:
+            if username := instagram_username(place.instagram_URL):
+                by_username.setdefault(username, []).append(place)
+        urls = [same_profile[0].instagram_URL for same_profile in by_username.values()]
+        if not urls:
+            return
+
+        print(f"\n🚀 Scaricamento dei post di {len(urls)} profili in gruppi da {chunk_size}...")
+        futures = {self.start_task("FindPostsFromURLS", self._posts_input(urls[i:i + chunk_size], newer_than)):
+                   urls[i:i + chunk_size] for i in range(0, len(urls), chunk_size)}
+        for future in as_completed(futures):
+            try:
+                run_actor = future.result()
+                for post in self.iter_dataset(run_actor["defaultDatasetId"]):
+                    for place in by_username.get((post.get("ownerUsername") or "").lower(), []):
+                        yield dict(post, place_id=place.id)
+            except Exception as e:
+                # Un gruppo fallito non blocca gli altri: i suoi luoghi verranno riprovati al prossimo aggiornamento
+                print(f"❌ Errore durante lo scaricamento dei post di {len(futures[future])} profili: {e}")
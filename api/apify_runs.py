@@ -0,0 +1,106 @@
+"""
+Orchestrazione delle run degli Actor Apify senza un thread bloccato per ogni run.
+
+Le run vengono avviate con `start()` (che ritorna subito) e un unico thread controlla
+periodicamente lo stato di tutte quelle in corso: quando una run termina, il suo
+`Future` viene completato e parte la prossima run in attesa. Le run contemporanee
+sono al massimo `max_in_flight`, per rispettare i limiti di concorrenza dell'account.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS, registry
+
+TERMINAL_STATUSES = {"SUCCEEDED", "FAILED", "ABORTED", "TIMED-OUT"}
+
+
+class ActorRunError(Exception):
+    """ la run è terminata senza successo """
+
+
+class ActorRunPool:
+
+    def __init__(self, max_in_flight: int = 10, poll_interval_s: float = 5.0):
+        self.max_in_flight = max_in_flight
+        self.poll_interval_s = poll_interval_s
+        self._pending: "deque[Tuple[Any, str, dict, Future, str]]" = deque()
+        # Letto e modificato solo dal thread di polling: client, Future, nome del task, inizio della run
+        self._running: Dict[str, Tuple[Any, Future, str, float]] = {}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._poller = None
+        self.stats = {"started": 0, "succeeded": 0, "failed": 0}
+
+    def submit(self, client, task_id: str, task_input: dict, name: Optional[str] = None) -> Future:
+        """
+        mette in coda una run del task; il Future ritorna l'oggetto run quando la run
+        termina con successo, altrimenti solleva `ActorRunError`.
+        `name` identifica il task nelle metriche (di default il suo id)
+        """
+        future = Future()
+        self._pending.append((client, task_id, task_input, future, name or task_id))
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_forever, name="apify-runs", daemon=True)
+                self._poller.start()
+        self._wake.set()
+        return future
+
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def _start_pending(self):
+        while self._pending and len(self._running) < self.max_in_flight:
+            client, task_id, task_input, future, name = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                run = client.task(task_id).start(task_input=task_input)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(service="apify", operation=name)
+                future.set_exception(e)
+                continue
+            self.stats["started"] += 1
+            self._running[run["id"]] = (client, future, name, time.perf_counter())
+
+    def _poll(self):
+        for run_id, (client, future, name, started_at) in list(self._running.items()):
+            try:
+                run = client.run(run_id).get()
+            except Exception as e:
+                # Errore temporaneo nel leggere lo stato: si riprova al prossimo giro
+                print(f"⚠️  Stato della run {run_id} non disponibile: {e}")
+                continue
+            if run is None or run["status"] not in TERMINAL_STATUSES:
+                continue
+            del self._running[run_id]
+            # Durata dall'avvio alla fine osservata: include fino a un intervallo di polling
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started_at, service="apify", operation=name)
+            if run["status"] == "SUCCEEDED":
+                self.stats["succeeded"] += 1
+                future.set_result(run)
+            else:
+                self.stats["failed"] += 1
+                UPSTREAM_ERRORS.inc(service="apify", operation=name)
+                future.set_exception(ActorRunError(f"Run {run_id} terminata con stato {run['status']}"))
+
+    def _poll_forever(self):
+        while True:
+            # Si azzera prima di controllare le code: una submit arrivata dopo sveglia la prossima wait
+            self._wake.clear()
+            self._start_pending()
+            if self._running:
+                self._poll()
+                # Le run appena liberate lasciano posto a quelle in attesa senza aspettare il prossimo giro
+                self._start_pending()
+            self._wake.wait(self.poll_interval_s if self._running else None)
+
+
+actor_runs = ActorRunPool(max_in_flight=int(os.getenv('APIFY_MAX_RUNS_IN_FLIGHT', '10')),
+                          poll_interval_s=float(os.getenv('APIFY_POLL_INTERVAL_S', '5')))
+registry.register_callback("safemo_apify_runs", "Run degli Actor in coda e in corso.", "gauge", ("state",),
+                           lambda: [(("pending",), len(actor_runs._pending)), (("running",), actor_runs.in_flight())])
@@ -3,6 +3,9 @@ import requests
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
+from api.quota import QuotaExceeded, get_quota, retry_after_s
+from db.profile_cache import get_profile_cache
+
 # Carica le variabili d'ambiente da un file .env
 load_dotenv()
 api_key = os.getenv("BRAVE_SEARCH_API_KEY")
@@ -14,7 +17,29 @@ def cerca_instagram(nome: str, indirizzo: str):
     """
     Cerca su Instagram usando la Brave Search API, filtrando per URL che
     corrispondono a un profilo utente O a una pagina di una location.
+    I risultati (anche quelli vuoti) vengono salvati nella cache dei profili.
     """
+    cache = get_profile_cache()
+    found, url = cache.get("brave", nome, indirizzo)
+    if found:
+        return url
+    try:
+        get_quota().acquire("brave")
+        url = _cerca_instagram(nome, indirizzo)
+        get_quota().report_success("brave")
+    except QuotaExceeded as e:
+        print(f"Ricerca non eseguita: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        if e.response is not None and e.response.status_code == 429:
+            get_quota().report_throttled("brave", retry_after_s(e.response))
+        print(f"Errore durante la richiesta API: {e}")
+        return None
+    cache.put("brave", nome, indirizzo, url)
+    return url
+
+
+def _cerca_instagram(nome: str, indirizzo: str):
     query = f"site:instagram.com {nome} {indirizzo}"
     endpoint = "https://api.search.brave.com/res/v1/web/search"
     headers = {
@@ -26,43 +51,38 @@ def cerca_instagram(nome: str, indirizzo: str):
         "count": 10
     }
 
-    try:
-        r = requests.get(endpoint, headers=headers, params=params)
-        r.raise_for_status()
-        data = r.json()
-
-        for item in data.get("web", {}).get("results", []):
-            url = item.get("url", "")
-            if not url:
-                continue
+    r = requests.get(endpoint, headers=headers, params=params)
+    r.raise_for_status()
+    data = r.json()
 
-            parsed_url = urlparse(url)
+    for item in data.get("web", {}).get("results", []):
+        url = item.get("url", "")
+        if not url:
+            continue
 
-            if "instagram.com" not in parsed_url.netloc:
-                continue
+        parsed_url = urlparse(url)
 
-            path_segments = [segment for segment in parsed_url.path.split('/') if segment]
+        if "instagram.com" not in parsed_url.netloc:
+            continue
 
-            # --- NUOVA LOGICA DI FILTRAGGIO ---
+        path_segments = [segment for segment in parsed_url.path.split('/') if segment]
 
-            # CONDIZIONE 1: L'URL è un profilo utente?
-            # es: /nomeutente/ -> path_segments: ['nomeutente']
-            is_user_profile = (len(path_segments) == 1 and
-                               path_segments[0] not in ["explore", "accounts", "reels", "p"])
+        # --- NUOVA LOGICA DI FILTRAGGIO ---
 
-            # CONDIZIONE 2: L'URL è una pagina di una location?
-            # es: /explore/locations/123/nome-luogo/ -> path_segments: ['explore', 'locations', ...]
-            is_location_page = (len(path_segments) >= 2 and
-                                path_segments[0] == 'explore' and
-                                path_segments[1] == 'locations')
+        # CONDIZIONE 1: L'URL è un profilo utente?
+        # es: /nomeutente/ -> path_segments: ['nomeutente']
+        is_user_profile = (len(path_segments) == 1 and
+                           path_segments[0] not in ["explore", "accounts", "reels", "p"])
 
-            # Se una delle due condizioni è vera, abbiamo trovato un risultato valido
-            if is_user_profile or is_location_page:
-                return url
+        # CONDIZIONE 2: L'URL è una pagina di una location?
+        # es: /explore/locations/123/nome-luogo/ -> path_segments: ['explore', 'locations', ...]
+        is_location_page = (len(path_segments) >= 2 and
+                            path_segments[0] == 'explore' and
+                            path_segments[1] == 'locations')
 
-    except requests.exceptions.RequestException as e:
-        print(f"Errore durante la richiesta API: {e}")
-        return None
+        # Se una delle due condizioni è vera, abbiamo trovato un risultato valido
+        if is_user_profile or is_location_page:
+            return url
 
     return None
 
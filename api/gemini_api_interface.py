@@ -1,27 +1,98 @@
 import google.generativeai as genai
+import hashlib
 import json
 import os
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
+from marshmallow import ValidationError
 
+from api.quota import get_quota, is_throttling_error
+from db.extraction_cache import content_key, get_extraction_cache
 from db.models import Event
+from event_extractor import HIGH_CONFIDENCE, classify_post, has_event_signal
+from metrics import EVENT_EXTRACTION_POSTS, UPSTREAM_ERRORS, UPSTREAM_SECONDS, timed
 
 load_dotenv()
 
 API_KEY = os.getenv("GEMINI_API_KEY")
+# Budget di token (stimati) per ogni richiesta in modalità batch
+BATCH_TOKEN_BUDGET = int(os.getenv('GEMINI_BATCH_TOKEN_BUDGET', '6000'))
+CHARS_PER_TOKEN = 4
+
+EVENT_FIELDS = """
+        - is_evento: (boolean) true se è un evento, altrimenti false.
+        - name: (string) Il nome o titolo dell'evento.
+        - description: (string) Una breve descrizione dell'evento, che possa comprendere tutte le informazioni 
+            presenti nel testo fornito (escluse quelle già presenti negli altri campi)
+        - start_time: (int) Date e ora completa in formato ISO dell'inizio dell'evento. (cerca qualsiasi orario 
+            presente nel testo e usalo come data di inizio anche se non specificato, se non presente riporta solo la data)
+        - end_time: (int) Timestamp completo di data e ora dell'inizio dell'evento, se specificato.
+        - price: (string) Il costo o il prezzo del biglietto, se specificato.
+"""
+
+EVENT_PROMPT = """
+        Analizza il testo fornito e determina se descrive un evento.
+        Se il testo descrive un evento, estrai le seguenti informazioni e restituiscile in formato JSON.
+        Se un'informazione non è presente, lascia il campo come null.
+        Se il testo non descrive un evento, restituisci un JSON con il campo "is_evento" impostato su false e tutti gli altri campi a null.
+        I campi da estrarre sono:""" + EVENT_FIELDS + """    
+        Testo da analizzare:
+        """
+
+BATCH_PROMPT = """
+        Ti vengono forniti più post, ognuno preceduto da una riga "### POST <id>".
+        Per ciascun post determina se descrive un evento e restituisci un array JSON con un oggetto per post,
+        nello stesso ordine, con il campo "post_id" uguale all'id del post.
+        Se un'informazione non è presente, lascia il campo come null.
+        Se il post non descrive un evento, imposta "is_evento" su false e tutti gli altri campi a null.
+        I campi da estrarre per ogni post sono:""" + EVENT_FIELDS + """
+        Post da analizzare:
+        """
+
+MODEL_NAME = 'gemini-1.5-flash-latest'
+# Cambia automaticamente quando cambiano i prompt, invalidando la cache delle estrazioni
+PROMPT_VERSION = hashlib.sha256((EVENT_PROMPT + BATCH_PROMPT).encode("utf-8")).hexdigest()[:16]
+
+
+class MalformedBatchResponse(ValueError):
+    pass
+
+
+def post_id(post: dict, index: int) -> str:
+    """ id del post (quello di Instagram se presente, altrimenti la posizione nella lista) """
+    return str(post.get('id') or index)
 
 
 class GeminiApiInterface:
-    def __init__(self):
+    def __init__(self, model=None):
+        """ `model` sostituisce il modello di Gemini (es. con un backend finto per i benchmark) """
+        if model is not None:
+            self.model = model
+            return
         generation_config = {
             "temperature": 0.0,
             "response_mime_type": "application/json",
         }
-        self.model = genai.GenerativeModel(model_name='gemini-1.5-flash-latest', generation_config=generation_config)
+        self.model = genai.GenerativeModel(model_name=MODEL_NAME, generation_config=generation_config)
         try:
             genai.configure(api_key=API_KEY)
         except Exception as e:
             print(f"Errore nella configurazione dell'API: {e}")
-            exit()
+            raise
+
+    def _generate(self, operation: str, prompt: str):
+        """ chiamata al modello che rispetta la quota "gemini" e segnala i 429 """
+        quota = get_quota()
+        quota.acquire("gemini")
+        try:
+            with timed(UPSTREAM_SECONDS, UPSTREAM_ERRORS, service="gemini", operation=operation):
+                response = self.model.generate_content(prompt)
+        except Exception as e:
+            if is_throttling_error(e):
+                quota.report_throttled("gemini")
+            raise
+        quota.report_success("gemini")
+        return response
 
     def extrac_event_info(self, testo_input):
         """
@@ -34,30 +105,13 @@ class GeminiApiInterface:
             dict: Un dizionario contenente le informazioni sull'evento estratte,
                   o un messaggio di errore.
         """
-        prompt = """
-        Analizza il testo fornito e determina se descrive un evento.
-        Se il testo descrive un evento, estrai le seguenti informazioni e restituiscile in formato JSON.
-        Se un'informazione non è presente, lascia il campo come null.
-        Se il testo non descrive un evento, restituisci un JSON con il campo "is_evento" impostato su false e tutti gli altri campi a null.
-        I campi da estrarre sono:
-        - is_evento: (boolean) true se è un evento, altrimenti false.
-        - name: (string) Il nome o titolo dell'evento.
-        - description: (string) Una breve descrizione dell'evento, che possa comprendere tutte le informazioni 
-            presenti nel testo fornito (escluse quelle già presenti negli altri campi)
-        - start_time: (int) Date e ora completa in formato ISO dell'inizio dell'evento. (cerca qualsiasi orario 
-            presente nel testo e usalo come data di inizio anche se non specificato, se non presente riporta solo la data)
-        - end_time: (int) Timestamp completo di data e ora dell'inizio dell'evento, se specificato.
-        - price: (string) Il costo o il prezzo del biglietto, se specificato.
-    
-        Testo da analizzare:
-        """
 
         try:
             # Combinazione del prompt con il testo dell'utente
-            full_prompt = f"{prompt}\n\n---\n\n{testo_input}"
+            full_prompt = f"{EVENT_PROMPT}\n\n---\n\n{testo_input}"
 
             # Chiamata all'API di Gemini
-            response = self.model.generate_content(full_prompt)
+            response = self._generate("generate_content", full_prompt)
 
             # Pulizia e parsing della risposta JSON
             # A volte il modello potrebbe restituire il JSON all'interno di un blocco di codice markdown
@@ -70,10 +124,116 @@ class GeminiApiInterface:
             return {"errore": f"Si è verificato un errore durante la chiamata all'API: {e}"}
 
     def get_events_from_posts(self, posts: list[dict]) -> list[Event]:
-        events = []
-        for post in posts:
-            event_info = self.extrac_event_info(post['text'])
-            if event_info:
-                events.append(event_info)
+        events_by_post = self.extract_events_by_post(posts)
+        return [event for event in events_by_post.values() if event]
+
+    def extract_events_by_post(self, posts: list[dict]) -> Dict[str, Optional[Event]]:
+        """
+        Estrae gli eventi da molti post con poche chiamate: i post senza date né orari vengono
+        scartati dalle regole locali (`event_extractor`), quelli già visti letti dalla cache,
+        quelli che le regole riconoscono con sicurezza compilati direttamente; gli altri vengono
+        raggruppati in richieste sotto `BATCH_TOKEN_BUDGET` token.
+        Ritorna post id -> Event (None se non è un evento).
+        """
+        events = {}
+        texts = {}
+        for i, post in enumerate(posts):
+            if text := post.get('text'):
+                if has_event_signal(text):
+                    texts[post_id(post, i)] = text
+                else:
+                    events[post_id(post, i)] = None
+        skipped = len(events)
+        keys = {p_id: content_key(text, PROMPT_VERSION, MODEL_NAME) for p_id, text in texts.items()}
+        cache = get_extraction_cache()
+        cached = cache.get_many(set(keys.values()))
+        events.update({p_id: Event.from_dict(cached[key]) if cached[key] else None
+                       for p_id, key in keys.items() if key in cached})
+        from_cache = len(events) - skipped
+        to_extract = {}
+        for p_id, text in texts.items():
+            if p_id in events:
+                continue
+            result = classify_post(text)
+            if not result.is_candidate:
+                events[p_id] = None
+            elif result.confidence >= HIGH_CONFIDENCE:
+                events[p_id] = result.event
+            else:
+                to_extract[p_id] = text
+        from_rules = len(events) - skipped - from_cache
+        for outcome, count in (("skipped", skipped), ("cache", from_cache), ("rules", from_rules),
+                               ("model", len(to_extract))):
+            EVENT_EXTRACTION_POSTS.inc(count, outcome=outcome)
+        print(f"🧠 Estrazione eventi: {skipped} post scartati dalle regole, {from_cache} dalla cache, "
+              f"{from_rules} estratti con le regole, {len(to_extract)} da inviare al modello.")
+        for batch in self._make_batches(to_extract):
+            extracted = self._extract_batch(batch)
+            # I post falliti per errore non sono nel risultato e non vanno in cache
+            cache.put_many((keys[p_id], event.dump() if event else None) for p_id, event in extracted.items())
+            events.update(extracted)
         return events
 
+    @staticmethod
+    def _load_event(event_dict: dict) -> Optional[Event]:
+        """ Event dal JSON del modello; None se non è un evento o se i campi non sono validi """
+        if not event_dict.get("is_evento"):
+            return None
+        try:
+            return Event.load_from_google_gemini(event_dict)
+        except (ValidationError, ValueError) as e:
+            print(f"⚠️  Evento scartato, campi non validi: {e}")
+            return None
+
+    @staticmethod
+    def _make_batches(texts: Dict[str, str]) -> List[Dict[str, str]]:
+        """ raggruppa i testi in batch che stanno nel budget di token del prompt """
+        budget = BATCH_TOKEN_BUDGET - len(BATCH_PROMPT) // CHARS_PER_TOKEN
+        batches, batch, batch_tokens = [], {}, 0
+        for p_id, text in texts.items():
+            tokens = len(text) // CHARS_PER_TOKEN + 10
+            if batch and batch_tokens + tokens > budget:
+                batches.append(batch)
+                batch, batch_tokens = {}, 0
+            batch[p_id] = text
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _extract_batch(self, batch: Dict[str, str]) -> Dict[str, Optional[Event]]:
+        """
+        estrae gli eventi di un batch; se la risposta non è valida divide il batch a metà e riprova.
+        I post su cui anche la chiamata singola fallisce non compaiono nel risultato.
+        """
+        if len(batch) == 1:
+            (p_id, text), = batch.items()
+            event = self.extrac_event_info(text)
+            # extrac_event_info ritorna un dict di errore se la chiamata fallisce
+            return {} if isinstance(event, dict) else {p_id: event}
+        try:
+            posts_text = "\n\n".join(f"### POST {p_id}\n{text}" for p_id, text in batch.items())
+            response = self._generate("generate_content_batch", f"{BATCH_PROMPT}\n\n---\n\n{posts_text}")
+            cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
+            results = json.loads(cleaned_response)
+            if not isinstance(results, list):
+                raise MalformedBatchResponse("la risposta non è un array JSON")
+            events = {}
+            for event_dict in results:
+                if isinstance(event_dict, dict) and (p_id := str(event_dict.get("post_id"))) in batch:
+                    events[p_id] = self._load_event(event_dict)
+            if missing := set(batch) - set(events):
+                raise MalformedBatchResponse(f"mancano i post {sorted(missing)}")
+            return events
+        except (MalformedBatchResponse, json.JSONDecodeError) as e:
+            # Solo una risposta illeggibile si risolve con batch più piccoli
+            print(f"⚠️  Risposta non valida per un batch di {len(batch)} post ({e}), lo divido e riprovo...")
+            items = list(batch.items())
+            half = len(items) // 2
+            return {**self._extract_batch(dict(items[:half])), **self._extract_batch(dict(items[half:]))}
+        except Exception as e:
+            # Quota esaurita, errori di rete o dell'API, risposta bloccata: dividere il batch moltiplicherebbe
+            # le chiamate a pagamento. I post restano fuori dalla cache e verranno riprovati
+            print(f"⚠️  Batch di {len(batch)} post non estratto: {e}")
+            return {}
+
@@ -1,14 +1,102 @@
+import asyncio
+import contextvars
+import math
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import json
-from datetime import datetime
-from typing import List, Dict
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+from functools import partial
+from typing import Callable, List, Dict, Optional, Tuple
 import os
+from requests.adapters import HTTPAdapter
+from api.places_cache import places_cache, TileKey
+from api.quota import THROTTLE_RETRIES, get_quota, retry_after_s
 from db.models import Place
+from db.opening_hours import filter_open_between, filter_open_daily_between
+from db.spatial_index import haversine_km
+from metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS, timed
 from dotenv import load_dotenv
 import uuid
 
 load_dotenv()
 API_KEY = os.getenv('GOOGLE_API_KEY')
+# Timeout (secondi) per ogni singola chiamata e numero massimo di chiamate contemporanee
+REQUEST_TIMEOUT_S = float(os.getenv('GOOGLE_API_TIMEOUT_S', '10'))
+MAX_CONCURRENT_REQUESTS = int(os.getenv('GOOGLE_API_MAX_CONCURRENT', '8'))
+# Costo stimato (dollari) di una geocodifica; quello di `searchNearby` è nella quota "google"
+GEOCODE_COST = float(os.getenv('QUOTA_GOOGLE_GEOCODE_COST', '0.005'))
+# Numero massimo di risultati restituiti da `searchNearby`
+MAX_RESULT_COUNT = 20
+# Con la Field Mask chiediamo anche gli orari di apertura dettagliati
+NIGHTLIFE_FIELD_MASK = "places.id,places.displayName,places.formattedAddress,places.location,places.regularOpeningHours"
+NIGHTLIFE_FILTER_HOUR = 22
+# Ora (del giorno dopo) in cui finisce la serata: fino ad allora vale ancora la sera precedente
+NIGHTLIFE_END_HOUR = 5
+# Sweep di un'area: raggio minimo delle celle (la frequenza delle chiamate è limitata da `api.quota`)
+SWEEP_MIN_RADIUS_KM = float(os.getenv('GOOGLE_SWEEP_MIN_RADIUS_KM', '0.5'))
+KM_PER_DEGREE_LAT = 111.32
+
+# Sessione HTTP condivisa da tutto il processo: riusa le connessioni TLS verso Google
+_session: Optional[requests.Session] = None
+# Thread riservati alle chiamate a Google: l'attesa dei token della quota (`time.sleep`) non deve
+# occupare l'executor di default, che serve anche le query al database delle altre richieste
+_executor: Optional[ThreadPoolExecutor] = None
+# Un semaforo per event loop: un asyncio.Semaphore non si può usare da loop diversi
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="google-places")
+    return _executor
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if (semaphore := _semaphores.get(loop)) is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return semaphore
+
+
+@dataclass
+class SweepReport:
+    """Resoconto di uno sweep: chiamate a Google, celle suddivise e completezza dei risultati."""
+    calls: int = 0  # solo le chiamate fatte davvero, non le attese di una chiamata già in corso
+    cache_hits: int = 0
+    errors: int = 0
+    split_cells: int = 0
+    max_depth: int = 0
+    places: int = 0
+    # Celle che al raggio minimo hanno comunque raggiunto il limite di risultati: l'area è molto densa,
+    # ma dividerle ancora non è previsto, quindi non rendono il resoconto incompleto
+    saturated_cells: int = 0
+    # False se una cella è fallita: l'area non va considerata coperta
+    complete: bool = True
+
+
+def _hex_children(latitude: float, longitude: float, radius_km: float) -> List[Tuple[float, float]]:
+    """
+    Centri delle 7 celle (una centrale e sei in disposizione esagonale) di raggio
+    `radius_km / 2` che coprono il cerchio di raggio `radius_km`.
+    """
+    distance_km = radius_km * math.sqrt(3) / 2
+    d_lat = distance_km / KM_PER_DEGREE_LAT
+    d_lon = distance_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 0.01))
+    return [(latitude, longitude)] + [(latitude + d_lat * math.sin(math.radians(angle)),
+                                       longitude + d_lon * math.cos(math.radians(angle)))
+                                      for angle in range(0, 360, 60)]
 
 
 class GoogleMapsApiInterface:
@@ -17,40 +105,218 @@ class GoogleMapsApiInterface:
     Non richiede la libreria 'googlemaps'.
     """
 
-    def __init__(self):
-        if not API_KEY:
+    def __init__(self, session: Optional[requests.Session] = None):
+        """ `session` sostituisce la sessione HTTP condivisa (es. con un backend finto per i benchmark) """
+        if not API_KEY and session is None:
             raise ValueError("Chiave API non trovata. Imposta la variabile d'ambiente GOOGLE_API_KEY")
         self.api_key = API_KEY
+        self.session = session
         self.base_url = "https://places.googleapis.com/v1/places:searchNearby"
+        self.geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
 
-    def _make_request(self, field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
+    def _make_request(self, field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: int,
+                      exact: bool = False) -> Dict[str, Place]:
         """
         Helper privato per eseguire le chiamate POST alla nuova API.
+        Gli errori vengono stampati e il risultato è vuoto: chi deve distinguere un errore
+        da un'area senza luoghi (es. per registrarne la copertura) usa `_search`.
+        """
+        try:
+            return self._search(field_mask, place_type, latitude, longitude, radius_km, exact)[0]
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Errore durante la chiamata API: {e}")
+            if e.response is not None:
+                print(f"   Dettagli errore: {e.response.text}")
+            return {}
+
+    def _search(self, field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: float,
+                exact: bool = False) -> Tuple[Dict[str, Place], bool]:
+        """
+        Ricerca `searchNearby` che propaga gli errori di rete e di stato HTTP.
+        Le risposte passano dalla cache per tile geografica (`api.places_cache`);
+        con `exact` il cerchio viene cercato così com'è, senza spostarlo sulla tile.
+        Ritorna anche se è stata fatta davvero una chiamata a Google (e non servita
+        dalla cache, da quella condivisa o dalla chiamata in corso di un'altra richiesta).
+        """
+        key = self._cache_key(field_mask, place_type, latitude, longitude, radius_km, exact)
+        fetched = []
+
+        def load():
+            fetched.append(True)
+            return self._fetch_places(key)
+
+        raw_places = places_cache.get_or_load(key, load)
+        return {p.get("id", str(uuid.uuid4())): Place.load_from_google_place(p) for p in raw_places}, bool(fetched)
+
+    @staticmethod
+    def _cache_key(field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: float,
+                   exact: bool) -> TileKey:
+        if exact:
+            return places_cache.exact_key(field_mask, place_type, latitude, longitude, radius_km)
+        # La richiesta parte dal centro della tile: il raggio viene allargato della distanza massima
+        # dal punto richiesto, così il cerchio cercato contiene sempre quello dell'utente
+        return places_cache.make_key(field_mask, place_type, latitude, longitude,
+                                     radius_km + places_cache.max_center_offset_km())
+
+    def _fetch_places(self, key: TileKey) -> Tuple[List[dict], int]:
         """
+        Esegue la chiamata a Google centrata sulla tile della chiave.
+        Ritorna i luoghi grezzi e la dimensione della risposta in byte.
+        """
+        latitude, longitude = places_cache.tile_center(key)
         headers = {
             "Content-Type": "application/json",
             "X-Goog-Api-Key": self.api_key,
-            "X-Goog-FieldMask": field_mask
+            "X-Goog-FieldMask": key.field_mask
         }
         payload = {
-            "includedTypes": [place_type],
-            "maxResultCount": 20,
+            "includedTypes": [key.place_type],
+            "maxResultCount": MAX_RESULT_COUNT,
             "locationRestriction": {
                 "circle": {
                     "center": {"latitude": latitude, "longitude": longitude},
-                    "radius": radius_km * 1000
+                    "radius": key.radius_km * 1000
                 }
             }
         }
-        try:
-            response = requests.post(self.base_url, data=json.dumps(payload), headers=headers)
-            response.raise_for_status()  # Lancia un errore per status non 2xx
-            return {p.get("id", str(uuid.uuid4())): Place.load_from_google_place(p) for p in response.json().get('places', [])}
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Errore durante la chiamata API: {e}")
-            if 'response' in locals():
-                print(f"   Dettagli errore: {response.text}")
-            return {}
+        if key.exact:
+            # Negli sweep ordiniamo per distanza: una cella piena copre comunque tutto il disco fino al 20° risultato
+            payload["rankPreference"] = "DISTANCE"
+        response = self._call_google("searchNearby", lambda: (self.session or _get_session()).post(
+            self.base_url, data=json.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT_S))
+        return response.json().get('places', []), len(response.content)
+
+    @staticmethod
+    def _call_google(operation: str, send: Callable[[], requests.Response],
+                     cost: Optional[float] = None) -> requests.Response:
+        """
+        Esegue `send` rispettando la quota "google": ogni tentativo aspetta un token e ne addebita
+        il costo. Un 429 viene misurato come errore, segnalato alla quota e ripetuto fino a
+        THROTTLE_RETRIES volte; gli altri status non 2xx vengono propagati subito.
+        """
+        quota = get_quota()
+        for attempt in range(THROTTLE_RETRIES + 1):
+            # Attende un token (le chiamate interattive hanno la precedenza) e addebita il costo
+            quota.acquire("google", cost=cost)
+            try:
+                with timed(UPSTREAM_SECONDS, UPSTREAM_ERRORS, service="google", operation=operation):
+                    response = send()
+                    response.raise_for_status()  # Lancia un errore per status non 2xx
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                quota.report_throttled("google", retry_after_s(e.response))
+                if attempt == THROTTLE_RETRIES:
+                    raise
+                continue
+            quota.report_success("google")
+            return response
+
+    async def _make_request_async(self, field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
+        """
+        Versione non bloccante di `_search`: la chiamata HTTP (e l'attesa della quota) gira in
+        un thread dedicato a Google, quindi né l'IOLoop di Tornado né l'executor delle query al
+        database restano bloccati. Il semaforo limita il numero di chiamate contemporanee
+        verso Google. Gli errori vengono propagati.
+        """
+        places, _ = await self._search_async(field_mask, place_type, latitude, longitude, radius_km)
+        return places
+
+    async def _search_async(self, field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: float,
+                            exact: bool = False) -> Tuple[Dict[str, Place], bool]:
+        """Come `_make_request_async`, ma ritorna anche se è stata fatta davvero una chiamata a Google."""
+        key = self._cache_key(field_mask, place_type, latitude, longitude, radius_km, exact)
+        if (raw_places := places_cache.get(key)) is not None:
+            return {p.get("id", str(uuid.uuid4())): Place.load_from_google_place(p) for p in raw_places}, False
+        async with _get_semaphore():
+            loop = asyncio.get_running_loop()
+            # Il contesto viene copiato perché la chiamata finisca nella traccia della richiesta
+            return await loop.run_in_executor(_get_executor(), contextvars.copy_context().run, partial(
+                self._search, field_mask, place_type, latitude, longitude, radius_km, exact))
+
+    async def sweep_area_async(self, place_type: str, latitude: float, longitude: float, radius_km: float,
+                               field_mask: str = NIGHTLIFE_FIELD_MASK,
+                               min_radius_km: float = SWEEP_MIN_RADIUS_KM) -> Tuple[Dict[str, Place], SweepReport]:
+        """
+        Copre tutto il cerchio richiesto superando il limite di 20 risultati di `searchNearby`:
+        si parte con una sola chiamata sull'intero cerchio e ogni cella che raggiunge il limite
+        viene divisa in 7 celle esagonali di raggio dimezzato, cercate in parallelo.
+        I risultati vengono deduplicati per id del luogo.
+        Una cella in errore rende il resoconto incompleto (l'area non va considerata coperta);
+        se fallisce già la prima chiamata l'errore viene propagato. Le celle ancora piene al
+        raggio minimo vengono solo contate in `saturated_cells`.
+        """
+        report = SweepReport()
+        places: Dict[str, Place] = {}
+        # Il cerchio di partenza è centrato sulla tile (allargato per contenere quello richiesto):
+        # così utenti vicini generano le stesse celle e condividono la cache
+        root_key = self._cache_key(field_mask, place_type, latitude, longitude, radius_km, exact=False)
+        root_latitude, root_longitude = places_cache.tile_center(root_key)
+
+        async def sweep_cell(cell_latitude: float, cell_longitude: float, cell_radius_km: float, depth: int):
+            try:
+                found, fetched = await self._search_async(field_mask, place_type, cell_latitude, cell_longitude,
+                                                          cell_radius_km, exact=True)
+            except requests.exceptions.RequestException as e:
+                if depth == 0:
+                    raise
+                # I luoghi delle altre celle restano validi, ma l'area non è stata coperta tutta
+                print(f"❌ Errore nella cella ({cell_latitude:.5f}, {cell_longitude:.5f}) dello sweep: {e}")
+                report.errors += 1
+                report.complete = False
+                return
+            report.cache_hits += not fetched
+            report.calls += fetched
+            report.max_depth = max(report.max_depth, depth)
+            places.update(found)
+            if len(found) < MAX_RESULT_COUNT:
+                return
+            if cell_radius_km / 2 < min_radius_km:
+                report.saturated_cells += 1
+                return
+            report.split_cells += 1
+            # 7 cerchi di raggio r/2 coprono esattamente il cerchio di raggio r: un 5% di margine
+            child_radius_km = cell_radius_km / 2 * 1.05
+            # Risultati ordinati per distanza: il disco fino al luogo più lontano trovato è già completo.
+            # Le celle fuori dal cerchio richiesto non servono
+            covered_km = max((haversine_km(cell_latitude, cell_longitude, p.latitude, p.longitude)
+                              for p in found.values() if p.latitude is not None and p.longitude is not None),
+                             default=0.0)
+            await asyncio.gather(*[sweep_cell(child_latitude, child_longitude, child_radius_km, depth + 1)
+                                   for child_latitude, child_longitude
+                                   in _hex_children(cell_latitude, cell_longitude, cell_radius_km)
+                                   if haversine_km(cell_latitude, cell_longitude, child_latitude, child_longitude)
+                                   + child_radius_km > covered_km
+                                   and haversine_km(latitude, longitude, child_latitude, child_longitude)
+                                   - child_radius_km < radius_km])
+
+        await sweep_cell(root_latitude, root_longitude, root_key.radius_km, 0)
+        report.places = len(places)
+        print(f"🗺️  Sweep di '{place_type}' entro {radius_km} km: {report.places} luoghi, {report.calls} chiamate, "
+              f"{report.cache_hits} dalla cache, {report.split_cells} celle suddivise, {report.errors} errori"
+              f"{'' if report.complete else ' (risultati incompleti)'}.")
+        if report.saturated_cells:
+            print(f"⚠️  {report.saturated_cells} celle al raggio minimo ({min_radius_km} km) hanno raggiunto il limite "
+                  f"di {MAX_RESULT_COUNT} risultati: qualche luogo potrebbe mancare.")
+        return places, report
+
+    def sweep_area(self, place_type: str, latitude: float, longitude: float, radius_km: float,
+                   field_mask: str = NIGHTLIFE_FIELD_MASK) -> Tuple[Dict[str, Place], SweepReport]:
+        """Versione sincrona di `sweep_area_async`, per gli script di raccolta dati."""
+        return asyncio.run(self.sweep_area_async(place_type, latitude, longitude, radius_km, field_mask))
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        """
+        Coordinate (lat, lon) di un indirizzo con la Geocoding API; None se non trovato.
+        Gli errori di rete vengono propagati al chiamante.
+        """
+        response = self._call_google("geocode", lambda: (self.session or _get_session()).get(
+            self.geocode_url, params={"address": address, "key": self.api_key, "region": "it"},
+            timeout=REQUEST_TIMEOUT_S), cost=GEOCODE_COST)
+        if not (results := response.json().get("results")):
+            return None
+        location = results[0]["geometry"]["location"]
+        return location["lat"], location["lng"]
 
     def find_places(self, place_type: str, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
         """
@@ -60,7 +326,7 @@ class GoogleMapsApiInterface:
         print(f"🛰️  Sto cercando i '{place_type}' entro {radius_km} km con la nuova API...")
 
         # Chiediamo solo i campi base per una ricerca generica
-        field_mask = "places.id,places.displayName,places.formattedAddress,places.types"
+        field_mask = "places.id,places.displayName,places.formattedAddress,places.location,places.types"
 
         places_data = self._make_request(field_mask, place_type, latitude, longitude, radius_km)
         print(f"✅ Ricerca completata! Trovati {len(places_data)} '{place_type}'.")
@@ -74,7 +340,7 @@ class GoogleMapsApiInterface:
         print(f"🛰️  Sto cercando i paesi entro {radius_km} km con la nuova API...")
 
         # Chiediamo solo i campi base per una ricerca generica
-        field_mask = "places.id,places.displayName,places.formattedAddress,places.types"
+        field_mask = "places.id,places.displayName,places.formattedAddress,places.location,places.types"
 
         places_data = self._make_request(field_mask, 'administrative_area_level_3', latitude, longitude, radius_km)
         print(f"✅ Ricerca completata! Trovati {len(places_data)} .")
@@ -84,42 +350,55 @@ class GoogleMapsApiInterface:
         """
         Trova luoghi e li filtra per orario di apertura serale in una SOLA chiamata API.
         """
-        filter_hour = 22
-        print(f"🚀 Eseguo una ricerca efficiente per '{place_type}' aperti dopo le {filter_hour}:00...")
-
-        # Con la Field Mask, chiediamo anche gli orari di apertura dettagliati
-        field_mask = "places.id,places.displayName,places.formattedAddress,places.regularOpeningHours"
+        print(f"🚀 Eseguo una ricerca efficiente per '{place_type}' aperti dopo le {NIGHTLIFE_FILTER_HOUR}:00...")
+        all_places_data = self._make_request(NIGHTLIFE_FIELD_MASK, place_type, latitude, longitude, radius_km)
+        return self.filter_nightlife(all_places_data)
 
-        all_places_data = self._make_request(field_mask, place_type, latitude, longitude, radius_km)
+    async def find_places_detailed_async(self, place_type: str, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
+        """Trova luoghi con posizione e orari di apertura, senza filtrarli e senza bloccare l'event loop."""
+        return await self._make_request_async(NIGHTLIFE_FIELD_MASK, place_type, latitude, longitude, radius_km)
 
-        # Filtra i risultati ottenuti
-        locali_filtrati_data = {}
-        today_weekday = datetime.now().weekday()
+    async def find_places_nightlife_async(self, place_type: str, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
+        """Come `find_places_nightlife`, ma senza bloccare l'event loop."""
+        print(f"🚀 Eseguo una ricerca efficiente per '{place_type}' aperti dopo le {NIGHTLIFE_FILTER_HOUR}:00...")
+        all_places_data = await self.find_places_detailed_async(place_type, latitude, longitude, radius_km)
+        return self.filter_nightlife(all_places_data)
 
-        for k, place in all_places_data.items():
-            if self._is_open_after(place, filter_hour, 5):
-                locali_filtrati_data.update({k: place})
+    def filter_nightlife(self, all_places_data: Dict[str, Place], now: Optional[datetime] = None) -> Dict[str, Place]:
+        """Filtra i risultati ottenuti tenendo solo i locali aperti la sera (da adesso a fine serata)."""
+        start, end = nightlife_window(now or datetime.now())
+        locali_filtrati_data = filter_open_between(all_places_data, start, end)
 
         print(
             f"✅ Filtraggio completato! Trovati {len(locali_filtrati_data)} locali aperti su {len(all_places_data)} totali.")
         return locali_filtrati_data
 
+    def filter_nightlife_venues(self, all_places_data: Dict[str, Place]) -> Dict[str, Place]:
+        """
+        Locali serali per la raccolta: aperti dopo le NIGHTLIFE_FILTER_HOUR in almeno un giorno della
+        settimana. A differenza di `filter_nightlife` il risultato non dipende dall'ora in cui si cerca.
+        """
+        locali_filtrati_data = filter_open_daily_between(all_places_data, time(NIGHTLIFE_FILTER_HOUR),
+                                                         time(NIGHTLIFE_END_HOUR))
+        print(
+            f"✅ Filtraggio completato! Trovati {len(locali_filtrati_data)} locali serali su {len(all_places_data)} totali.")
+        return locali_filtrati_data
+
     def find_bars(self, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
         """Metodo scorciatoia per trovare bar serali."""
         return self.find_places_nightlife("bar", latitude, longitude, radius_km)
 
-    def _is_open_after(self, place: Place, hour: int, weekday: int) -> bool:
-        """Helper function per controllare l'orario di apertura."""
-        if not place.opening_hours or not place.opening_hours.get('periods'):
-            return False
-        for period in place.opening_hours['periods']:
-            open_info = period.get('open')
-            if not open_info or open_info.get('day') != weekday:
-                continue
-            close_info = period.get('close')
-            if not close_info or close_info.get('day') != weekday or close_info.get('hour', 0) > hour:
-                return True
-        return False
+    async def find_bars_async(self, latitude: float, longitude: float, radius_km: int) -> Dict[str, Place]:
+        """Metodo scorciatoia non bloccante per trovare bar serali."""
+        return await self.find_places_nightlife_async("bar", latitude, longitude, radius_km)
+
+
+def nightlife_window(now: datetime) -> Tuple[datetime, datetime]:
+    """ da adesso (o dalle NIGHTLIFE_FILTER_HOUR se è presto) a fine serata, anche dopo mezzanotte """
+    evening = now if now.hour >= NIGHTLIFE_END_HOUR else now - timedelta(days=1)
+    start = evening.replace(hour=NIGHTLIFE_FILTER_HOUR, minute=0, second=0, microsecond=0)
+    end = start.replace(hour=NIGHTLIFE_END_HOUR) + timedelta(days=1)
+    return max(start, now), end
 
 
 # --- ESEMPIO DI UTILIZZO ---
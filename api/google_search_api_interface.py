@@ -2,8 +2,21 @@
 
 from googlesearch import search
 
+from db.profile_cache import get_profile_cache
+
 
 def find_instagram_url(name, address, num_results=5):
+    # Results (also empty ones) are stored in the profile cache
+    cache = get_profile_cache()
+    found, url = cache.get("google", name, address)
+    if found:
+        return url
+    url = _find_instagram_url(name, address, num_results)
+    cache.put("google", name, address, url)
+    return url
+
+
+def _find_instagram_url(name, address, num_results=5):
     # Build the query
     query = f"site:instagram.com/*/ {name} {address}"
 
@@ -0,0 +1,172 @@
+"""
+Pipeline unica per trovare il profilo Instagram di un luogo.
+
+Le sorgenti (Brave Search, googlesearch, Actor di Apify) sono divise in livelli
+ordinati per costo e latenza, configurabili con `INSTAGRAM_RESOLVER_TIERS`:
+le virgole separano i livelli, il `+` unisce sorgenti eseguite in parallelo
+(es. "brave+google,apify"). Ci si ferma al primo risultato affidabile; per ogni
+sorgente vengono raccolte latenza media e percentuale di successo.
+
+Le sorgenti a lotti (`BatchSource`, come l'Actor di Apify) ricevono con una sola chiamata
+tutti i luoghi ancora senza profilo: avviano le loro ricerche insieme e le riprovano da sole.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import urlparse
+
+from db.models import Place
+
+RESOLVER_TIERS = os.getenv('INSTAGRAM_RESOLVER_TIERS', 'brave+google,apify')
+RESOLVER_WORKERS = int(os.getenv('INSTAGRAM_RESOLVER_WORKERS', '10'))
+# Tempo massimo di attesa per ogni sorgente, in secondi: un livello aspetta il massimo tra le sue sorgenti
+SOURCE_DEADLINES_S = {"brave": 5.0, "google": 10.0, "apify": 180.0}
+NOT_PROFILE_SEGMENTS = {"explore", "accounts", "reels", "reel", "p", "stories", "tv"}
+
+Source = Callable[[str, str], Optional[str]]
+
+
+class BatchSource:
+    """ sorgente che cerca più luoghi con una sola chiamata: riceve i luoghi e ritorna place.id -> URL """
+
+    def __init__(self, fn: Callable[[List[Place]], Dict[str, Optional[str]]]):
+        self.fn = fn
+
+    def __call__(self, places: List[Place]) -> Dict[str, Optional[str]]:
+        return self.fn(places)
+
+
+def is_confident(url: Optional[str]) -> bool:
+    """ un URL è affidabile se punta a un profilo utente (non a post o pagine di location) """
+    if not url:
+        return False
+    parsed_url = urlparse(url)
+    path_segments = [segment for segment in parsed_url.path.split('/') if segment]
+    return ("instagram.com" in parsed_url.netloc and len(path_segments) == 1
+            and path_segments[0] not in NOT_PROFILE_SEGMENTS)
+
+
+def default_sources() -> Dict[str, Union[Source, BatchSource]]:
+    """ sorgenti disponibili: quelle senza chiave o libreria installata vengono saltate """
+    sources = {}
+    try:
+        from api.brave_search_api_interface import cerca_instagram
+        sources["brave"] = cerca_instagram
+    except (ImportError, ValueError) as e:
+        print(f"⚠️  Sorgente 'brave' non disponibile: {e}")
+    try:
+        from api.google_search_api_interface import find_instagram_url
+        sources["google"] = find_instagram_url
+    except ImportError as e:
+        print(f"⚠️  Sorgente 'google' non disponibile: {e}")
+    try:
+        from api.apify_api_interface import ApifyApiInterface
+        # Le run partono tutte insieme e i luoghi falliti vengono riprovati con backoff
+        sources["apify"] = BatchSource(ApifyApiInterface().get_profiles_from_places)
+    except ImportError as e:
+        print(f"⚠️  Sorgente 'apify' non disponibile: {e}")
+    return sources
+
+
+class SourceMetrics:
+
+    def __init__(self):
+        # Per luogo: la latenza di una chiamata a lotti è divisa tra i suoi luoghi
+        self.calls = 0
+        self.successes = 0
+        self.errors = 0
+        self.total_latency_s = 0.0
+
+    def as_dict(self) -> dict:
+        return {"calls": self.calls,
+                "success_rate": self.successes / self.calls if self.calls else 0.0,
+                "errors": self.errors,
+                "avg_latency_s": self.total_latency_s / self.calls if self.calls else 0.0}
+
+
+class InstagramResolver:
+
+    def __init__(self, sources: Optional[Dict[str, Union[Source, BatchSource]]] = None, tiers: str = RESOLVER_TIERS,
+                 deadlines_s: Optional[Dict[str, float]] = None):
+        self.sources = default_sources() if sources is None else sources
+        self.tiers: List[List[str]] = [[name for name in tier.split("+") if name in self.sources]
+                                       for tier in tiers.split(",")]
+        self.tiers = [tier for tier in self.tiers if tier]
+        self.deadlines_s = dict(SOURCE_DEADLINES_S, **(deadlines_s or {}))
+        self.metrics = {name: SourceMetrics() for name in self.sources}
+        self._metrics_lock = threading.Lock()
+        # Al più RESOLVER_WORKERS luoghi alla volta, in tutte le chiamate: le loro sorgenti non restano in coda.
+        # Le sorgenti oltre la deadline non si possono interrompere: finiscono in background
+        self._places_executor = ThreadPoolExecutor(max_workers=RESOLVER_WORKERS)
+        self._executor = ThreadPoolExecutor(max_workers=RESOLVER_WORKERS * max(map(len, self.tiers), default=1))
+
+    def _call_source(self, name: str, places: List[Place]) -> Dict[str, Optional[str]]:
+        start = time.perf_counter()
+        urls, error = {}, False
+        try:
+            source = self.sources[name]
+            if isinstance(source, BatchSource):
+                urls = source(places)
+            else:
+                urls = {place.id: source(place.name, place.address) for place in places}
+            return urls
+        except Exception as e:
+            error = True
+            print(f"❌ Errore della sorgente '{name}' per {len(places)} luoghi: {e}")
+            return {}
+        finally:
+            with self._metrics_lock:
+                metrics = self.metrics[name]
+                metrics.calls += len(places)
+                metrics.errors += len(places) if error else 0
+                metrics.successes += sum(map(is_confident, urls.values()))
+                metrics.total_latency_s += time.perf_counter() - start
+
+    def _resolve_place(self, tier: List[str], place: Place) -> Optional[str]:
+        """ prova le sorgenti per luogo di un livello in parallelo, fino alla deadline """
+        futures = [self._executor.submit(self._call_source, name, [place]) for name in tier]
+        deadline = time.monotonic() + max(self.deadlines_s.get(name, 30.0) for name in tier)
+        fallback, pending = None, set(futures)
+        while pending and (timeout := deadline - time.monotonic()) > 0:
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if is_confident(url := future.result().get(place.id)):
+                    return url
+                fallback = fallback or url
+        return fallback
+
+    def resolve(self, place: Place) -> Optional[str]:
+        """ URL del profilo del luogo, provando i livelli in ordine; None se nessuna sorgente lo trova """
+        return self.resolve_many([place]).get(place.id)
+
+    def resolve_many(self, places: List[Place]) -> Dict[str, Optional[str]]:
+        """
+        risolve tutti i luoghi, un livello alla volta: ogni livello riceve insieme i luoghi che
+        i precedenti non hanno trovato. Ritorna place.id -> URL
+        """
+        urls: Dict[str, Optional[str]] = {place.id: None for place in places}
+        pending = list(places)
+        for tier in self.tiers:
+            if not pending:
+                break
+            batch = [name for name in tier if isinstance(self.sources[name], BatchSource)]
+            single = [name for name in tier if name not in batch]
+            futures = {self._places_executor.submit(self._resolve_place, single, place): place
+                       for place in (pending if single else [])}
+            # Le sorgenti a lotti lavorano qui, mentre quelle per luogo vanno avanti in background
+            results = [self._call_source(name, pending) for name in batch]
+            results += [{place.id: future.result()} for future, place in futures.items()]
+            for found in results:
+                for place_id, url in found.items():
+                    # Un profilo affidabile vince; altrimenti si tiene la prima pagina trovata
+                    if url and not is_confident(current := urls.get(place_id)) and (is_confident(url) or not current):
+                        urls[place_id] = url
+            pending = [place for place in pending if not is_confident(urls[place.id])]
+        # Chi non ha un profilo affidabile resta con una pagina di location, meglio che niente
+        return urls
+
+    def report(self) -> Dict[str, dict]:
+        with self._metrics_lock:
+            return {name: metrics.as_dict() for name, metrics in self.metrics.items()}
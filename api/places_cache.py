@@ -0,0 +1,186 @@
+"""
+Cache in-process delle ricerche `places:searchNearby`, indicizzata per tile geografica.
+
+Le coordinate vengono quantizzate su una griglia di tile (default 250 m) e il raggio
+viene arrotondato per eccesso a un multiplo di `radius_step_km`: utenti vicini tra loro
+condividono quindi la stessa chiave e la stessa risposta di Google.
+La cache ha TTL, eviction LRU entro un budget di memoria configurabile e coalescenza
+delle richieste: più miss contemporanei sulla stessa chiave producono una sola chiamata.
+Con una `SharedCache` i miss vengono cercati anche nella cache comune agli altri processi.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from db.shared_cache import SharedCache, get_shared_cache
+from metrics import registry
+
+METERS_PER_DEGREE_LAT = 111_320.0
+
+
+class TileKey(NamedTuple):
+    lat_idx: int
+    lon_idx: int
+    radius_km: float
+    place_type: str
+    field_mask: str
+    exact: bool = False  # True: indici in milionesimi di grado, senza quantizzazione su tile
+
+
+class _Entry(NamedTuple):
+    value: List[dict]
+    size: int
+    expires_at: float
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class GeoTileCache:
+
+    def __init__(self, ttl_s: float = 600.0, max_bytes: int = 32 * 1024 * 1024,
+                 tile_m: float = 250.0, radius_step_km: float = 0.5, shared: Optional[SharedCache] = None):
+        self.ttl_s = ttl_s
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.tile_m = tile_m
+        self.radius_step_km = radius_step_km
+        self._entries: "OrderedDict[TileKey, _Entry]" = OrderedDict()
+        self._in_flight: Dict[TileKey, _InFlight] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "shared_hits": 0}
+
+    def make_key(self, field_mask: str, place_type: str, latitude: float, longitude: float,
+                 radius_km: float) -> TileKey:
+        """ quantizza coordinate e raggio nella chiave della tile """
+        lat_step = self.tile_m / METERS_PER_DEGREE_LAT
+        lat_idx = round(latitude / lat_step)
+        lon_step = self.tile_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat_idx * lat_step)), 0.01))
+        lon_idx = round(longitude / lon_step)
+        radius_bucket = math.ceil(radius_km / self.radius_step_km) * self.radius_step_km
+        return TileKey(lat_idx, lon_idx, radius_bucket, place_type, field_mask)
+
+    @staticmethod
+    def exact_key(field_mask: str, place_type: str, latitude: float, longitude: float, radius_km: float) -> TileKey:
+        """ chiave senza quantizzazione, per cerchi già calcolati in modo deterministico (es. sweep) """
+        return TileKey(round(latitude * 1e6), round(longitude * 1e6), radius_km, place_type, field_mask, True)
+
+    def tile_center(self, key: TileKey) -> Tuple[float, float]:
+        """ centro della tile: è il punto usato per la richiesta a Google """
+        if key.exact:
+            return key.lat_idx / 1e6, key.lon_idx / 1e6
+        lat_step = self.tile_m / METERS_PER_DEGREE_LAT
+        latitude = key.lat_idx * lat_step
+        lon_step = self.tile_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 0.01))
+        return latitude, key.lon_idx * lon_step
+
+    def max_center_offset_km(self) -> float:
+        """ distanza massima tra un punto e il centro della sua tile """
+        return self.tile_m * math.sqrt(2) / 2 / 1000
+
+    def get(self, key: TileKey):
+        """ ritorna il valore in cache o None se assente/scaduto """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry.value
+
+    def get_or_load(self, key: TileKey, loader: Callable[[], Tuple[List[dict], int]]) -> List[dict]:
+        """
+        ritorna il valore in cache, altrimenti chiama `loader` (che ritorna valore e dimensione in byte).
+        I chiamanti concorrenti sulla stessa chiave aspettano il risultato del primo.
+        Gli errori del loader non vengono messi in cache.
+        """
+        if (value := self.get(key)) is not None:
+            return value
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = self._in_flight[key] = _InFlight()
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not owner:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+        try:
+            if (value := self._shared_get(key)) is not None:
+                size = len(json.dumps(value))
+            else:
+                value, size = loader()
+                self._shared_put(key, value)
+            in_flight.value = value
+            self.put(key, value, size)
+            return value
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.done.set()
+
+    def put(self, key: TileKey, value: List[dict], size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, time.monotonic() + self.ttl_s)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def _shared_get(self, key: TileKey) -> Optional[List[dict]]:
+        if self.shared is None or (raw := self.shared.get("places", repr(tuple(key)))) is None:
+            return None
+        with self._lock:
+            self.stats["shared_hits"] += 1
+        return json.loads(raw)
+
+    def _shared_put(self, key: TileKey, value: List[dict]):
+        if self.shared is not None:
+            self.shared.put("places", repr(tuple(key)), json.dumps(value).encode(), self.ttl_s)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: TileKey):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+places_cache = GeoTileCache(ttl_s=float(os.getenv('PLACES_CACHE_TTL_S', '600')),
+                            max_bytes=int(os.getenv('PLACES_CACHE_MAX_BYTES', str(32 * 1024 * 1024))),
+                            tile_m=float(os.getenv('PLACES_CACHE_TILE_M', '250')),
+                            radius_step_km=float(os.getenv('PLACES_CACHE_RADIUS_STEP_KM', '0.5')),
+                            shared=get_shared_cache())
+registry.register_callback("safemo_places_cache_events_total", "Eventi della cache delle risposte di Google.",
+                           "counter", ("event",), lambda: [((event,), n) for event, n in places_cache.stats.items()])
+registry.register_callback("safemo_places_cache_bytes", "Byte occupati dalla cache delle risposte di Google.",
+                           "gauge", (), lambda: [((), places_cache.info()["bytes"])])
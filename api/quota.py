@@ -0,0 +1,309 @@
+"""
+Quote condivise per tutte le API a pagamento (Google, Apify, Brave, Gemini).
+
+Per ogni servizio:
+- un token bucket (`rate` chiamate al secondo, picchi fino a `burst`);
+- un budget di spesa giornaliero e mensile, calcolato dal costo stimato di ogni chiamata;
+- un backoff adattivo: dopo un 429 le chiamate si fermano fino a `Retry-After` e la
+  frequenza viene dimezzata, per poi risalire gradualmente a ogni chiamata riuscita.
+
+Lo stato è salvato in SQLite, quindi è condiviso da tutti i processi (worker del server,
+crawler, script di raccolta) che usano lo stesso database: i limiti sono quelli dell'account.
+
+Le chiamate hanno una priorità: quelle fatte servendo una richiesta HTTP sono INTERACTIVE
+(vedi `BaseHandler.prepare`), tutte le altre BATCH. Le chiamate BATCH non possono usare la
+quota riservata (`QUOTA_BATCH_RESERVE` dei token e del budget), così un crawl di una
+provincia non lascia senza quota gli utenti che stanno usando l'app.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional
+
+from db.places_store import DB_PATH, connect
+from metrics import registry
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Quota (token e budget) che le chiamate BATCH lasciano alle chiamate INTERACTIVE
+BATCH_RESERVE = float(os.getenv('QUOTA_BATCH_RESERVE', '0.2'))
+# Dopo un 429 la frequenza viene moltiplicata per questo fattore (mai sotto MIN_RATE_FACTOR)...
+THROTTLE_DECREASE = 0.5
+MIN_RATE_FACTOR = 0.05
+# ...e risale di questo valore a ogni chiamata riuscita
+THROTTLE_RECOVERY = 0.05
+# Pausa dopo un 429 se il servizio non indica `Retry-After`, e tentativi dopo un 429
+DEFAULT_RETRY_AFTER_S = float(os.getenv('QUOTA_DEFAULT_RETRY_AFTER_S', '5'))
+THROTTLE_RETRIES = int(os.getenv('QUOTA_THROTTLE_RETRIES', '3'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_bucket (
+    provider TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    rate_factor REAL NOT NULL DEFAULT 1.0,
+    blocked_until REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS quota_spend (
+    provider TEXT NOT NULL,
+    period TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    spent REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (provider, period)
+);
+"""
+
+
+class QuotaExceeded(Exception):
+    """ il budget del servizio è esaurito per la priorità della chiamata """
+
+
+@dataclass
+class ProviderQuota:
+    name: str
+    rate: float  # chiamate al secondo
+    burst: int
+    cost_per_call: float  # in dollari, stimato
+    daily_budget: Optional[float] = None  # None = illimitato
+    monthly_budget: Optional[float] = None
+
+    @classmethod
+    def from_env(cls, name: str, rate: float, burst: int, cost_per_call: float) -> "ProviderQuota":
+        """ valori di default sovrascrivibili con QUOTA_<NOME>_RATE, _BURST, _COST, _DAILY_BUDGET, _MONTHLY_BUDGET """
+        prefix = f"QUOTA_{name.upper()}_"
+
+        def budget(key: str) -> Optional[float]:
+            return float(value) if (value := os.getenv(prefix + key)) else None
+
+        return cls(name, float(os.getenv(prefix + "RATE", str(rate))), int(os.getenv(prefix + "BURST", str(burst))),
+                   float(os.getenv(prefix + "COST", str(cost_per_call))), budget("DAILY_BUDGET"),
+                   budget("MONTHLY_BUDGET"))
+
+
+# Costi indicativi dei listini pubblici: Nearby Search con gli orari (SKU Enterprise),
+# una run breve di un Actor, una ricerca Brave, una richiesta a Gemini Flash
+DEFAULT_PROVIDERS = {
+    "google": ProviderQuota.from_env("google", rate=5, burst=5, cost_per_call=0.035),
+    "apify": ProviderQuota.from_env("apify", rate=5, burst=20, cost_per_call=0.01),
+    "brave": ProviderQuota.from_env("brave", rate=1, burst=1, cost_per_call=0.005),
+    "gemini": ProviderQuota.from_env("gemini", rate=2, burst=5, cost_per_call=0.001),
+}
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("quota_priority", default=BATCH)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def set_priority(priority: str):
+    """ imposta la priorità per il contesto corrente (per Tornado: la richiesta in corso) """
+    _priority.set(priority)
+
+
+@contextmanager
+def priority(value: str):
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_throttling_error(e: BaseException) -> bool:
+    """ true se l'eccezione di un client HTTP/SDK corrisponde a un 429 """
+    response = getattr(e, "response", None)
+    codes = (getattr(e, "status_code", None), getattr(e, "code", None), getattr(response, "status_code", None))
+    return 429 in codes or type(e).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+def retry_after_s(response) -> Optional[float]:
+    """ valore dell'header Retry-After (in secondi) della risposta, se presente """
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaManager:
+
+    def __init__(self, providers: Dict[str, ProviderQuota] = None, path: str = DB_PATH,
+                 batch_reserve: float = BATCH_RESERVE):
+        self.providers = dict(DEFAULT_PROVIDERS if providers is None else providers)
+        self.path = path
+        self.batch_reserve = batch_reserve
+        self._local = threading.local()
+        # Ultimo fattore di frequenza letto per servizio: evita una scrittura per ogni successo quando è già 1
+        self._rate_factors: Dict[str, float] = {}
+        self.stats = {"waits": 0, "wait_s": 0.0, "rejected": 0, "throttled": 0}
+        self._stats_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+            # Le transazioni sono aperte esplicitamente con BEGIN IMMEDIATE
+            conn.isolation_level = None
+        return conn
+
+    @staticmethod
+    def _periods(now: float):
+        day = datetime.fromtimestamp(now)
+        return day.strftime("%Y-%m-%d"), day.strftime("%Y-%m")
+
+    def _limit(self, budget: Optional[float], priority: str) -> Optional[float]:
+        if budget is None:
+            return None
+        return budget * (1 - self.batch_reserve) if priority == BATCH else budget
+
+    def _try_acquire(self, provider: ProviderQuota, cost: float, priority: str) -> float:
+        """
+        prova a prendere un token e a registrare la spesa in un'unica transazione;
+        ritorna 0 se riuscito, altrimenti i secondi da aspettare prima di riprovare
+        """
+        now = time.time()
+        day, month = self._periods(now)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at, rate_factor, blocked_until FROM quota_bucket "
+                               "WHERE provider = ?", (provider.name,)).fetchone()
+            tokens, updated_at, rate_factor, blocked_until = row or (provider.burst, now, 1.0, 0.0)
+            self._rate_factors[provider.name] = rate_factor
+            if now < blocked_until:
+                conn.execute("ROLLBACK")
+                return blocked_until - now
+            rate = provider.rate * rate_factor
+            tokens = min(provider.burst, tokens + max(now - updated_at, 0) * rate)
+            # Le chiamate BATCH lasciano sempre una parte dei token a quelle INTERACTIVE
+            floor = (provider.burst - 1) * self.batch_reserve if priority == BATCH else 0.0
+            if tokens - 1 < floor:
+                conn.execute("ROLLBACK")
+                return (floor + 1 - tokens) / rate
+            for period, budget in ((day, provider.daily_budget), (month, provider.monthly_budget)):
+                if (limit := self._limit(budget, priority)) is None:
+                    continue
+                spent = conn.execute("SELECT spent FROM quota_spend WHERE provider = ? AND period = ?",
+                                     (provider.name, period)).fetchone()
+                if (spent[0] if spent else 0.0) + cost > limit:
+                    raise QuotaExceeded(f"Budget {period} di {provider.name} esaurito per le chiamate {priority} "
+                                        f"(limite {limit:.2f}$)")
+            conn.execute("INSERT OR REPLACE INTO quota_bucket (provider, tokens, updated_at, rate_factor, blocked_until) "
+                         "VALUES (?, ?, ?, ?, ?)", (provider.name, tokens - 1, now, rate_factor, blocked_until))
+            conn.executemany("INSERT INTO quota_spend (provider, period, calls, spent) VALUES (?, ?, 1, ?) "
+                             "ON CONFLICT (provider, period) DO UPDATE SET calls = calls + 1, spent = spent + ?",
+                             [(provider.name, period, cost, cost) for period in (day, month)])
+            conn.execute("COMMIT")
+            return 0.0
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def _reserve(self, provider_name: str, cost: Optional[float], priority: Optional[str]) -> float:
+        provider = self.providers[provider_name]
+        try:
+            return self._try_acquire(provider, provider.cost_per_call if cost is None else cost,
+                                     priority or current_priority())
+        except QuotaExceeded:
+            with self._stats_lock:
+                self.stats["rejected"] += 1
+            raise
+
+    def _count_wait(self, wait_s: float):
+        with self._stats_lock:
+            self.stats["waits"] += 1
+            self.stats["wait_s"] += wait_s
+
+    def acquire(self, provider: str, cost: Optional[float] = None, priority: Optional[str] = None):
+        """
+        aspetta un token del servizio e ne addebita il costo (di default `cost_per_call`);
+        solleva `QuotaExceeded` se il budget non basta
+        """
+        if provider not in self.providers:
+            return
+        while (wait_s := self._reserve(provider, cost, priority)) > 0:
+            self._count_wait(wait_s)
+            time.sleep(wait_s)
+
+    async def acquire_async(self, provider: str, cost: Optional[float] = None, priority: Optional[str] = None):
+        """ come `acquire`, senza bloccare l'event loop mentre aspetta """
+        if provider not in self.providers:
+            return
+        while (wait_s := self._reserve(provider, cost, priority)) > 0:
+            self._count_wait(wait_s)
+            await asyncio.sleep(wait_s)
+
+    def report_throttled(self, provider: str, retry_after: Optional[float] = None):
+        """ il servizio ha risposto 429: pausa per tutti i processi e frequenza dimezzata """
+        if provider not in self.providers:
+            return
+        with self._stats_lock:
+            self.stats["throttled"] += 1
+        now = time.time()
+        blocked_until = now + (DEFAULT_RETRY_AFTER_S if retry_after is None else retry_after)
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO quota_bucket (provider, tokens, updated_at, rate_factor, blocked_until) "
+                         "VALUES (?, 0, ?, ?, ?) ON CONFLICT (provider) DO UPDATE SET tokens = 0, updated_at = ?, "
+                         "rate_factor = MAX(rate_factor * ?, ?), blocked_until = MAX(blocked_until, ?)",
+                         (provider, now, THROTTLE_DECREASE, blocked_until,
+                          now, THROTTLE_DECREASE, MIN_RATE_FACTOR, blocked_until))
+        self._rate_factors[provider] = None
+        print(f"🐢 {provider}: troppe richieste, pausa di {blocked_until - now:.1f}s e frequenza ridotta.")
+
+    def report_success(self, provider: str):
+        """ la frequenza ridotta da un 429 risale gradualmente """
+        if self._rate_factors.get(provider, 1.0) == 1.0:
+            return
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE quota_bucket SET rate_factor = MIN(rate_factor + ?, 1.0) WHERE provider = ?",
+                         (THROTTLE_RECOVERY, provider))
+
+    def usage(self) -> Dict[str, dict]:
+        """ chiamate e spesa di oggi e del mese per servizio, con i budget configurati """
+        day, month = self._periods(time.time())
+        rows = self._connection().execute("SELECT provider, period, calls, spent FROM quota_spend "
+                                          "WHERE period IN (?, ?)", (day, month)).fetchall()
+        usage = {name: {"day": {"calls": 0, "spent": 0.0, "budget": p.daily_budget},
+                        "month": {"calls": 0, "spent": 0.0, "budget": p.monthly_budget}}
+                 for name, p in self.providers.items()}
+        for provider, period, calls, spent in rows:
+            if provider in usage:
+                usage[provider]["day" if period == day else "month"].update(calls=calls, spent=spent)
+        return usage
+
+
+_quota: Optional[QuotaManager] = None
+_quota_lock = threading.Lock()
+
+
+def get_quota() -> QuotaManager:
+    """ istanza condivisa da tutto il processo, creata al primo utilizzo """
+    global _quota
+    with _quota_lock:
+        if _quota is None:
+            _quota = QuotaManager()
+    return _quota
+
+
+def _spend_metrics():
+    for provider, periods in get_quota().usage().items():
+        for period, usage in periods.items():
+            yield (provider, period), usage["spent"]
+
+
+registry.register_callback("safemo_quota_spent_dollars", "Spesa stimata per servizio, oggi (day) e nel mese (month).",
+                           "gauge", ("provider", "period"), _spend_metrics, shared=True)
+registry.register_callback("safemo_quota_events_total", "Attese, rifiuti per budget e 429 del gestore delle quote.",
+                           "counter", ("event",),
+                           lambda: [((event,), n) for event, n in get_quota().stats.items()])
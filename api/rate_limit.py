@@ -0,0 +1,37 @@
+"""
+Limitatore di frequenza (token bucket) per le chiamate alle API esterne.
+"""
+import asyncio
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket: al massimo `rate` chiamate al secondo, con picchi fino a `burst`.
+    Utilizzabile sia da thread (`acquire`) sia da coroutine (`acquire_async`).
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """ prenota un token e ritorna quanti secondi aspettare prima di usarlo """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        if (wait_s := self._reserve()) > 0:
+            time.sleep(wait_s)
+
+    async def acquire_async(self):
+        if (wait_s := self._reserve()) > 0:
+            await asyncio.sleep(wait_s)
@@ -0,0 +1,286 @@
+"""
+Backend finti e locali per Google Places, Apify e Gemini, da usare senza chiavi e senza rete.
+
+Ogni backend simula latenza (distribuzione configurabile), errori con una certa
+probabilità e dimensione dei risultati, e conta le chiamate ricevute. Vengono passati
+alle interfacce reali tramite i loro parametri (`session`, `client`, `model`), quindi
+tutto il codice tra l'interfaccia e il servizio viene esercitato come in produzione.
+I luoghi e i post generati sono deterministici: dipendono solo dal seed e dalle coordinate.
+"""
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from db.spatial_index import KM_PER_DEGREE_LAT, haversine_km
+
+
+@dataclass
+class LatencyModel:
+    """
+    Latenza lognormale con mediana `median_ms` e 99° percentile `p99_ms`,
+    più un errore con probabilità `error_rate`.
+    """
+    median_ms: float = 50.0
+    p99_ms: float = 200.0
+    error_rate: float = 0.0
+    rng: random.Random = field(default_factory=lambda: random.Random(0))
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        # z del 99° percentile della normale standard
+        self._sigma = math.log(max(self.p99_ms, self.median_ms) / self.median_ms) / 2.326 if self.median_ms else 0.0
+
+    def sample(self) -> Tuple[float, bool]:
+        """ latenza in secondi e se la chiamata deve fallire """
+        with self._lock:
+            delay_ms = self.median_ms * math.exp(self.rng.gauss(0, self._sigma)) if self.median_ms else 0.0
+            return delay_ms / 1000, self.rng.random() < self.error_rate
+
+    def wait(self) -> bool:
+        """ aspetta la latenza simulata; True se la chiamata deve fallire """
+        delay_s, failed = self.sample()
+        time.sleep(delay_s)
+        return failed
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class _FakeResponse:
+    """ il minimo di `requests.Response` usato da `GoogleMapsApiInterface` """
+
+    def __init__(self, status_code: int, payload: dict):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode()
+        self.text = self.content.decode()
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} dal backend finto", response=self)
+
+
+class FakePlacesSession:
+    """
+    Sostituto di `requests.Session` per la Places API: i luoghi sono distribuiti su una griglia
+    con `places_per_km2` luoghi per km² (ogni cella della griglia ha la sua posizione casuale
+    ma stabile), restituiti al massimo 20 per chiamata come fa Google.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None, places_per_km2: float = 20.0, seed: int = 0,
+                 open_at_night_ratio: float = 0.7):
+        self.latency = latency or LatencyModel()
+        self.places_per_km2 = places_per_km2
+        self.seed = seed
+        self.open_at_night_ratio = open_at_night_ratio
+        self.calls = Counter()
+
+    def _places_in_circle(self, latitude: float, longitude: float, radius_km: float) -> List[dict]:
+        step_km = 1 / math.sqrt(self.places_per_km2)
+        lat_step = step_km / KM_PER_DEGREE_LAT
+        lon_step = step_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 0.01))
+        span = int(radius_km / step_km) + 1
+        base_i, base_j = round(latitude / lat_step), round(longitude / lon_step)
+        places = []
+        for i in range(base_i - span, base_i + span + 1):
+            for j in range(base_j - span, base_j + span + 1):
+                rng = random.Random(f"{self.seed}:{i}:{j}")
+                place_latitude = (i + rng.random()) * lat_step
+                place_longitude = (j + rng.random()) * lon_step
+                if (distance := haversine_km(latitude, longitude, place_latitude, place_longitude)) <= radius_km:
+                    places.append((distance, self._make_place(f"fake-{i}-{j}", place_latitude, place_longitude, rng)))
+        places.sort(key=lambda item: item[0])
+        return [place for _, place in places]
+
+    def _make_place(self, place_id: str, latitude: float, longitude: float, rng: random.Random) -> dict:
+        closing_hour = 2 if rng.random() < self.open_at_night_ratio else 20
+        periods = [{"open": {"day": day, "hour": 18, "minute": 0},
+                    "close": {"day": (day + 1) % 7 if closing_hour < 18 else day, "hour": closing_hour, "minute": 0}}
+                   for day in range(7)]
+        return {"id": place_id, "displayName": {"text": f"Bar {place_id}"},
+                "formattedAddress": f"Via Finta {rng.randint(1, 200)}",
+                "location": {"latitude": latitude, "longitude": longitude},
+                "types": ["bar"], "regularOpeningHours": {"periods": periods}}
+
+    def post(self, url: str, data: str, headers: dict, timeout: float = None) -> _FakeResponse:
+        self.calls["searchNearby"] += 1
+        if self.latency.wait():
+            return _FakeResponse(500, {"error": {"message": "errore simulato"}})
+        circle = json.loads(data)["locationRestriction"]["circle"]
+        places = self._places_in_circle(circle["center"]["latitude"], circle["center"]["longitude"],
+                                        circle["radius"] / 1000)
+        return _FakeResponse(200, {"places": places[:json.loads(data).get("maxResultCount", 20)]})
+
+    def get(self, url: str, params: dict, timeout: float = None) -> _FakeResponse:
+        self.calls["geocode"] += 1
+        if self.latency.wait():
+            return _FakeResponse(500, {"error_message": "errore simulato"})
+        rng = random.Random(f"{self.seed}:{params['address']}")
+        return _FakeResponse(200, {"results": [{"geometry": {"location": {
+            "lat": 45.0 + rng.random(), "lng": 11.0 + rng.random()}}}]})
+
+
+class _FakeTask:
+    def __init__(self, client: "FakeApifyClient", task_id: str):
+        self.client = client
+        self.task_id = task_id
+
+    def start(self, task_input: dict) -> dict:
+        return self.client._start(self.task_id, task_input)
+
+
+class _FakeRun:
+    def __init__(self, client: "FakeApifyClient", run_id: str):
+        self.client = client
+        self.run_id = run_id
+
+    def get(self) -> Optional[dict]:
+        return self.client._get_run(self.run_id)
+
+
+class _FakeDataset:
+    def __init__(self, client: "FakeApifyClient", dataset_id: str):
+        self.client = client
+        self.dataset_id = dataset_id
+
+    def list_items(self, offset: int = 0, limit: Optional[int] = None):
+        items = self.client._datasets[self.dataset_id]
+        self.client.calls["list_items"] += 1
+        return _Page(items[offset:offset + limit if limit else None])
+
+
+@dataclass
+class _Page:
+    items: list
+
+
+class FakeApifyClient:
+    """
+    Sostituto di `ApifyClient` con l'API usata da `ApifyApiInterface` (task().start,
+    run().get, dataset().list_items). Ogni run finisce dopo una latenza simulata; i task
+    dei post generano `posts_per_profile` post per profilo, di cui `event_ratio` annunciano un evento.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None, posts_per_profile: int = 10,
+                 event_ratio: float = 0.3, seed: int = 0):
+        self.latency = latency or LatencyModel(median_ms=2000, p99_ms=8000)
+        self.posts_per_profile = posts_per_profile
+        self.event_ratio = event_ratio
+        self.seed = seed
+        self.calls = Counter()
+        self._runs: Dict[str, dict] = {}
+        self._datasets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def task(self, task_id: str) -> _FakeTask:
+        return _FakeTask(self, task_id)
+
+    def run(self, run_id: str) -> _FakeRun:
+        return _FakeRun(self, run_id)
+
+    def dataset(self, dataset_id: str) -> _FakeDataset:
+        return _FakeDataset(self, dataset_id)
+
+    def _start(self, task_id: str, task_input: dict) -> dict:
+        self.calls["start"] += 1
+        with self._lock:
+            run_id = f"run-{len(self._runs)}"
+            # La durata viene estratta subito: la run risulterà finita quando sarà passata
+            duration_s, failed = self.latency.sample()
+            self._runs[run_id] = {"id": run_id, "defaultDatasetId": run_id, "status": "RUNNING",
+                                  "finishes_at": time.monotonic() + duration_s,
+                                  "final_status": "FAILED" if failed else "SUCCEEDED"}
+            self._datasets[run_id] = [] if failed else self._items(task_input)
+        return {"id": run_id, "defaultDatasetId": run_id, "status": "RUNNING"}
+
+    def _get_run(self, run_id: str) -> dict:
+        self.calls["get_run"] += 1
+        run = self._runs[run_id]
+        if time.monotonic() >= run["finishes_at"]:
+            run["status"] = run["final_status"]
+        return {k: run[k] for k in ("id", "defaultDatasetId", "status")}
+
+    def _items(self, task_input: dict) -> List[dict]:
+        if "search" in task_input:
+            username = re.sub(r"\W+", "", task_input["search"].lower())[:30]
+            return [{"url": f"https://www.instagram.com/{username}/", "username": username}]
+        items = []
+        for url in task_input.get("urls", []):
+            username = url.rstrip("/").split("/")[-1].lower()
+            for n in range(self.posts_per_profile):
+                rng = random.Random(f"{self.seed}:{username}:{n}")
+                day = datetime.now() - timedelta(days=n)
+                if rng.random() < self.event_ratio / 2:
+                    # Annuncio completo: riconosciuto dalle regole locali senza chiamare Gemini
+                    event_day = datetime.now() + timedelta(days=rng.randint(1, 14))
+                    caption = (f"SERATA SPECIALE\n{event_day.day}/{event_day.month} dalle {rng.randint(19, 23)}:00 "
+                               f"alle 0{rng.randint(1, 4)}:00, ingresso {rng.randint(5, 20)}€")
+                elif rng.random() < self.event_ratio:
+                    # Annuncio vago: serve il modello
+                    caption = f"Vi aspettiamo venerdì alle {rng.randint(19, 23)}:30 con musica dal vivo!"
+                else:
+                    caption = "Che bella serata con gli amici 🍻"
+                items.append({"id": f"{username}-{n}", "ownerUsername": username, "caption": caption,
+                              "timestamp": day.strftime("%Y-%m-%dT%H:%M:%S.000Z")})
+        return items
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """
+    Sostituto di `genai.GenerativeModel`: risponde ai prompt singoli e a quelli a batch
+    ("### POST <id>") con un JSON plausibile; un post è un evento se contiene un orario.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self.latency = latency or LatencyModel(median_ms=800, p99_ms=3000)
+        self.calls = Counter()
+
+    @staticmethod
+    def _event(text: str) -> dict:
+        if not (match := re.search(r"(\d{1,2})[:.](\d{2})", text)):
+            return {"is_evento": False}
+        start = (datetime.now() + timedelta(days=1)).replace(hour=int(match.group(1)) % 24, minute=int(match.group(2)),
+                                                             second=0, microsecond=0)
+        return {"is_evento": True, "name": text.strip().split("\n")[0][:60], "description": text[:200],
+                "start_time": start.isoformat(), "end_time": None, "price": None}
+
+    def generate_content(self, prompt: str) -> _FakeGeminiResponse:
+        self.calls["generate_content"] += 1
+        if self.latency.wait():
+            raise FakeBackendError("errore simulato di Gemini")
+        if posts := re.findall(r"### POST (\S+)\n(.*?)(?=\n\n### POST |\Z)", prompt, re.DOTALL):
+            return _FakeGeminiResponse(json.dumps([dict(self._event(text), post_id=p_id) for p_id, text in posts]))
+        return _FakeGeminiResponse(json.dumps(self._event(prompt.split("---", 1)[-1])))
+
+
+def fake_instagram_source(latency: Optional[LatencyModel] = None, hit_ratio: float = 0.8, seed: int = 0):
+    """ sorgente finta per `InstagramResolver`: trova un profilo per `hit_ratio` dei luoghi """
+    latency = latency or LatencyModel(median_ms=300, p99_ms=1500)
+
+    def source(name: str, address: str) -> Optional[str]:
+        if latency.wait():
+            raise FakeBackendError("errore simulato della ricerca")
+        rng = random.Random(f"{seed}:{name}:{address}")
+        if rng.random() >= hit_ratio:
+            return None
+        return f"https://www.instagram.com/{re.sub(r'[^a-z0-9]+', '', name.lower())}/"
+
+    return source
@@ -0,0 +1,235 @@
+"""
+Benchmark end-to-end senza rete e senza chiavi: Google, Apify, Gemini e la ricerca dei
+profili sono sostituiti dai backend finti di `bench.fakes`, tutto il resto è il codice reale.
+
+    python -m bench.run collector --areas 5 --radius 2
+    python -m bench.run server --requests 500 --concurrency 20 --max-p95-ms 200
+
+Stampa latenze (p50/p95/p99), throughput, chiamate ai servizi esterni, statistiche delle
+cache e memoria massima; con `--json` il report è in JSON. Con `--max-p95-ms` e
+`--min-throughput` il comando esce con codice 1 se le soglie non sono rispettate.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# La configurazione viene letta all'import dei moduli: va impostata prima
+_WORKDIR = tempfile.mkdtemp(prefix="safemo-bench-")
+os.environ.setdefault('LOCALS_DB_PATH', os.path.join(_WORKDIR, "locals_db.sqlite3"))
+os.environ.setdefault('APIFY_POLL_INTERVAL_S', '0.2')
+os.environ.setdefault('RESPONSE_CACHE_TTL_S', '60')
+
+from bench.fakes import (FakeApifyClient, FakeGeminiModel, FakePlacesSession, LatencyModel,  # noqa: E402
+                         fake_instagram_source)
+
+# Centro delle aree generate (Vicenza): le aree sono sparse entro `--spread-km`
+CENTER = (45.5455, 11.5354)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": ordered[-1]}
+
+
+def random_point(rng: random.Random, spread_km: float):
+    from db.spatial_index import KM_PER_DEGREE_LAT
+    return (CENTER[0] + rng.uniform(-spread_km, spread_km) / KM_PER_DEGREE_LAT,
+            CENTER[1] + rng.uniform(-spread_km, spread_km) / (KM_PER_DEGREE_LAT * 0.7))
+
+
+def make_fakes(args) -> dict:
+    rng = random.Random(args.seed)
+
+    def latency(median_ms: float, p99_ms: float) -> LatencyModel:
+        return LatencyModel(median_ms * args.latency_scale, p99_ms * args.latency_scale, args.error_rate,
+                            random.Random(rng.random()))
+
+    return {"places": FakePlacesSession(latency(80, 400), places_per_km2=args.density, seed=args.seed),
+            "apify": FakeApifyClient(latency(2000, 8000), posts_per_profile=args.posts, seed=args.seed),
+            "gemini": FakeGeminiModel(latency(800, 3000)),
+            "instagram": fake_instagram_source(latency(300, 1500), seed=args.seed)}
+
+
+def run_collector(args, fakes: dict) -> dict:
+    from api.apify_api_interface import ApifyApiInterface
+    from api.gemini_api_interface import GeminiApiInterface
+    from api.google_maps_api_interface import GoogleMapsApiInterface
+    from api.instagram_resolver import InstagramResolver
+    from main import PlacesDataCollector
+
+    collector = PlacesDataCollector(google_maps=GoogleMapsApiInterface(session=fakes["places"]),
+                                    gemini=GeminiApiInterface(model=fakes["gemini"]),
+                                    apify=ApifyApiInterface(client=fakes["apify"]),
+                                    instagram_resolver=InstagramResolver(sources={"fake": fakes["instagram"]},
+                                                                         tiers="fake"))
+    rng = random.Random(args.seed)
+    latencies, first_place, places, events = [], [], 0, 0
+    start = time.perf_counter()
+    for _ in range(args.areas):
+        latitude, longitude = random_point(rng, args.spread_km)
+        area_start = time.perf_counter()
+        for n, place in enumerate(collector.stream_places_nearby("bar", latitude, longitude, args.radius)):
+            if n == 0:
+                first_place.append(time.perf_counter() - area_start)
+            places += 1
+            events += len(place.events or [])
+        latencies.append(time.perf_counter() - area_start)
+    elapsed = time.perf_counter() - start
+    return {"operations": args.areas, "elapsed_s": elapsed, "latency_ms": _ms(percentiles(latencies)),
+            "first_place_ms": _ms(percentiles(first_place)), "throughput_per_s": args.areas / elapsed,
+            "places": places, "events": events}
+
+
+def run_server(args, fakes: dict) -> dict:
+    import asyncio
+
+    import tornado.httpclient
+    import tornado.httpserver
+    import tornado.netutil
+
+    from api.google_maps_api_interface import GoogleMapsApiInterface
+    from handlers.health_handler import ServerState
+    from server import make_app
+
+    async def load() -> dict:
+        state = ServerState()
+        state.ready = True
+        app = make_app(state, google_maps_api=GoogleMapsApiInterface(session=fakes["places"]))
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        port = sockets[0].getsockname()[1]
+        http_server = tornado.httpserver.HTTPServer(app)
+        http_server.add_sockets(sockets)
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+
+        rng = random.Random(args.seed)
+        urls = []
+        for _ in range(args.requests):
+            latitude, longitude = random_point(rng, args.spread_km)
+            urls.append(f"http://127.0.0.1:{port}/api/placesAround?lat={latitude}&lon={longitude}&radius={args.radius}")
+        latencies, statuses = [], {}
+        queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+
+        async def worker():
+            while not queue.empty():
+                url = queue.get_nowait()
+                request_start = time.perf_counter()
+                response = await client.fetch(url, raise_error=False, request_timeout=120)
+                latencies.append(time.perf_counter() - request_start)
+                statuses[response.code] = statuses.get(response.code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        http_server.stop()
+        client.close()
+        return {"operations": args.requests, "elapsed_s": elapsed, "latency_ms": _ms(percentiles(latencies)),
+                "throughput_per_s": args.requests / elapsed, "status_codes": statuses}
+
+    return asyncio.run(load())
+
+
+def _ms(stats: Dict[str, float]) -> Dict[str, float]:
+    return {name: round(value * 1000, 1) for name, value in stats.items()}
+
+
+def collect_report(args, fakes: dict, result: dict) -> dict:
+    from api.apify_runs import actor_runs
+    from api.places_cache import places_cache
+    from api.quota import get_quota
+    from handlers.response_cache import places_responses
+    from metrics import EVENT_EXTRACTION_POSTS
+
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return dict(result, scenario=args.scenario, max_rss_mb=round(max_rss_mb, 1),
+                upstream_calls={"google": dict(fakes["places"].calls), "apify": dict(fakes["apify"].calls),
+                                "gemini": dict(fakes["gemini"].calls)},
+                actor_runs=dict(actor_runs.stats),
+                cost_usd={provider: round(usage["day"]["spent"], 4) for provider, usage in get_quota().usage().items()},
+                caches={"places": dict(places_cache.stats), "responses": dict(places_responses.stats)},
+                extraction={outcome: int(EVENT_EXTRACTION_POSTS.value(outcome=outcome))
+                            for outcome in ("skipped", "cache", "rules", "model")})
+
+
+def print_report(report: dict):
+    print(f"📊 Scenario '{report['scenario']}': {report['operations']} operazioni in {report['elapsed_s']:.2f}s "
+          f"({report['throughput_per_s']:.2f}/s)")
+    latency = report["latency_ms"]
+    print(f"   latenza: p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+          f"max {latency['max']} ms")
+    for name in ("first_place_ms", "places", "events", "status_codes"):
+        if name in report:
+            print(f"   {name}: {report[name]}")
+    print(f"   chiamate esterne: {report['upstream_calls']}")
+    print(f"   run Apify: {report['actor_runs']}")
+    print(f"   costo stimato ($): {report['cost_usd']}")
+    print(f"   cache: {report['caches']}")
+    print(f"   estrazione eventi (post): {report['extraction']}")
+    print(f"   memoria massima: {report['max_rss_mb']} MB")
+
+
+def check_gates(args, report: dict) -> List[str]:
+    failures = []
+    if args.max_p95_ms is not None and report["latency_ms"]["p95"] > args.max_p95_ms:
+        failures.append(f"p95 {report['latency_ms']['p95']} ms > {args.max_p95_ms} ms")
+    if args.min_throughput is not None and report["throughput_per_s"] < args.min_throughput:
+        failures.append(f"throughput {report['throughput_per_s']:.2f}/s < {args.min_throughput}/s")
+    extraction = report["extraction"]
+    # I post finti contengono annunci completi: se nessuno passa dalle regole locali, il percorso non è misurato
+    if extraction["rules"] + extraction["model"] > 0 and extraction["rules"] == 0:
+        failures.append("nessun post estratto con le regole locali")
+    return failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end con backend finti.")
+    parser.add_argument("scenario", choices=["collector", "server"])
+    parser.add_argument("--areas", type=int, default=3, help="aree raccolte (scenario collector)")
+    parser.add_argument("--requests", type=int, default=200, help="richieste HTTP (scenario server)")
+    parser.add_argument("--concurrency", type=int, default=10, help="richieste contemporanee (scenario server)")
+    parser.add_argument("--radius", type=float, default=1.0, help="raggio delle aree in km")
+    parser.add_argument("--spread-km", type=float, default=5.0, help="distanza massima delle aree dal centro")
+    parser.add_argument("--density", type=float, default=20.0, help="luoghi finti per km²")
+    parser.add_argument("--posts", type=int, default=10, help="post finti per profilo")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="moltiplica tutte le latenze simulate")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilità di errore di ogni chiamata")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="fallisce se il p95 supera questa soglia")
+    parser.add_argument("--min-throughput", type=float, help="fallisce se il throughput è inferiore (operazioni/s)")
+    args = parser.parse_args(argv)
+
+    fakes = make_fakes(args)
+    # Con --json su stdout va solo il report: i messaggi del codice misurato finiscono su stderr
+    with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+        result = run_collector(args, fakes) if args.scenario == "collector" else run_server(args, fakes)
+    report = collect_report(args, fakes, result)
+    failures = check_gates(args, report)
+    report["gate_failures"] = failures
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        for failure in failures:
+            print(f"❌ Soglia non rispettata: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
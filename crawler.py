@@ -0,0 +1,118 @@
+"""
+Crawler per province: raccoglie i locali di tutti i comuni delle province richieste
+usando `PlacesDataCollector`.
+
+I comuni vengono messi in una coda persistente (`db.crawl_store`) ed elaborati da un
+pool di worker, con un limite globale di frequenza e un budget massimo di comuni per
+esecuzione. Lo stato di ogni comune viene salvato: dopo un crash il crawler riparte
+dai comuni non ancora completati.
+Le chiamate del crawler hanno priorità BATCH (`api.quota`): quando il loro budget è
+esaurito il crawler si ferma e i comuni rimasti restano in coda per la prossima esecuzione.
+
+Uso: python crawler.py PD VR --workers 4 --radius 3 --rate 0.5 --budget 200
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from api.quota import QuotaExceeded
+from api.rate_limit import RateLimiter
+from db.crawl_store import CrawlStore, DONE, FAILED, PENDING, RUNNING, load_comuni
+from main import PlacesDataCollector
+
+
+class CrawlBudget:
+    """ numero massimo di comuni da raccogliere in questa esecuzione (None = illimitato) """
+
+    def __init__(self, max_jobs: Optional[int]):
+        self.remaining = max_jobs
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class ProvinceCrawler:
+
+    def __init__(self, provinces: List[str], place_type: str = "bar", radius_km: float = 3.0, workers: int = 4,
+                 max_jobs_per_s: float = 0.5, budget: Optional[int] = None, retry_failed: bool = False,
+                 incremental: bool = False):
+        self.provinces = provinces
+        self.place_type = place_type
+        self.radius_km = radius_km
+        self.workers = workers
+        self.retry_failed = retry_failed
+        self.incremental = incremental
+        self.limiter = RateLimiter(max_jobs_per_s, burst=1)
+        self.budget = CrawlBudget(budget)
+        self.quota_exhausted = threading.Event()
+        self.store = CrawlStore()
+        self.collector = PlacesDataCollector()
+
+    def geocode(self, province: str, comune: str) -> Optional[Tuple[float, float]]:
+        """ coordinate del comune, geocodificato una sola volta e poi letto dalla cache """
+        address = f"{comune}, {province}, Italia"
+        found, coordinates = self.store.get_geocode(address)
+        if not found:
+            coordinates = self.collector.google_maps.geocode(address)
+            self.store.put_geocode(address, coordinates)
+        return coordinates
+
+    def _crawl_comune(self, province: str, comune: str):
+        if self.quota_exhausted.is_set() or not self.budget.take():
+            return
+        self.limiter.acquire()
+        self.store.set_status(province, comune, RUNNING)
+        try:
+            if (coordinates := self.geocode(province, comune)) is None:
+                self.store.set_status(province, comune, FAILED, "comune non geocodificabile")
+                return
+            if self.incremental:
+                self.collector.refresh_places_nearby(self.place_type, *coordinates, self.radius_km)
+            else:
+                self.collector.collect_places_nearby(self.place_type, *coordinates, self.radius_km)
+            self.store.set_status(province, comune, DONE)
+            print(f"✅ {comune} ({province}) completato.")
+        except QuotaExceeded as e:
+            # Il comune torna in coda: verrà raccolto quando il budget si rinnova
+            print(f"💸 {e}: il crawler si ferma, {comune} ({province}) resta in coda.")
+            self.store.set_status(province, comune, PENDING)
+            self.quota_exhausted.set()
+        except Exception as e:
+            print(f"❌ Errore durante la raccolta di {comune} ({province}): {e}")
+            self.store.set_status(province, comune, FAILED, str(e))
+
+    def run(self) -> dict:
+        self.store.enqueue(load_comuni(self.provinces))
+        jobs = self.store.resume(self.provinces, retry_failed=self.retry_failed)
+        print(f"🚀 {len(jobs)} comuni da raccogliere in {', '.join(self.provinces)} con {self.workers} worker...")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for province, comune in jobs:
+                executor.submit(self._crawl_comune, province, comune)
+        progress = self.store.progress(self.provinces)
+        print(f"🎉 Crawler terminato: {progress}")
+        return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Raccoglie i locali di tutti i comuni delle province indicate.")
+    parser.add_argument("provinces", nargs="+", help="sigle delle province, es. PD VR")
+    parser.add_argument("--type", default="bar", help="tipo di luogo da cercare")
+    parser.add_argument("--radius", type=float, default=3.0, help="raggio in km attorno a ogni comune")
+    parser.add_argument("--workers", type=int, default=4, help="numero di comuni elaborati in parallelo")
+    parser.add_argument("--rate", type=float, default=0.5, help="comuni avviati al massimo al secondo")
+    parser.add_argument("--budget", type=int, default=None, help="numero massimo di comuni in questa esecuzione")
+    parser.add_argument("--retry-failed", action="store_true", help="riprova anche i comuni falliti")
+    parser.add_argument("--incremental", action="store_true",
+                        help="aggiorna solo aree e locali scaduti invece di raccogliere tutto da capo")
+    args = parser.parse_args()
+
+    ProvinceCrawler([p.upper() for p in args.provinces], args.type, args.radius, args.workers,
+                    args.rate, args.budget, args.retry_failed, args.incremental).run()
@@ -0,0 +1,101 @@
+"""
+Stato persistente (SQLite) del crawler per province: coda dei comuni da raccogliere
+con il loro stato (checkpoint per riprendere dopo un crash) e cache delle geocodifiche.
+"""
+import json
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from db.places_store import DB_PATH, connect
+
+PROVINCE_FILE = "db/province_e_comuni.json"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_jobs (
+    province TEXT NOT NULL,
+    comune TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (province, comune)
+);
+CREATE INDEX IF NOT EXISTS idx_crawl_jobs_status ON crawl_jobs (status);
+CREATE TABLE IF NOT EXISTS geocode_cache (
+    address TEXT PRIMARY KEY,
+    latitude REAL,
+    longitude REAL
+);
+"""
+
+
+def load_comuni(provinces: List[str], path: str = PROVINCE_FILE) -> List[Tuple[str, str]]:
+    """ (provincia, comune) per tutte le province richieste """
+    with open(path, "r") as f:
+        province_e_comuni = json.load(f)
+    if missing := [p for p in provinces if p not in province_e_comuni]:
+        raise ValueError(f"Province sconosciute: {', '.join(missing)}")
+    return [(province, comune) for province in provinces for comune in province_e_comuni[province]]
+
+
+class CrawlStore:
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def enqueue(self, jobs: List[Tuple[str, str]]):
+        """ aggiunge i comuni alla coda; quelli già presenti mantengono il loro stato """
+        with self._connection() as conn:
+            conn.executemany("INSERT OR IGNORE INTO crawl_jobs (province, comune, status, updated_at) "
+                             "VALUES (?, ?, ?, ?)", [(p, c, PENDING, time.time()) for p, c in jobs])
+
+    def resume(self, provinces: List[str], retry_failed: bool = False) -> List[Tuple[str, str]]:
+        """
+        comuni ancora da raccogliere: quelli rimasti `running` dopo un crash tornano in coda,
+        quelli falliti solo se richiesto
+        """
+        statuses = [PENDING, RUNNING] + ([FAILED] if retry_failed else [])
+        rows = self._connection().execute(
+            f"SELECT province, comune FROM crawl_jobs WHERE province IN ({','.join('?' * len(provinces))}) "
+            f"AND status IN ({','.join('?' * len(statuses))}) ORDER BY province, comune", (*provinces, *statuses))
+        return rows.fetchall()
+
+    def set_status(self, province: str, comune: str, status: str, error: Optional[str] = None):
+        with self._connection() as conn:
+            conn.execute("UPDATE crawl_jobs SET status = ?, error = ?, updated_at = ?, "
+                         "attempts = attempts + (? = 'running') WHERE province = ? AND comune = ?",
+                         (status, error, time.time(), status, province, comune))
+
+    def progress(self, provinces: List[str]) -> dict:
+        rows = self._connection().execute(
+            f"SELECT status, COUNT(*) FROM crawl_jobs WHERE province IN ({','.join('?' * len(provinces))}) "
+            f"GROUP BY status", provinces)
+        return dict(rows.fetchall())
+
+    def get_geocode(self, address: str) -> Tuple[bool, Optional[Tuple[float, float]]]:
+        """ ritorna (trovato in cache, coordinate); coordinate None se l'indirizzo non è geocodificabile """
+        row = self._connection().execute(
+            "SELECT latitude, longitude FROM geocode_cache WHERE address = ?", (address,)).fetchone()
+        if row is None:
+            return False, None
+        return True, (row[0], row[1]) if row[0] is not None else None
+
+    def put_geocode(self, address: str, coordinates: Optional[Tuple[float, float]]):
+        latitude, longitude = coordinates or (None, None)
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO geocode_cache (address, latitude, longitude) VALUES (?, ?, ?)",
+                         (address, latitude, longitude))
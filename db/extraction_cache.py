@@ -0,0 +1,69 @@
+"""
+Cache persistente (SQLite) dei risultati dell'estrazione di eventi con l'LLM.
+
+Il modello gira a temperatura 0, quindi lo stesso testo con lo stesso prompt e lo
+stesso modello dà sempre lo stesso risultato. La chiave è l'hash di (testo
+normalizzato, versione del prompt, nome del modello); vengono salvati sia gli
+eventi estratti sia i post che non sono eventi.
+"""
+import hashlib
+import json
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from db.places_store import DB_PATH, connect
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS extraction_cache (
+    key TEXT PRIMARY KEY,
+    event TEXT
+);
+"""
+
+
+def content_key(text: str, prompt_version: str, model_name: str) -> str:
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model_name}\0{prompt_version}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """ ritorna key -> evento serializzato (None se il post non è un evento) per le chiavi in cache """
+        keys = list(keys)
+        result = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._connection().execute(
+                f"SELECT key, event FROM extraction_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            result.update({key: json.loads(event) if event else None for key, event in rows})
+        return result
+
+    def put_many(self, results: Iterable[Tuple[str, Optional[dict]]]):
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO extraction_cache (key, event) VALUES (?, ?)",
+                             [(key, json.dumps(event) if event else None) for key, event in results])
+
+
+_extraction_cache: Optional[ExtractionCache] = None
+_extraction_cache_lock = threading.Lock()
+
+
+def get_extraction_cache() -> ExtractionCache:
+    """ istanza condivisa da tutto il processo """
+    global _extraction_cache
+    with _extraction_cache_lock:
+        if _extraction_cache is None:
+            _extraction_cache = ExtractionCache()
+    return _extraction_cache
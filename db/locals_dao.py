@@ -1,49 +1,163 @@
 import json
-from typing import Dict, Optional, Union
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
 from marshmallow import ValidationError
 
 from db.models import Place
+from db.places_store import PlacesStore
+from db.spatial_index import GridIndex, cells_in_radius, haversine_km
+from metrics import DB_ERRORS, DB_SECONDS, instrumented
+
+# Dopo quanto tempo un'area già cercata su Google non è più considerata aggiornata
+COVERAGE_MAX_AGE_S = float(os.getenv('COVERAGE_MAX_AGE_S', str(24 * 3600)))
 
 
 class LocalsDAO:
 
-    @staticmethod
-    def load_db() -> Optional[Dict[str, Dict[str, Place]]]:
-        """ load the db file and return a dict of places """
-        with open("db/locals_db.json", "r") as f:
+    def __init__(self, store: Optional[PlacesStore] = None):
+        self.store = store or PlacesStore()
+        self.spatial_index = GridIndex()
+        self._index_version = None
+        self._sync_index()
+
+    @property
+    def version(self) -> int:
+        """
+        versione dei dati, incrementata a ogni scrittura di qualsiasi processo:
+        chi tiene in cache dati derivati sa quando sono vecchi
+        """
+        return self.store.get_version()
+
+    def area_version(self, place_type: str, latitude: float, longitude: float, radius_km: float) -> int:
+        """
+        versione dei luoghi nelle celle del cerchio: cambia solo con le scritture in quest'area,
+        quindi i dati derivati di altre aree restano validi
+        """
+        return self.store.cells_version(place_type, cells_in_radius(latitude, longitude, radius_km))
+
+    def _sync_index(self):
+        """
+        allinea l'indice spaziale alle scritture degli altri processi: all'avvio lo costruisce
+        da tutto il database, poi applica solo i luoghi scritti dopo l'ultima versione vista
+        """
+        if (version := self.store.get_version()) == self._index_version:
+            return
+        if self._index_version is None:
+            index = GridIndex()
+            for place_type, place_id, latitude, longitude in self.store.iter_locations():
+                index.upsert(place_type, place_id, latitude, longitude)
+            self.spatial_index = index
+        else:
+            for place_type, place_id, latitude, longitude in self.store.iter_locations_since(self._index_version):
+                self.spatial_index.upsert(place_type, place_id, latitude, longitude)
+        self._index_version = version
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="load_db")
+    def load_db(self) -> Optional[Dict[str, Dict[str, Place]]]:
+        """ load the whole db and return a dict of places """
+        db = {}
+        for place_type, place_id, place in self.store.iter_all():
             try:
-                db = json.load(f)
-                for place_type, places in db.items():
-                    for place_id, place in places.items():
-                        try:
-                            db[place_type].update({place_id: Place.load(place)})
-                        except ValidationError:
-                            pass
-            except json.JSONDecodeError:
-                return {}
+                # Dati già validati quando sono stati salvati: niente marshmallow
+                place = Place.from_dict(place)
+            except ValidationError:
+                pass
+            db.setdefault(place_type, {})[place_id] = place
         return db
 
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="get_places_details")
     def get_places_details(self, place_type: str, new_places: Dict[str, Place]):
-        """ update the db file with new places """
-        db = self.load_db()
-        if not (places := db.get(place_type)):
+        """ update the new places with the details already stored in the db """
+        if not (places := self.store.get_many(place_type, new_places.keys())):
             print("no data found in db for this place type")
             return new_places
-        for p_id, p in new_places.items():
-            if p_id in db[place_type]:
-                p.update(places.get(p_id).dump())
+        for p_id, p in places.items():
+            try:
+                stored = Place.from_dict(p)
+                new_places[p_id].update({name: getattr(stored, name) for name in Place.__slots__})
+            except ValidationError:
+                new_places[p_id].update(p)
         return new_places
 
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="dump_db")
     def dump_db(self, place_type: str, new_places: Dict[str, Union[dict, Place]]):
-        """ update the db file with new places """
-        db = self.load_db()
-        for p_id, p in db.get(place_type, {}).items():
-            if isinstance(place := new_places.get(p_id, {}), Place):
+        """
+        upsert the new places in the db, merging them with the stored ones.
+        Places whose merged data equals the stored data are not rewritten, so they keep
+        their version and the cached responses of their area stay valid
+        """
+        stored = self.store.get_many(place_type, new_places.keys())
+        changed = {}
+        for p_id, place in new_places.items():
+            if isinstance(place, Place):
                 place = place.dump()
-            p.update(place)
-        with open("db/locals_db.json", "w") as f:
-            json.dump(self.db_to_dict(db), f, indent=4)
+            merged = dict(stored.get(p_id, {}), **place)
+            if merged != stored.get(p_id):
+                changed[p_id] = merged
+        if not changed:
+            return
+        previous_version = self._index_version
+        version = self.store.upsert_many(place_type, changed)
+        for p_id, place in changed.items():
+            self.spatial_index.upsert(place_type, p_id, place.get("latitude"), place.get("longitude"))
+        # Se nel frattempo nessun altro ha scritto, l'indice aggiornato qui è già allineato
+        if version == previous_version + 1:
+            self._index_version = version
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="find_places_within")
+    def find_places_within(self, place_type: str, latitude: float, longitude: float,
+                           radius_km: float) -> Dict[str, Place]:
+        """ return the stored places within the radius, ordered by distance """
+        self._sync_index()
+        nearby = self.spatial_index.query_radius(place_type, latitude, longitude, radius_km)
+        stored = self.store.get_many(place_type, [p_id for _, p_id in nearby])
+        return {p_id: Place.from_dict(stored[p_id]) for _, p_id in nearby if p_id in stored}
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="find_events")
+    def find_events(self, place_type: str, latitude: float, longitude: float, radius_km: float,
+                    start_from: datetime, start_to: datetime, max_price: Optional[float] = None, limit: int = 50,
+                    after: Optional[Tuple[float, str, int]] = None) -> Tuple[List[dict], Optional[Tuple[float, str, int]]]:
+        """
+        events starting in [start_from, start_to) within the radius, ordered by start time, read from the
+        events index; returns the page and the key to pass as `after` for the next one (None if it is the last)
+        """
+        events, last_key = [], None
+        for start_ts, place_id, seq, e_lat, e_lon, data in self.store.iter_events(
+                place_type, cells_in_radius(latitude, longitude, radius_km), start_from.timestamp(),
+                start_to.timestamp(), max_price, after):
+            if (distance := haversine_km(latitude, longitude, e_lat, e_lon)) > radius_km:
+                continue
+            if len(events) == limit:
+                return events, last_key
+            event = json.loads(data)
+            event["distance_km"] = round(distance, 3)
+            events.append(event)
+            last_key = (start_ts, place_id, seq)
+        return events, None
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="get_refresh_state")
+    def get_refresh_state(self, place_type: str, place_ids) -> Dict[str, Tuple[float, Optional[str]]]:
+        """ place_id -> (last posts fetch timestamp, ISO date of the newest post seen) """
+        return self.store.get_refresh_state(place_type, place_ids)
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="set_refresh_state")
+    def set_refresh_state(self, place_type: str, states: Dict[str, Tuple[float, Optional[str]]]):
+        self.store.set_refresh_state(place_type, states)
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="record_coverage")
+    def record_coverage(self, place_type: str, latitude: float, longitude: float, radius_km: float):
+        """ mark the area as completely fetched from Google right now """
+        self.store.add_coverage(place_type, latitude, longitude, radius_km, time.time())
+
+    @instrumented(DB_SECONDS, DB_ERRORS, operation="is_area_fresh")
+    def is_area_fresh(self, place_type: str, latitude: float, longitude: float, radius_km: float,
+                      max_age_s: float = COVERAGE_MAX_AGE_S) -> bool:
+        """ true if a recent complete search contains the whole requested circle """
+        return any(haversine_km(latitude, longitude, c_lat, c_lon) + radius_km <= c_radius
+                   for c_lat, c_lon, c_radius in self.store.get_coverage(place_type, time.time() - max_age_s))
 
     @staticmethod
     def db_to_dict(db: Dict[str, Union[dict, Place]]) -> Dict[str, Dict[str, dict]]:
@@ -1,39 +1,143 @@
+import dataclasses
 import json
+import typing
 from abc import ABC
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import ClassVar, Type, Mapping, Any, List
+from typing import ClassVar, Callable, Dict, Tuple, Type, Mapping, Any, List
 
 import marshmallow
 import marshmallow_dataclass
 from bson import ObjectId
 
+from db import opening_hours
+
 
 class BaseSchema(marshmallow.Schema):
     class Meta:
         unknown = marshmallow.EXCLUDE
 
 
+class _Missing:
+    pass
+
+
+# Campo assente nel dict passato a `from_dict`
+_MISSING = _Missing()
+# Istanze degli Schema riusate tra le chiamate: crearne uno è molto più costoso di usarlo
+_SCHEMAS: Dict[Tuple[type, bool], BaseSchema] = {}
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _from_iso(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _dump_models(values):
+    return None if values is None else [v.dump() if isinstance(v, BasicModel) else v for v in values]
+
+
+def _compile_converters(cls) -> Tuple[Callable[[Any], dict], Callable[[Mapping], Any]]:
+    """
+    genera il codice di dump/from_dict della dataclass, un'espressione per campo in base al tipo:
+    niente dispatch per campo a runtime come in marshmallow
+    """
+    hints = typing.get_type_hints(cls)
+    namespace = {"cls": cls, "_iso": _iso, "_from_iso": _from_iso, "_dump_models": _dump_models, "MISSING": _MISSING}
+    dump_items, load_lines = [], []
+    for i, f in enumerate(dataclasses.fields(cls)):
+        hint = hints[f.name]
+        nested = typing.get_args(hint)[0] if typing.get_origin(hint) is list else None
+        if hint is datetime:
+            dump_expr, load_expr = f"_iso(self.{f.name})", "_from_iso(value)"
+        elif isinstance(nested, type) and issubclass(nested, BasicModel):
+            namespace[f"nested_{i}"] = nested
+            dump_expr = f"_dump_models(self.{f.name})"
+            load_expr = f"None if value is None else [nested_{i}.from_dict(v) for v in value]"
+        else:
+            dump_expr, load_expr = f"self.{f.name}", "value"
+        dump_items.append(f"{f.name!r}: {dump_expr}")
+        if f.default is not dataclasses.MISSING:
+            namespace[f"default_{i}"] = f.default
+            missing = f"default_{i}"
+        elif f.default_factory is not dataclasses.MISSING:
+            namespace[f"factory_{i}"] = f.default_factory
+            missing = f"factory_{i}()"
+        else:
+            missing = "MISSING"
+        load_lines += [f"    value = mapping.get({f.name!r}, MISSING)",
+                       f"    obj.{f.name} = {missing} if value is MISSING else {load_expr}"]
+    source = (f"def dump(self):\n    return {{{', '.join(dump_items)}}}\n"
+              f"def from_dict(mapping):\n    obj = cls.__new__(cls)\n" + "\n".join(load_lines) + "\n    return obj\n")
+    exec(source, namespace)
+    return namespace["dump"], namespace["from_dict"]
+
+
+def with_slots(cls):
+    """
+    ricrea la dataclass con `__slots__` (marshmallow_dataclass non supporta slots=True):
+    meno memoria per istanza e accesso agli attributi più veloce. Lo Schema viene
+    rigenerato perché crei istanze della nuova classe.
+    """
+    names = tuple(f.name for f in dataclasses.fields(cls))
+    namespace = {k: v for k, v in cls.__dict__.items() if k not in names + ("__dict__", "__weakref__", "Schema")}
+    namespace["__slots__"] = names
+    slotted = type(cls)(cls.__name__, cls.__bases__, namespace)
+    slotted.Schema = marshmallow_dataclass.class_schema(slotted, base_schema=BaseSchema)
+    return slotted
+
+
 @marshmallow_dataclass.dataclass(base_schema=BaseSchema)
 class BasicModel(ABC):
+    """
+    `load`/`loads` validano con marshmallow e vanno usati per i dati esterni (Google, Gemini, client).
+    `dump` e `from_dict` usano convertitori generati per ogni classe e non validano:
+    `from_dict` è per i dati già validati in precedenza (database, cache).
+    """
+    __slots__ = ()
     Schema: ClassVar[Type[BaseSchema]]  # only for type hinting
 
     def __getitem__(self, key):
         return self.__getattribute__(key)
 
+    @classmethod
+    def schema(cls, many: bool = False) -> BaseSchema:
+        if (schema := _SCHEMAS.get((cls, many))) is None:
+            schema = _SCHEMAS[(cls, many)] = cls.Schema(many=many)
+        return schema
+
+    @classmethod
+    def _converters(cls) -> Tuple[Callable[[Any], dict], Callable[[Mapping], Any]]:
+        # Generati al primo uso: i tipi annidati devono essere già definiti
+        if "_compiled" not in cls.__dict__:
+            cls._compiled = _compile_converters(cls)
+        return cls._compiled
+
     def dump(self) -> dict:
-        return dict(self.Schema().dump(self))
+        return self._converters()[0](self)
 
     def dumps(self) -> str:
-        return self.Schema().dumps(self)
+        return json.dumps(self.dump())
 
     @classmethod
     def dump_many(cls, obj):
-        return cls.Schema(many=True).dump(obj)
+        dump = cls._converters()[0]
+        return [dump(o) for o in obj]
+
+    @classmethod
+    def from_dict(cls, mapping: Mapping):
+        """ load veloce senza validazione; se mancano campi obbligatori ripiega su `load` """
+        obj = cls._converters()[1](mapping)
+        if any(getattr(obj, name) is _MISSING for name in cls.__slots__):
+            return cls.load(mapping)
+        return obj
 
     @classmethod
     def load(cls, mapping: Mapping):
-        return cls.Schema().load(mapping)
+        return cls.schema().load(mapping)
 
     @classmethod
     def loadm(cls, model: Any):
@@ -46,17 +150,20 @@ class BasicModel(ABC):
             return str(o)
         if isinstance(o, bytes):
             return o.decode('utf-8')
+        if isinstance(o, BasicModel):
+            return o.dump()
         return o.__dict__
 
     @classmethod
     def load_many(cls, model: Any):
-        return cls.Schema(many=True).load(model)
+        return cls.schema(many=True).load(model)
 
     @classmethod
     def loads(cls, model: str):
-        return cls.Schema().loads(model)
+        return cls.schema().loads(model)
 
 
+@with_slots
 @marshmallow_dataclass.dataclass(base_schema=BaseSchema)
 class Event(BasicModel):
     name: str = None
@@ -68,13 +175,14 @@ class Event(BasicModel):
     @classmethod
     def load_from_google_gemini(cls, event: dict):
         m = dict(name=event.get('name', ''),
-                 start_time=datetime.fromisoformat(event.get('start_time')) if event.get('start_time') else None,
-                 end_time=datetime.fromisoformat(event.get('end_time')) if event.get('end_time') else None,
+                 start_time=datetime.fromisoformat(event.get('start_time')).isoformat() if event.get('start_time') else None,
+                 end_time=datetime.fromisoformat(event.get('end_time')).isoformat() if event.get('end_time') else None,
                  price=event.get('price', 0.0),
                  description=event.get('description', ''))
         return cls.load(m)
 
 
+@with_slots
 @marshmallow_dataclass.dataclass(base_schema=BaseSchema)
 class Place(BasicModel):
     name: str
@@ -87,6 +195,10 @@ class Place(BasicModel):
     latitude: float = None
     instagram_URL: str = ""
     events: List[Event] = field(default_factory=list)  # list of events
+    # opening_hours compilati da `db.opening_hours` (None se non ancora compilati)
+    weekly_hours: List[int] = None
+    # Campi salvati nel database ma non restituiti dalle API
+    STORAGE_ONLY_FIELDS: ClassVar[Tuple[str, ...]] = ("weekly_hours",)
 
     @classmethod
     def load_from_google_place(cls, place: dict):
@@ -94,11 +206,34 @@ class Place(BasicModel):
                    id=place.get('id', ''),
                    address=place.get('formattedAddress', ''),
                    type=place.get('types', []),
-                   opening_hours=place.get('regularOpeningHours', {}),)
+                   opening_hours=place.get('regularOpeningHours', {}),
+                   weekly_hours=opening_hours.compile_periods(place.get('regularOpeningHours', {}).get('periods')),
+                   latitude=place.get('location', {}).get('latitude'),
+                   longitude=place.get('location', {}).get('longitude'))
         return cls.load(map)
 
+    def dump_public(self) -> dict:
+        """ `dump` per le risposte delle API, senza i campi interni """
+        return {k: v for k, v in self.dump().items() if k not in self.STORAGE_ONLY_FIELDS}
+
     def update(self, place_data: dict):
         for k, v in place_data.items():
-            if v is not None:
+            # Con __slots__ le chiavi che non sono campi non possono diventare attributi
+            if v is not None and k in self.__slots__:
                 self.__setattr__(k, v)
+        if "opening_hours" in place_data and place_data.get("weekly_hours") is None:
+            # Orari cambiati senza la loro versione compilata: verranno ricompilati al primo uso
+            self.weekly_hours = None
+
+    def weekly_intervals(self) -> List[int]:
+        """ orari compilati, calcolati una volta sola per i luoghi salvati prima della compilazione """
+        if self.weekly_hours is None:
+            self.weekly_hours = opening_hours.compile_periods((self.opening_hours or {}).get('periods'))
+        return self.weekly_hours
+
+    def is_open_at(self, when: datetime) -> bool:
+        return opening_hours.is_open_at(self.weekly_intervals(), opening_hours.minute_of_week(when))
+
+    def is_open_between(self, start: datetime, end: datetime) -> bool:
+        return bool(opening_hours.filter_open_between({self.id: self}, start, end))
 
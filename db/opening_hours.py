@@ -0,0 +1,99 @@
+"""
+Orari di apertura compilati in intervalli settimanali.
+
+I `regularOpeningHours.periods` di Google diventano una lista piatta e ordinata di minuti
+della settimana `[apre, chiude, apre, chiude, ...]` (lunedì 00:00 = 0, come `datetime.weekday()`),
+con gli intervalli uniti e quelli che attraversano la fine della settimana divisi in due.
+Con la lista piatta "aperto al minuto m" è una bisezione: l'indice di inserimento è dispari
+solo se m cade dentro un intervallo. Gli orari sono nell'ora locale del luogo.
+"""
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, TypeVar
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# Un periodo senza chiusura (Google lo usa per i locali aperti 24 ore su 24)
+ALWAYS_OPEN = [0, MINUTES_PER_WEEK]
+
+P = TypeVar("P")
+
+
+def _minute_of_week(point: dict) -> int:
+    # Google conta i giorni dalla domenica (0), Python dal lunedì
+    day = (point.get('day', 0) - 1) % 7
+    return day * MINUTES_PER_DAY + point.get('hour', 0) * 60 + point.get('minute', 0)
+
+
+def minute_of_week(when: datetime) -> int:
+    return when.weekday() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+
+def compile_periods(periods: Optional[List[dict]]) -> List[int]:
+    """ compila i periodi di Google nella lista piatta di intervalli; [] se mancano gli orari """
+    intervals = []
+    for period in periods or []:
+        if not (open_info := period.get('open')):
+            continue
+        if not (close_info := period.get('close')):
+            return list(ALWAYS_OPEN)
+        start, end = _minute_of_week(open_info), _minute_of_week(close_info)
+        if end <= start:
+            # Chiude il giorno dopo (o la settimana dopo, da sabato a domenica)
+            end += MINUTES_PER_WEEK
+        if end > MINUTES_PER_WEEK:
+            intervals += [(start, MINUTES_PER_WEEK), (0, end - MINUTES_PER_WEEK)]
+        else:
+            intervals.append((start, end))
+    merged: List[int] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1]:
+            merged[-1] = max(merged[-1], end)
+        else:
+            merged += [start, end]
+    return merged
+
+
+def is_open_at(intervals: List[int], minute: int) -> bool:
+    return bisect_right(intervals, minute) % 2 == 1
+
+
+def is_open_between(intervals: List[int], start: int, end: int) -> bool:
+    """ aperto almeno per un minuto in [start, end); `end` può superare la fine della settimana """
+    if end - start >= MINUTES_PER_WEEK:
+        return bool(intervals)
+    if end > MINUTES_PER_WEEK:
+        return is_open_between(intervals, start, MINUTES_PER_WEEK) or is_open_between(intervals, 0, end - MINUTES_PER_WEEK)
+    i = bisect_right(intervals, start)
+    # Aperto già all'inizio, oppure il primo orario successivo a `start` è un'apertura prima di `end`
+    return i % 2 == 1 or (i < len(intervals) and intervals[i] < end)
+
+
+def is_open_daily_between(intervals: List[int], start: int, end: int) -> bool:
+    """
+    aperto almeno per un minuto tra `start` ed `end` (minuti dalla mezzanotte) in almeno un giorno
+    della settimana; con `end` <= `start` la fascia finisce il giorno dopo
+    """
+    if end <= start:
+        end += MINUTES_PER_DAY
+    return any(is_open_between(intervals, day * MINUTES_PER_DAY + start, day * MINUTES_PER_DAY + end)
+               for day in range(7))
+
+
+def filter_open_between(places: Dict[str, P], start: datetime, end: datetime) -> Dict[str, P]:
+    """ i luoghi aperti almeno per un minuto tra `start` ed `end`: l'intervallo viene convertito una volta sola """
+    first = minute_of_week(start)
+    last = first + max(int((end - start).total_seconds() // 60), 1)
+    return {p_id: place for p_id, place in places.items() if is_open_between(place.weekly_intervals(), first, last)}
+
+
+def filter_open_at(places: Dict[str, P], when: datetime) -> Dict[str, P]:
+    """ i luoghi aperti all'istante `when` ("aperto ora" con `datetime.now()`) """
+    return filter_open_between(places, when, when + timedelta(minutes=1))
+
+
+def filter_open_daily_between(places: Dict[str, P], start: time, end: time) -> Dict[str, P]:
+    """ i luoghi aperti tra `start` ed `end` in almeno un giorno: non dipende da quando viene chiamato """
+    first, last = start.hour * 60 + start.minute, end.hour * 60 + end.minute
+    return {p_id: place for p_id, place in places.items()
+            if is_open_daily_between(place.weekly_intervals(), first, last)}
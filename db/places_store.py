@@ -0,0 +1,278 @@
+"""
+Storage SQLite (WAL) per i luoghi salvati da `LocalsDAO`.
+
+Ogni riga è un luogo serializzato in JSON, indicizzato per id, tipo e cella della
+griglia spaziale: upsert e letture puntuali costano O(righe toccate) e non
+richiedono più di riscrivere tutto il database.
+Gli eventi dei luoghi sono copiati nella tabella `events`, indicizzata per cella e
+orario di inizio e aggiornata nella stessa transazione dell'upsert del luogo.
+"""
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DB_PATH = os.getenv('LOCALS_DB_PATH', 'db/locals_db.sqlite3')
+JSON_DB_PATH = "db/locals_db.json"
+# Lato della cella della griglia spaziale, in gradi (~1 km di latitudine)
+GRID_CELL_DEG = 0.01
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS places (
+    place_type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    cell TEXT,
+    latitude REAL,
+    longitude REAL,
+    data TEXT NOT NULL,
+    updated_version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (place_type, id)
+);
+CREATE INDEX IF NOT EXISTS idx_places_id ON places (id);
+CREATE TABLE IF NOT EXISTS coverage (
+    place_type TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    radius_km REAL NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_coverage_type_time ON coverage (place_type, fetched_at);
+CREATE TABLE IF NOT EXISTS refresh_state (
+    place_type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    posts_fetched_at REAL,
+    newest_post_at TEXT,
+    PRIMARY KEY (place_type, id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('places_version', 0);
+CREATE TABLE IF NOT EXISTS events (
+    place_type TEXT NOT NULL,
+    place_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    cell TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    price REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (place_type, place_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_events_cell_start ON events (place_type, cell, start_ts);
+"""
+# Campi del luogo copiati in ogni evento dell'indice, per rispondere senza leggere il luogo
+EVENT_PLACE_FIELDS = ("id", "name", "address", "latitude", "longitude", "instagram_URL")
+
+
+def grid_cell_index(latitude: Optional[float], longitude: Optional[float]) -> Optional[Tuple[int, int]]:
+    """ indici (riga, colonna) della cella della griglia spaziale che contiene il punto """
+    if latitude is None or longitude is None:
+        return None
+    return math.floor(latitude / GRID_CELL_DEG), math.floor(longitude / GRID_CELL_DEG)
+
+
+def grid_cell(latitude: Optional[float], longitude: Optional[float]) -> Optional[str]:
+    """ cella della griglia spaziale che contiene il punto, come stringa per la colonna `cell` """
+    if (cell := grid_cell_index(latitude, longitude)) is None:
+        return None
+    return f"{cell[0]}:{cell[1]}"
+
+
+def _timestamp(value) -> Optional[float]:
+    """ epoch dell'orario ISO (senza fuso: ora locale), None se assente o non valido """
+    try:
+        return datetime.fromisoformat(value).timestamp() if isinstance(value, str) else None
+    except ValueError:
+        return None
+
+
+def event_rows(place_type: str, place_id: str, place: dict) -> List[tuple]:
+    """ righe della tabella `events` per il luogo: solo gli eventi con un orario di inizio e un luogo posizionato """
+    latitude, longitude = place.get("latitude"), place.get("longitude")
+    if (cell := grid_cell(latitude, longitude)) is None:
+        return []
+    summary = {name: place.get(name) for name in EVENT_PLACE_FIELDS}
+    rows = []
+    for seq, event in enumerate(place.get("events") or []):
+        if (start_ts := _timestamp(event.get("start_time"))) is None:
+            continue
+        price = event.get("price")
+        rows.append((place_type, place_id, seq, cell, start_ts, latitude, longitude,
+                     price if isinstance(price, (int, float)) else None, json.dumps(dict(event, place=summary))))
+    return rows
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """ apre una connessione SQLite in modalità WAL """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class PlacesStore:
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+            # Database creati prima di `updated_version`: le righe esistenti partono dalla versione 0
+            if "updated_version" not in {row[1] for row in conn.execute("PRAGMA table_info(places)")}:
+                conn.execute("ALTER TABLE places ADD COLUMN updated_version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_places_updated ON places (updated_version)")
+            # Con la versione nell'indice per cella, la versione di un'area si legge senza toccare le righe
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_places_cell_version ON places (place_type, cell, updated_version)")
+            conn.execute("DROP INDEX IF EXISTS idx_places_cell")
+            # Database creati prima dell'indice degli eventi: lo si costruisce una volta sola
+            if conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('events_indexed', 1)").rowcount:
+                self._index_events(conn, ((place_type, place_id, json.loads(data)) for place_type, place_id, data
+                                          in conn.execute("SELECT place_type, id, data FROM places").fetchall()))
+
+    def _connection(self) -> sqlite3.Connection:
+        """ una connessione per thread: in WAL i lettori non bloccano lo scrittore """
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def get(self, place_type: str, place_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data FROM places WHERE place_type = ? AND id = ?", (place_type, place_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, place_type: str, place_ids: Iterable[str]) -> Dict[str, dict]:
+        place_ids = list(place_ids)
+        result = {}
+        # SQLite limita il numero di parametri per query
+        for i in range(0, len(place_ids), 500):
+            chunk = place_ids[i:i + 500]
+            rows = self._connection().execute(
+                f"SELECT id, data FROM places WHERE place_type = ? AND id IN ({','.join('?' * len(chunk))})",
+                (place_type, *chunk))
+            result.update({place_id: json.loads(data) for place_id, data in rows})
+        return result
+
+    def iter_all(self) -> Iterator[Tuple[str, str, dict]]:
+        for place_type, place_id, data in self._connection().execute("SELECT place_type, id, data FROM places"):
+            yield place_type, place_id, json.loads(data)
+
+    def iter_locations(self) -> Iterator[Tuple[str, str, float, float]]:
+        yield from self._connection().execute(
+            "SELECT place_type, id, latitude, longitude FROM places WHERE latitude IS NOT NULL AND longitude IS NOT NULL")
+
+    def iter_locations_since(self, version: int) -> Iterator[Tuple[str, str, Optional[float], Optional[float]]]:
+        """ posizioni dei luoghi scritti dopo `version` (anche senza coordinate, per toglierli dall'indice) """
+        yield from self._connection().execute(
+            "SELECT place_type, id, latitude, longitude FROM places WHERE updated_version > ?", (version,))
+
+    def upsert_many(self, place_type: str, places: Dict[str, dict]) -> int:
+        """ inserisce o aggiorna i luoghi; ritorna la nuova versione del database """
+        with self._connection() as conn:
+            # Nella stessa transazione: chi vede la nuova versione vede anche i nuovi dati.
+            # Ogni riga ricorda la versione che l'ha scritta, così gli altri processi leggono solo le modifiche
+            version = conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'places_version' RETURNING value"
+                                   ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO places (place_type, id, cell, latitude, longitude, data, updated_version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (place_type, id) DO UPDATE SET cell = excluded.cell, "
+                "latitude = excluded.latitude, longitude = excluded.longitude, data = excluded.data, "
+                "updated_version = excluded.updated_version",
+                [(place_type, place_id, grid_cell(p.get("latitude"), p.get("longitude")),
+                  p.get("latitude"), p.get("longitude"), json.dumps(p), version) for place_id, p in places.items()])
+            self._index_events(conn, ((place_type, place_id, p) for place_id, p in places.items()))
+            return version
+
+    @staticmethod
+    def _index_events(conn: sqlite3.Connection, places: Iterable[Tuple[str, str, dict]]):
+        """ sostituisce nell'indice gli eventi dei luoghi (da chiamare dentro la transazione dell'upsert) """
+        for place_type, place_id, place in places:
+            conn.execute("DELETE FROM events WHERE place_type = ? AND place_id = ?", (place_type, place_id))
+            conn.executemany("INSERT INTO events (place_type, place_id, seq, cell, start_ts, latitude, longitude, "
+                             "price, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             event_rows(place_type, place_id, place))
+
+    def iter_events(self, place_type: str, cells: List[str], start_from: float, start_to: float,
+                    max_price: Optional[float] = None, after: Optional[Tuple[float, str, int]] = None
+                    ) -> Iterator[Tuple[float, str, int, float, float, str]]:
+        """
+        eventi delle celle con inizio in [start_from, start_to), ordinati per (inizio, luogo, posizione)
+        e successivi ad `after`; ritorna (start_ts, place_id, seq, lat, lon, JSON dell'evento).
+        Gli eventi senza prezzo non vengono esclusi da `max_price`.
+        """
+        query = (f"SELECT start_ts, place_id, seq, latitude, longitude, data FROM events "
+                 f"WHERE place_type = ? AND cell IN ({','.join('?' * len(cells))}) AND start_ts >= ? AND start_ts < ?")
+        params = [place_type, *cells, start_from, start_to]
+        if max_price is not None:
+            query += " AND (price IS NULL OR price <= ?)"
+            params.append(max_price)
+        if after is not None:
+            query += " AND (start_ts, place_id, seq) > (?, ?, ?)"
+            params += after
+        yield from self._connection().execute(query + " ORDER BY start_ts, place_id, seq", params)
+
+    def get_version(self) -> int:
+        """ contatore delle scritture su `places`, condiviso da tutti i processi che usano il database """
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'places_version'").fetchone()[0]
+
+    def cells_version(self, place_type: str, cells: List[str]) -> int:
+        """ versione dell'ultima scrittura dei luoghi nelle celle (0 se sono vuote) """
+        version = 0
+        # SQLite limita il numero di parametri per query
+        for i in range(0, len(cells), 500):
+            chunk = cells[i:i + 500]
+            row = self._connection().execute(
+                f"SELECT MAX(updated_version) FROM places WHERE place_type = ? AND cell IN ({','.join('?' * len(chunk))})",
+                (place_type, *chunk)).fetchone()
+            version = max(version, row[0] or 0)
+        return version
+
+    def add_coverage(self, place_type: str, latitude: float, longitude: float, radius_km: float, fetched_at: float):
+        """ registra che l'area è stata cercata completamente su Google in `fetched_at` """
+        with self._connection() as conn:
+            conn.execute("INSERT INTO coverage (place_type, latitude, longitude, radius_km, fetched_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (place_type, latitude, longitude, radius_km, fetched_at))
+
+    def get_coverage(self, place_type: str, since: float) -> List[Tuple[float, float, float]]:
+        """ aree (lat, lon, raggio) cercate dopo `since` """
+        return self._connection().execute(
+            "SELECT latitude, longitude, radius_km FROM coverage WHERE place_type = ? AND fetched_at >= ?",
+            (place_type, since)).fetchall()
+
+    def get_refresh_state(self, place_type: str, place_ids: Iterable[str]) -> Dict[str, Tuple[float, Optional[str]]]:
+        """ place_id -> (ultimo scaricamento dei post, data ISO del post più recente visto) """
+        place_ids = list(place_ids)
+        result = {}
+        for i in range(0, len(place_ids), 500):
+            chunk = place_ids[i:i + 500]
+            rows = self._connection().execute(
+                f"SELECT id, posts_fetched_at, newest_post_at FROM refresh_state "
+                f"WHERE place_type = ? AND id IN ({','.join('?' * len(chunk))})", (place_type, *chunk))
+            result.update({place_id: (fetched_at, newest) for place_id, fetched_at, newest in rows})
+        return result
+
+    def set_refresh_state(self, place_type: str, states: Dict[str, Tuple[float, Optional[str]]]):
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO refresh_state (place_type, id, posts_fetched_at, newest_post_at) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(place_type, place_id, fetched_at, newest) for place_id, (fetched_at, newest) in states.items()])
+
+    def import_json(self, json_path: str = JSON_DB_PATH) -> int:
+        """ importa una volta sola il vecchio file JSON; ritorna il numero di luoghi importati """
+        with open(json_path, "r") as f:
+            db = json.load(f)
+        for place_type, places in db.items():
+            self.upsert_many(place_type, places)
+        return sum(len(places) for places in db.values())
+
+
+if __name__ == '__main__':
+    # Uso: python -m db.places_store [percorso del file JSON]
+    count = PlacesStore().import_json(sys.argv[1] if len(sys.argv) > 1 else JSON_DB_PATH)
+    print(f"✅ Importati {count} luoghi in {DB_PATH}.")
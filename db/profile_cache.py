@@ -0,0 +1,88 @@
+"""
+Cache persistente (SQLite) delle ricerche dei profili Instagram.
+
+La chiave è (sorgente, nome normalizzato, indirizzo normalizzato). Vengono salvati
+sia i profili trovati (TTL lungo) sia i luoghi senza profilo (TTL più breve), così
+le raccolte successive sulla stessa zona non ripetono le ricerche a pagamento.
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Dict, Optional, Tuple
+
+from db.places_store import DB_PATH, connect
+
+HIT_TTL_S = float(os.getenv('PROFILE_CACHE_HIT_TTL_S', str(90 * 24 * 3600)))
+MISS_TTL_S = float(os.getenv('PROFILE_CACHE_MISS_TTL_S', str(7 * 24 * 3600)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile_cache (
+    source TEXT NOT NULL,
+    name TEXT NOT NULL,
+    address TEXT NOT NULL,
+    url TEXT,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (source, name, address)
+);
+"""
+
+
+def normalize(text: str) -> str:
+    """ minuscolo, senza accenti e con la punteggiatura ridotta a spazi singoli """
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+
+class ProfileCache:
+
+    def __init__(self, path: str = DB_PATH, hit_ttl_s: float = HIT_TTL_S, miss_ttl_s: float = MISS_TTL_S):
+        self.path = path
+        self.hit_ttl_s = hit_ttl_s
+        self.miss_ttl_s = miss_ttl_s
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0}
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def get(self, source: str, name: str, address: str) -> Tuple[bool, Optional[str]]:
+        """ ritorna (trovato in cache, url); url None in cache significa "nessun profilo" """
+        row = self._connection().execute(
+            "SELECT url FROM profile_cache WHERE source = ? AND name = ? AND address = ? AND expires_at > ?",
+            (source, normalize(name), normalize(address), time.time())).fetchone()
+        with self._stats_lock:
+            if row is None:
+                self.stats["misses"] += 1
+            else:
+                self.stats["hits" if row[0] else "negative_hits"] += 1
+        return (False, None) if row is None else (True, row[0])
+
+    def put(self, source: str, name: str, address: str, url: Optional[str]):
+        expires_at = time.time() + (self.hit_ttl_s if url else self.miss_ttl_s)
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO profile_cache (source, name, address, url, expires_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (source, normalize(name), normalize(address), url, expires_at))
+
+    def report(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.stats)
+
+
+_profile_cache: Optional[ProfileCache] = None
+_profile_cache_lock = threading.Lock()
+
+
+def get_profile_cache() -> ProfileCache:
+    """ istanza condivisa da tutto il processo """
+    global _profile_cache
+    with _profile_cache_lock:
+        if _profile_cache is None:
+            _profile_cache = ProfileCache()
+    return _profile_cache
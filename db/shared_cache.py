@@ -0,0 +1,83 @@
+"""
+Cache condivisa tra processi, su un file SQLite (WAL) locale: nessun servizio esterno.
+
+Con il server multi-processo ogni worker ha le sue cache in memoria; questa cache fa da
+secondo livello comune, così una risposta di Google o una risposta renderizzata
+calcolata da un worker è subito disponibile anche agli altri.
+Viene attivata impostando `SHARED_CACHE_PATH` (il server multi-processo lo fa da sé).
+"""
+import os
+import threading
+import time
+from typing import List, Optional
+
+from db.places_store import connect
+
+SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS idx_shared_cache_expires ON shared_cache (expires_at);
+"""
+
+
+class SharedCache:
+
+    def __init__(self, path: str, purge_every: int = 1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._puts = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        """ il valore se presente e non scaduto """
+        row = self._connection().execute(
+            "SELECT value FROM shared_cache WHERE namespace = ? AND key = ? AND expires_at >= ?",
+            (namespace, key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def values(self, namespace: str) -> List[bytes]:
+        """ tutti i valori non scaduti del namespace """
+        return [row[0] for row in self._connection().execute(
+            "SELECT value FROM shared_cache WHERE namespace = ? AND expires_at >= ?", (namespace, time.time()))]
+
+    def put(self, namespace: str, key: str, value: bytes, ttl_s: float):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO shared_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                         (namespace, key, value, time.time() + ttl_s))
+        self._puts += 1
+        if self._puts % self.purge_every == 0:
+            self.purge()
+
+    def purge(self):
+        """ elimina le voci scadute """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM shared_cache WHERE expires_at < ?", (time.time(),))
+
+
+_shared_cache: Optional[SharedCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache() -> Optional[SharedCache]:
+    """ istanza condivisa da tutto il processo, None se `SHARED_CACHE_PATH` non è impostato """
+    global _shared_cache
+    if not SHARED_CACHE_PATH:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SharedCache(SHARED_CACHE_PATH)
+    return _shared_cache
@@ -0,0 +1,92 @@
+"""
+Indice spaziale in memoria (griglia regolare) sui luoghi salvati.
+
+Usa le stesse celle della colonna `cell` di `PlacesStore`: una ricerca per raggio
+visita solo le celle che intersecano il bounding box del cerchio e ordina i
+candidati per distanza haversine.
+"""
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from db.places_store import grid_cell_index
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """ distanza in km tra due punti sulla sfera terrestre """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cell_bounds(latitude: float, longitude: float, radius_km: float) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """
+    prima e ultima cella del bounding box del cerchio, calcolato sulla stessa sfera di `haversine_km`:
+    un bounding box più stretto della distanza usata dal filtro perderebbe i luoghi appena oltre il bordo di una cella
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(angle)
+    if abs(latitude) + d_lat >= 90:
+        # Il cerchio contiene un polo: tutte le longitudini
+        d_lon = 180.0
+    else:
+        # Il punto più a est del cerchio è più vicino al polo del centro: l'ampiezza supera angle / cos(lat)
+        d_lon = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(latitude)))))
+    return (grid_cell_index(latitude - d_lat, longitude - d_lon),
+            grid_cell_index(latitude + d_lat, longitude + d_lon))
+
+
+def cells_in_radius(latitude: float, longitude: float, radius_km: float) -> List[str]:
+    """ celle (nel formato della colonna `cell`) che intersecano il bounding box del cerchio """
+    (min_x, min_y), (max_x, max_y) = cell_bounds(latitude, longitude, radius_km)
+    return [f"{x}:{y}" for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+class GridIndex:
+
+    def __init__(self):
+        # (place_type, cella) -> {place_id: (lat, lon)}
+        self._cells: Dict[Tuple[str, Tuple[int, int]], Dict[str, Tuple[float, float]]] = {}
+        # (place_type, place_id) -> cella
+        self._positions: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        # L'indice è condiviso tra i thread (handler, worker del crawler)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def upsert(self, place_type: str, place_id: str, latitude: Optional[float], longitude: Optional[float]):
+        with self._lock:
+            self.remove(place_type, place_id)
+            if (cell := grid_cell_index(latitude, longitude)) is None:
+                return
+            self._cells.setdefault((place_type, cell), {})[place_id] = (latitude, longitude)
+            self._positions[(place_type, place_id)] = cell
+
+    def remove(self, place_type: str, place_id: str):
+        with self._lock:
+            if (cell := self._positions.pop((place_type, place_id), None)) is None:
+                return
+            bucket = self._cells[(place_type, cell)]
+            bucket.pop(place_id, None)
+            if not bucket:
+                del self._cells[(place_type, cell)]
+
+    def query_radius(self, place_type: str, latitude: float, longitude: float,
+                     radius_km: float) -> List[Tuple[float, str]]:
+        """ ritorna (distanza_km, place_id) dei luoghi entro il raggio, dal più vicino """
+        (min_x, min_y), (max_x, max_y) = cell_bounds(latitude, longitude, radius_km)
+        results = []
+        with self._lock:
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    for place_id, (p_lat, p_lon) in self._cells.get((place_type, (x, y)), {}).items():
+                        if (distance := haversine_km(latitude, longitude, p_lat, p_lon)) <= radius_km:
+                            results.append((distance, place_id))
+        results.sort()
+        return results
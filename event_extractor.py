@@ -1,9 +1,105 @@
 import re
-from typing import Optional
+import unicodedata
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
 
 import dateparser
 
-from instaScrapping.db.models import Event
+from db.models import Event
+
+# Sopra questa soglia l'evento estratto con le regole viene usato senza chiamare l'LLM
+HIGH_CONFIDENCE = 0.9
+
+_MONTHS = (r'gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre|'
+           r'january|february|march|april|may|june|july|august|september|october|november|december|'
+           r'gen|feb|mar|apr|mag|giu|lug|ago|set|ott|nov|dic|jan|jun|jul|aug|sep|oct|dec')
+_WEEKDAYS = (r'luned[iì]|marted[iì]|mercoled[iì]|gioved[iì]|venerd[iì]|sabato|domenica|'
+             r'monday|tuesday|wednesday|thursday|friday|saturday|sunday')
+
+# Regex precompilate: vengono usate su ogni post, prima di qualsiasi chiamata all'LLM.
+# Con il punto serve anche l'anno: "22.00", "12.30" o "4.5" sono orari o numeri, non date
+DATE_PATTERN = re.compile(
+    rf'\b(?:(?:{_WEEKDAYS})\s+)?\d{{1,2}}\s+(?:{_MONTHS})\b\.?(?:\s+\d{{4}})?'
+    r'|\b(?P<day>\d{1,2})/(?P<month>\d{1,2})(?:/\d{2,4})?\b(?![:./]\d)'
+    r'|\b(?P<dotted_day>\d{1,2})\.(?P<dotted_month>\d{1,2})\.\d{2,4}\b',
+    re.IGNORECASE)
+# "aperti 24/7", "h24/7", "voto 8/10": una barra dopo queste parole non è una data
+NOT_DATE_BEFORE_PATTERN = re.compile(r'\b(?:aperti|aperto|open|h|su|voto)\s*$', re.IGNORECASE)
+# "3/4 2" o "24/7 365": un numero che segue (e non è un orario) indica una frazione o un conteggio
+NOT_DATE_AFTER_PATTERN = re.compile(r'\s*\d+\b(?![:.]\d)')
+RELATIVE_DAY_PATTERN = re.compile(rf'\b(?:stasera|stanotte|oggi|domani|tonight|tomorrow|{_WEEKDAYS})\b',
+                                  re.IGNORECASE)
+# Giorni relativi che bastano da soli a fissare la data (in giorni da oggi)
+RELATIVE_DAY_OFFSETS = {'stasera': 0, 'stanotte': 0, 'oggi': 0, 'tonight': 0, 'today': 0, 'domani': 1, 'tomorrow': 1}
+RELATIVE_DATE_PATTERN = re.compile(rf'\b(?:{"|".join(RELATIVE_DAY_OFFSETS)})\b', re.IGNORECASE)
+_HOUR = r'([01]?\d|2[0-3])'
+_TIME_PREFIX = r'(?:dalle\s+ore|dalle|alle|ore|from|h)'
+_RANGE_END = rf'(?:\s*(?:-|–|alle|to)\s*(?:ore\s*)?{_HOUR}(?:[:.]([0-5]\d))?\b)?'
+# Gruppi: ora e minuti di inizio (1, 2) e di fine (3, 4) con i minuti, oppure
+# ora di inizio (5) e ora e minuti di fine (6, 7) per "dalle 22 alle 2"
+TIME_PATTERN = re.compile(
+    rf'(?:\b{_TIME_PREFIX}\s*)?\b{_HOUR}[:.]([0-5]\d)\b{_RANGE_END}'
+    rf'|\b{_TIME_PREFIX}\s*{_HOUR}\b(?![:.]\d){_RANGE_END}',
+    re.IGNORECASE)
+# Inizio di un intervallo ("dalle 22 ..."): se la fine non viene letta l'evento è incompleto
+RANGE_START_PATTERN = re.compile(r'(?:dalle|from)\b', re.IGNORECASE)
+PRICE_PATTERN = re.compile(r'(\d+(?:[.,]\d{1,2})?)\s*(?:€|euro)|€\s*(\d+(?:[.,]\d{1,2})?)|(ingresso\s+(?:libero|gratuito)|gratuit[oa]|free\s+entry)',
+                           re.IGNORECASE)
+DATE_SETTINGS = {'PREFER_DATES_FROM': 'future', 'DATE_ORDER': 'DMY'}
+
+
+class RuleResult(NamedTuple):
+    is_candidate: bool  # False: il post non ha segnali di data/ora e non va inviato all'LLM
+    confidence: float
+    event: Optional[Event]
+
+
+def _is_date(match: re.Match) -> bool:
+    """ scarta le date numeriche con giorno o mese fuori intervallo e le barre che non sono date """
+    day, month = match.group('day') or match.group('dotted_day'), match.group('month') or match.group('dotted_month')
+    if day is None:
+        return True
+    if not (1 <= int(day) <= 31 and 1 <= int(month) <= 12):
+        return False
+    if match.group('day') is None:
+        return True
+    return not (NOT_DATE_BEFORE_PATTERN.search(match.string, 0, match.start())
+                or NOT_DATE_AFTER_PATTERN.match(match.string, match.end()))
+
+
+def find_date(text: str) -> Optional[re.Match]:
+    """ la prima data del testo che supera i controlli di `_is_date` """
+    return next((match for match in DATE_PATTERN.finditer(text) if _is_date(match)), None)
+
+
+def has_event_signal(text: str) -> bool:
+    """ controllo veloce (solo regex): il testo contiene una data, un giorno o un orario? """
+    return bool(find_date(text) or RELATIVE_DAY_PATTERN.search(text) or TIME_PATTERN.search(text))
+
+
+def _extract_title(lines: list) -> Optional[str]:
+    """ una riga quasi tutta in maiuscolo è spesso il titolo dell'evento """
+    for line in lines:
+        letters = [c for c in line if c.isalpha()]
+        if len(letters) > 5 and sum(c.isupper() for c in letters) / len(letters) > 0.7:
+            return line.strip()
+    return None
+
+
+def _parse_time(match: re.Match) -> Tuple[int, int, Optional[int], int]:
+    """ (ora, minuti) di inizio e di fine (ora None se il testo non indica la fine) """
+    if match.group(1) is not None:
+        start_hour, start_minute, end_hour, end_minute = match.group(1, 2, 3, 4)
+    else:
+        start_hour, start_minute, end_hour, end_minute = match.group(5), None, match.group(6), match.group(7)
+    return (int(start_hour), int(start_minute or 0),
+            int(end_hour) if end_hour is not None else None, int(end_minute or 0))
+
+
+def _parse_price(match: re.Match) -> float:
+    if match.group(3):
+        return 0.0
+    return float((match.group(1) or match.group(2)).replace(',', '.'))
 
 
 def extract_event_info(text: str) -> Optional[Event]:
@@ -14,96 +110,93 @@ def extract_event_info(text: str) -> Optional[Event]:
         text: The string containing the event description.
 
     Returns:
-        An Event object populated with the extracted information.
+        An Event object populated with the extracted information, or None if no date is found.
     """
+    return classify_post(text).event
 
-    # Instantiate the Event object to store results
-    event_info = Event()
 
-    lines = text.strip().split('\n')
+def classify_post(text: str) -> RuleResult:
+    """
+    Classificatore locale basato su regole: scarta i post senza segnali di data/ora
+    e, quando trova titolo, data e orario, compila direttamente l'Event.
+    """
+    # NFKC riporta i caratteri "larghi" (es. ＡＦＲＯ) a caratteri normali
+    text = unicodedata.normalize('NFKC', text or '')
+    if not has_event_signal(text):
+        return RuleResult(False, 0.0, None)
+
+    lines = [line for line in text.strip().split('\n') if line.strip()]
     remaining_text = text
+    confidence = 0.0
 
     # --- 1. Extract Event Name ---
-    # Look for a line that is mostly uppercase, which is often the title.
-    for i, line in enumerate(lines):
-        # Remove anything that isn't an uppercase letter or whitespace to check its ratio
-        clean_line = re.sub(r'[^A-ZÀ-Ú\s]', '', line.upper())
-        if len(clean_line.strip()) > 5 and (len(clean_line) / len(line) > 0.7 if len(line) > 0 else 0):
-            event_info.name = line.strip()
-            # Remove the title line from the text so it's not in the description
-            remaining_text = remaining_text.replace(line, "", 1)
-            break
+    name = _extract_title(lines)
+    if name:
+        confidence += 0.2
+        remaining_text = remaining_text.replace(name, "", 1)
 
     # --- 2. Extract Date ---
-    # Use dateparser.search.search_dates for flexible date parsing.
-    # Set PREFER_DATES_FROM to 'future' to correctly interpret dates without a year.
-    settings = {'PREFER_DATES_FROM': 'future', 'DATE_ORDER': 'DMY'}
-    # Correctly call the function from the 'search' module
-    found_dates = dateparser.parse(text, languages=['it'], date_formats=['%d %B'])
-    if not found_dates:
-        return None
-    # Take the first valid date found
-    event_info.date = found_dates[0][1].strftime('%Y-%m-%d')
-    # Remove the date string from the remaining text
-    remaining_text = remaining_text.replace(found_dates[0][0], "", 1)
+    date = None
+    if date_match := find_date(remaining_text):
+        date = dateparser.parse(date_match.group(0), languages=['it', 'en'], settings=DATE_SETTINGS)
+        remaining_text = remaining_text.replace(date_match.group(0), "", 1)
+    elif relative_match := RELATIVE_DATE_PATTERN.search(remaining_text):
+        # "stasera", "domani": la data è relativa a oggi, la parola resta nella descrizione
+        date = datetime.now() + timedelta(days=RELATIVE_DAY_OFFSETS[relative_match.group(0).lower()])
+    if date is None:
+        return RuleResult(True, confidence, None)
+    confidence += 0.4
 
     # --- 3. Extract Time (Start and End) ---
-    # Regex to find times like "22.00", "22:00", "dalle 22", or ranges like "21:00 - 23:30"
-    time_pattern = re.compile(
-        r'(?:dalle\sore|dalle|alle|ore)?\s*(\d{1,2}[:.]\d{2}|\d{1,2})\s*(?:-\s*(\d{1,2}[:.]\d{2}|\d{1,2}))?',
-        re.IGNORECASE)
-    found_times = time_pattern.findall(remaining_text)
-
-    if found_times:
-        # Take the first start time found and normalize it
-        event_info.start_time = found_times[0][0].replace('.', ':')
-        # If an end time is found in the "start - end" format
-        if found_times[0][1]:
-            event_info.end_time = found_times[0][1].replace('.', ':')
-
-        # Remove the found time strings from the remaining text
-        for match in time_pattern.finditer(remaining_text):
-            remaining_text = remaining_text.replace(match.group(0), "", 1)
+    start_time, end_time = date.replace(hour=0, minute=0, second=0, microsecond=0), None
+    if time_match := TIME_PATTERN.search(remaining_text):
+        start_hour, start_minute, end_hour, end_minute = _parse_time(time_match)
+        start_time = start_time.replace(hour=start_hour, minute=start_minute)
+        if end_hour is not None:
+            end_time = start_time.replace(hour=end_hour, minute=end_minute)
+            # Un evento che finisce "prima" di iniziare finisce il giorno dopo
+            if end_time <= start_time:
+                end_time += timedelta(days=1)
+        # "dalle 22" senza una fine leggibile: l'orario è incompleto, meglio far decidere l'LLM
+        incomplete = end_time is None and RANGE_START_PATTERN.match(time_match.group(0))
+        confidence += 0.1 if incomplete else 0.3
+        remaining_text = remaining_text.replace(time_match.group(0), "", 1)
 
     # --- 4. Extract Price ---
-    # Regex for prices like "€10", "10€", "10 euro", or "ingresso libero"
-    price_pattern = re.compile(r'(\d+[\.,]?\d*\s*€|€\s*\d+[\.,]?\d*|\d+\s*euro|ingresso\s*libero|gratuito)',
-                               re.IGNORECASE)
-    found_price = price_pattern.search(text)
-    if found_price:
-        event_info.price = found_price.group(1).strip()
-        remaining_text = remaining_text.replace(found_price.group(1), "", 1)
+    price = None
+    if price_match := PRICE_PATTERN.search(remaining_text):
+        confidence += 0.1
+        price = _parse_price(price_match)
+        remaining_text = remaining_text.replace(price_match.group(0), "", 1)
 
     # --- 5. Consolidate Description ---
-    # Clean up the remaining text to create the description.
-    description_lines = [line.strip() for line in remaining_text.strip().split('\n') if line.strip()]
-    event_info.description = " ".join(description_lines)
+    # Il testo originale senza la riga del titolo: togliere le parti riconosciute lascerebbe frasi spezzate
+    title_index = next((i for i, line in enumerate(lines) if line.strip() == name), None)
+    description = " ".join(line.strip() for i, line in enumerate(lines) if i != title_index)
 
-    return event_info
+    event = Event(name=name, start_time=start_time, end_time=end_time, price=price, description=description)
+    return RuleResult(True, round(confidence, 2), event)
 
 
-# --- Example Usage ---
-sample_text_1 = """
+if __name__ == '__main__':
+    import json
+
+    # --- Example Usage ---
+    sample_text_1 = """
 🗓Venerdì 6 Giugno PRO LOCO MONTECCHIA presenta: 🌟ＡＦＲＯ ＶＩＢＥＳ ＳＵＭＭＥＲ ＴＯＵＲ ２０２５🌟 Unisciti a noi per una serata magica,dove il ritmo incontrerà la bellezza del cielo stellato! 📍Luogo: Piazza Umberto I,37030 Montecchia di Crosara (Vr) 🍝🍔 Ricco stand gastronomico DALLE 22.00 🎧DJ Morgan 🎙Andrea Meggio Preparatevi a ballare, a divertirvi e vivere una notte indimenticabile sotto le stelle. Non mancate!🌟❤️
 """
 
-# Another example with a price and end time
-sample_text_2 = """
+    # Another example with a price and end time
+    sample_text_2 = """
 Charity Concert
 Saturday 13 September, don't miss the chance to help!
 From 21:00 - 23:30 at the Municipal Theater.
 Admission: 15€, proceeds will go to charity.
 """
 
-# Extract information
-event_data_1 = Event.Schema().dump(extract_event_info(sample_text_1))
-event_data_2 = Event.Schema().dump(extract_event_info(sample_text_2))
-
-# Print results in a readable JSON format
-import json
-
-print("--- Results for Sample Text 1 ---")
-print(json.dumps(event_data_1, indent=4, ensure_ascii=False))
+    sample_text_3 = "Che bella giornata al lago con gli amici 😎"
 
-print("\n--- Results for Sample Text 2 ---")
-print(json.dumps(event_data_2, indent=4, ensure_ascii=False))
\ No newline at end of file
+    for i, sample in enumerate([sample_text_1, sample_text_2, sample_text_3], start=1):
+        result = classify_post(sample)
+        print(f"--- Results for Sample Text {i} (candidate: {result.is_candidate}, confidence: {result.confidence}) ---")
+        print(json.dumps(result.event.dump() if result.event else None, indent=4, ensure_ascii=False))
@@ -1,19 +1,53 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextvars
 import inspect
 import json
+import random
 from abc import ABC
 from asyncio import AbstractEventLoop
 from functools import partial
 from typing import Any, Callable, List, Optional, Tuple, Type, Union
 from tornado.escape import json_decode, json_encode
 from tornado.web import RequestHandler
+
+from api.quota import INTERACTIVE, set_priority
+from handlers.response_cache import RenderedResponse
+from metrics import HTTP_SECONDS, TRACE_SAMPLE_RATE, Trace, start_trace
 import logging
 logger = logging.getLogger(inspect.currentframe().f_back.f_globals["__name__"])
 
 
 class BaseHandler(RequestHandler, ABC):
+    trace: Optional[Trace] = None
+
+    def prepare(self):
+        # Le richieste in corso vengono contate per chiudere il worker senza interromperle
+        if state := self.settings.get("state"):
+            state.in_flight += 1
+        # Le chiamate alle API fatte per servire un utente hanno la precedenza su quelle dei crawl
+        set_priority(INTERACTIVE)
+        if self.request.headers.get("X-Trace") == "1" or random.random() < TRACE_SAMPLE_RATE:
+            self.trace = start_trace()
+
+    def finish(self, chunk=None):
+        if self.trace is not None and not self._finished:
+            timing = f"total;dur={self.request.request_time() * 1000:.1f}"
+            if spans := self.trace.server_timing():
+                timing += ", " + spans
+            self.set_header("Server-Timing", timing)
+        return super().finish(chunk)
+
+    def on_finish(self):
+        if state := self.settings.get("state"):
+            state.in_flight -= 1
+        HTTP_SECONDS.observe(self.request.request_time(), handler=type(self).__name__, method=self.request.method,
+                             status=self.get_status())
+        if self.trace is not None:
+            logger.info(f"Traccia di {self.request.method} {self.request.uri}: "
+                        + ", ".join(f"{s.name} +{s.start_s * 1000:.1f}ms {s.duration_s * 1000:.1f}ms"
+                                    for s in self.trace.spans))
 
     def write(self, chunk: Union[str, bytes, dict]) -> None:
         if isinstance(chunk, dict):
@@ -23,13 +57,27 @@ class BaseHandler(RequestHandler, ABC):
 
     def success(self, msg):
         logger.debug(msg)
+        # write() chiude già la risposta
         self.write({"status": "ok", "msg": msg})
-        self.finish()
 
     def error(self, msg):
         logger.error(msg)
         self.write({"status": "ko", "msg": msg})
-        self.finish()
+
+    def write_rendered(self, rendered: RenderedResponse) -> None:
+        """ invia una risposta già renderizzata: 304 se il client ha già questo ETag, gzip se accettato """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Vary", "Accept-Encoding")
+        use_gzip = rendered.gzipped is not None and "gzip" in self.request.headers.get("Accept-Encoding", "")
+        # Ogni codifica è una rappresentazione diversa e ha il suo ETag
+        self.set_header("Etag", rendered.etag[:-1] + '-gzip"' if use_gzip else rendered.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        if use_gzip:
+            self.set_header("Content-Encoding", "gzip")
+        self.write(rendered.gzipped if use_gzip else rendered.body)
 
     def get_body_attribute(self, name: str, default: Optional[Any] = None) -> Optional[Any]:
         body_obj = json_decode(self.request.body)
@@ -42,5 +90,6 @@ class BaseHandler(RequestHandler, ABC):
     async def async_query(self, dao: Callable, *args, **kwargs):
         self.require_setting("loop", "Async query requires a loop to be defined in settings")
         loop: AbstractEventLoop = self.settings.get("loop")
-        return await loop.run_in_executor(None, partial(dao, *args, **kwargs))
+        # Il contesto viene copiato perché le operazioni finiscano nella traccia della richiesta
+        return await loop.run_in_executor(None, contextvars.copy_context().run, partial(dao, *args, **kwargs))
 
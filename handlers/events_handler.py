@@ -0,0 +1,68 @@
+import base64
+import inspect
+import json
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from db.locals_dao import LocalsDAO
+from handlers.base_handler import BaseHandler
+import logging
+logger = logging.getLogger(inspect.currentframe().f_back.f_globals["__name__"])
+
+DEFAULT_WINDOW = timedelta(hours=24)
+MAX_WINDOW = timedelta(days=31)
+# Oltre questo raggio le celle da leggere diventano troppe per una sola query
+MAX_RADIUS_KM = 20.0
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def encode_cursor(key: Tuple[float, str, int]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str, int]:
+    start_ts, place_id, seq = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(start_ts), str(place_id), int(seq)
+
+
+class EventsHandler(BaseHandler):
+    """
+    GET /api/events?lat=&lon=&radius=2&from=<ISO>&to=<ISO>&max_price=&limit=50&cursor=
+
+    Eventi che iniziano nella finestra [from, to) (di default le prossime 24 ore) entro il
+    raggio in km, in ordine di inizio. `next_cursor` nella risposta porta alla pagina successiva.
+    """
+    locals_dao: LocalsDAO
+
+    def initialize(self, locals_dao: LocalsDAO) -> None:
+        self.locals_dao = locals_dao
+
+    def _datetime_argument(self, name: str, default: datetime) -> datetime:
+        value = self.get_query_argument(name, default=None)
+        return datetime.fromisoformat(value) if value else default
+
+    def _float_argument(self, name: str, default: Optional[float] = None) -> Optional[float]:
+        value = self.get_query_argument(name, default=None)
+        return float(value) if value else default
+
+    async def get(self):
+        try:
+            lat = float(self.get_query_argument("lat"))
+            lon = float(self.get_query_argument("lon"))
+            radius = min(self._float_argument("radius", 2.0), MAX_RADIUS_KM)
+            start_from = self._datetime_argument("from", datetime.now())
+            start_to = min(self._datetime_argument("to", start_from + DEFAULT_WINDOW), start_from + MAX_WINDOW)
+            max_price = self._float_argument("max_price")
+            limit = max(1, min(int(self.get_query_argument("limit", default=str(DEFAULT_LIMIT))), MAX_LIMIT))
+            cursor = self.get_query_argument("cursor", default=None)
+            after = decode_cursor(cursor) if cursor else None
+        except (ValueError, TypeError) as e:
+            self.set_status(400)
+            self.error(f"Parametri non validi: {e}")
+            return
+        place_type = self.get_query_argument("type", default="bar")
+        logger.info(f"Eventi richiesti per lat: {lat}, lon: {lon}, radius: {radius}, dal {start_from} al {start_to}")
+        events, next_key = await self.async_query(self.locals_dao.find_events, place_type, lat, lon, radius,
+                                                  start_from, start_to, max_price, limit, after)
+        self.write({"events": events, "next_cursor": encode_cursor(next_key) if next_key else None})
@@ -1,25 +1,65 @@
 import inspect
 import json
+import os
+from typing import Optional
+
+import requests
 
 from api.google_maps_api_interface import GoogleMapsApiInterface
+from api.quota import QuotaExceeded
+from db.locals_dao import LocalsDAO
 from handlers.base_handler import BaseHandler
+from handlers.response_cache import places_responses
 import logging
 logger = logging.getLogger(inspect.currentframe().f_back.f_globals["__name__"])
 
+PLACE_TYPE = "bar"
+# Le coordinate vengono arrotondate (3 decimali ≈ 100 m) così che utenti vicini condividano la risposta in cache
+COORD_DECIMALS = int(os.getenv('RESPONSE_CACHE_COORD_DECIMALS', '3'))
+
 
 class PLacesAroundHandler(BaseHandler):
     google_maps_api: GoogleMapsApiInterface
+    locals_dao: LocalsDAO
 
-    def initialize(self) -> None:
-        self.google_maps_api = GoogleMapsApiInterface()
+    def initialize(self, locals_dao: LocalsDAO, google_maps_api: Optional[GoogleMapsApiInterface] = None) -> None:
+        self.google_maps_api = google_maps_api or GoogleMapsApiInterface()
+        self.locals_dao = locals_dao
 
     async def get(self):
 
-        lat = self.get_query_argument("lat", default="0.0")
-        lon = self.get_query_argument("lon", default="0.0")
-        radius = self.get_query_argument("radius", default="1")  # in km
+        lat = round(float(self.get_query_argument("lat", default="0.0")), COORD_DECIMALS)
+        lon = round(float(self.get_query_argument("lon", default="0.0")), COORD_DECIMALS)
+        radius = round(float(self.get_query_argument("radius", default="1")), 1)  # in km
         logger.info(f"Ricevuta richiesta per lat: {lat}, lon: {lon} and radius: {radius}")
-        if response := self.google_maps_api.find_bars(latitude=lat, longitude=lon, radius=float(radius)):
-            self.write(dict(places=[place.dump() for place in response]))
+        key = (PLACE_TYPE, lat, lon, radius)
+        # Solo le scritture nelle celle dell'area invalidano la risposta, non quelle di tutto il database
+        version = await self.async_query(self.locals_dao.area_version, PLACE_TYPE, lat, lon, radius)
+        if rendered := places_responses.get(key, version):
+            self.write_rendered(rendered)
+            return
+        if await self.async_query(self.locals_dao.is_area_fresh, PLACE_TYPE, lat, lon, radius):
+            # L'area è già stata cercata di recente: rispondiamo dall'indice locale senza chiamare Google
+            places = await self.async_query(self.locals_dao.find_places_within, PLACE_TYPE, lat, lon, radius)
+        else:
+            try:
+                # Le chiamate a Google non bloccano l'IOLoop: le altre richieste vengono servite nel frattempo
+                places, report = await self.google_maps_api.sweep_area_async(PLACE_TYPE, lat, lon, radius)
+            except (QuotaExceeded, requests.exceptions.RequestException) as e:
+                # Budget esaurito o Google in errore: meglio i locali già salvati (anche se vecchi) che nessuna
+                # risposta. L'area non viene registrata come coperta, la prossima richiesta riprova
+                logger.warning(f"Ricerca su Google non riuscita ({e}): rispondo con i dati locali")
+                places = await self.async_query(self.locals_dao.find_places_within, PLACE_TYPE, lat, lon, radius)
+            else:
+                places = await self.async_query(self.locals_dao.get_places_details, PLACE_TYPE, places)
+                await self.async_query(self.locals_dao.dump_db, PLACE_TYPE, places)
+                # Se lo sweep ha coperto tutta l'area, le prossime richieste possono essere servite in locale
+                if report.complete:
+                    await self.async_query(self.locals_dao.record_coverage, PLACE_TYPE, lat, lon, radius)
+        if response := self.google_maps_api.filter_nightlife(places):
+            # La versione è quella dopo il salvataggio: la risposta resta valida finché i dati dell'area non cambiano
+            version = await self.async_query(self.locals_dao.area_version, PLACE_TYPE, lat, lon, radius)
+            rendered = places_responses.put(key, dict(places=[place.dump_public() for place in response.values()]), version)
+            self.write_rendered(rendered)
             return
         self.error("No places found")
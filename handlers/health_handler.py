@@ -0,0 +1,25 @@
+from tornado.web import RequestHandler
+
+
+class ServerState:
+    """ stato del worker: pronto dopo l'avvio, in chiusura (draining) dopo un SIGTERM """
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+
+
+class ReadinessHandler(RequestHandler):
+    state: ServerState
+
+    def initialize(self, state: ServerState) -> None:
+        self.state = state
+
+    def get(self):
+        # 503 durante l'avvio e la chiusura: il bilanciatore smette di mandare richieste a questo worker
+        if self.state.ready and not self.state.draining:
+            self.write({"status": "ok"})
+        else:
+            self.set_status(503)
+            self.write({"status": "draining" if self.state.draining else "starting"})
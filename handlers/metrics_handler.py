@@ -0,0 +1,38 @@
+import json
+import os
+
+from tornado.web import RequestHandler
+
+from db.shared_cache import get_shared_cache
+from metrics import merge_families, registry
+
+# Ogni quanto un worker pubblica le sue metriche nella cache condivisa, e per quanto restano valide:
+# le metriche di un worker fermo spariscono dallo scrape dopo METRICS_PUBLISH_TTL_S
+METRICS_PUBLISH_INTERVAL_S = float(os.getenv('METRICS_PUBLISH_INTERVAL_S', '5'))
+METRICS_PUBLISH_TTL_S = float(os.getenv('METRICS_PUBLISH_TTL_S', '30'))
+
+
+def publish_worker_metrics():
+    """ salva nella cache condivisa le metriche di questo processo, con l'etichetta `worker` """
+    if (cache := get_shared_cache()) is None:
+        return
+    families = registry.families({"worker": str(os.getpid())}, shared=False)
+    cache.put("metrics", str(os.getpid()), json.dumps(families).encode(), METRICS_PUBLISH_TTL_S)
+
+
+class MetricsHandler(RequestHandler):
+    """
+    metriche in formato Prometheus. Con la cache condivisa (server multi-processo) lo scrape
+    restituisce le metriche di tutti i worker, ognuna con l'etichetta `worker` (il pid):
+    i contatori di un worker non si mescolano a quelli degli altri e `rate()` resta corretto
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        if (cache := get_shared_cache()) is None:
+            self.finish(registry.render())
+            return
+        # Le metriche di questo worker sono sempre aggiornate, quelle degli altri al più di un intervallo fa
+        publish_worker_metrics()
+        workers = [json.loads(value) for value in cache.values("metrics")]
+        self.finish(merge_families([registry.families(shared=True), *workers]))
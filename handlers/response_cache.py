@@ -0,0 +1,94 @@
+"""
+Cache delle risposte JSON già renderizzate.
+
+Ogni risposta viene serializzata una sola volta in byte, compressa con gzip e marcata
+con un ETag forte (hash del corpo): le richieste successive con la stessa query
+normalizzata non toccano né il database né marshmallow, e i client che rimandano
+l'ETag ricevono `304 Not Modified`.
+Una risposta è valida finché non scade il TTL e finché la versione dei dati da cui
+è stata generata (es. `LocalsDAO.area_version`, che cambia solo con le scritture
+nelle celle dell'area richiesta) non cambia.
+Con una `SharedCache` il corpo renderizzato viene condiviso con gli altri processi.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional
+
+from db.shared_cache import SharedCache, get_shared_cache
+from metrics import registry
+
+GZIP_MIN_BYTES = 512
+
+
+class RenderedResponse(NamedTuple):
+    body: bytes
+    gzipped: Optional[bytes]  # None se il corpo è troppo piccolo per valere la compressione
+    etag: str
+    version: int
+    expires_at: float
+
+
+def render_json(obj: Any, version: int = 0, ttl_s: float = 0.0) -> RenderedResponse:
+    return render_bytes(json.dumps(obj, separators=(",", ":")).encode(), version, ttl_s)
+
+
+def render_bytes(body: bytes, version: int = 0, ttl_s: float = 0.0) -> RenderedResponse:
+    gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return RenderedResponse(body, gzipped, etag, version, time.monotonic() + ttl_s)
+
+
+class ResponseCache:
+
+    def __init__(self, ttl_s: float = 60.0, max_entries: int = 1024, shared: Optional[SharedCache] = None):
+        self.ttl_s = ttl_s
+        self.shared = shared
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, RenderedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "shared_hits": 0}
+
+    def get(self, key: Hashable, version: int) -> Optional[RenderedResponse]:
+        """ la risposta in cache, None se assente, scaduta o generata da una versione precedente dei dati """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at >= time.monotonic() and entry.version == version:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self._entries.pop(key, None)
+        # La versione fa parte della chiave condivisa: i corpi generati da dati vecchi non vengono mai letti
+        if self.shared is not None and (body := self.shared.get("responses", f"{key!r}@{version}")) is not None:
+            with self._lock:
+                self.stats["shared_hits"] += 1
+            return self._store(key, render_bytes(body, version, self.ttl_s))
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key: Hashable, obj: Any, version: int) -> RenderedResponse:
+        """ renderizza `obj` e lo salva in cache """
+        rendered = render_json(obj, version, self.ttl_s)
+        if self.shared is not None:
+            self.shared.put("responses", f"{key!r}@{version}", rendered.body, self.ttl_s)
+        return self._store(key, rendered)
+
+    def _store(self, key: Hashable, rendered: RenderedResponse) -> RenderedResponse:
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+
+places_responses = ResponseCache(ttl_s=float(os.getenv('RESPONSE_CACHE_TTL_S', '60')),
+                                 max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024')),
+                                 shared=get_shared_cache())
+registry.register_callback("safemo_response_cache_events_total", "Eventi della cache delle risposte renderizzate.",
+                           "counter", ("event",), lambda: [((event,), n) for event, n in places_responses.stats.items()])
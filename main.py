@@ -1,36 +1,226 @@
-from typing import Dict
+import contextlib
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from api.apify_api_interface import ApifyApiInterface
+from api.apify_api_interface import POSTS_CHUNK_SIZE, ApifyApiInterface, instagram_username
 from api.google_maps_api_interface import GoogleMapsApiInterface
 from api.gemini_api_interface import GeminiApiInterface
+from api.instagram_resolver import InstagramResolver
 from db.locals_dao import LocalsDAO
-from db.models import Place
+from db.models import Event, Place
+from db.profile_cache import get_profile_cache
+from metrics import install_profiler_signal, write_textfile
+from pipeline import PipelineStage, StreamingPipeline
+
+
+@dataclass
+class FreshnessPolicy:
+    """Quando un'area o i post di un locale vanno considerati da aggiornare."""
+    area_max_age_s: float = 24 * 3600
+    posts_max_age_s: float = 3 * 24 * 3600
+    # I locali con eventi imminenti vengono aggiornati più spesso e per primi
+    upcoming_window_s: float = 3 * 24 * 3600
+    upcoming_posts_max_age_s: float = 6 * 3600
+    max_places: Optional[int] = None  # numero massimo di locali aggiornati per esecuzione
+
+
+def _event_start(event) -> Optional[datetime]:
+    start_time = event.start_time if isinstance(event, Event) else event.get("start_time")
+    if isinstance(start_time, str):
+        start_time = datetime.fromisoformat(start_time)
+    return start_time
+
+
+def _parse_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(timestamp) if timestamp else None
 
 
 class PlacesDataCollector:
-    def __init__(self):
-        self.google_maps = GoogleMapsApiInterface()
-        self.gemini = GeminiApiInterface()
-        self.apify = ApifyApiInterface()
-        self.locals_dao = LocalsDAO()
+    def __init__(self, google_maps: Optional[GoogleMapsApiInterface] = None, gemini: Optional[GeminiApiInterface] = None,
+                 apify: Optional[ApifyApiInterface] = None, locals_dao: Optional[LocalsDAO] = None,
+                 instagram_resolver: Optional[InstagramResolver] = None):
+        self.google_maps = google_maps or GoogleMapsApiInterface()
+        self.gemini = gemini or GeminiApiInterface()
+        self.apify = apify or ApifyApiInterface()
+        self.locals_dao = locals_dao or LocalsDAO()
+        self.instagram_resolver = instagram_resolver or InstagramResolver()
 
     def collect_places_nearby(self, place_type, latitude, longitude, radius) -> Dict[str, Place]:
-        if place_type == "bar":
-            g_places = self.google_maps.find_places_nightlife(place_type=place_type, latitude=latitude, longitude=longitude, radius_km=radius)
+        return {place.id: place for place in self.stream_places_nearby(place_type, latitude, longitude, radius)}
+
+    def refresh_places_nearby(self, place_type, latitude, longitude, radius,
+                              policy: FreshnessPolicy = FreshnessPolicy()) -> Dict[str, Place]:
+        """
+        Aggiornamento incrementale: l'area viene cercata su Google solo se non è aggiornata,
+        i post vengono scaricati solo per i locali scaduti secondo `policy` (prima quelli con
+        eventi imminenti) e solo se più recenti dell'ultimo post già visto.
+        """
+        if self.locals_dao.is_area_fresh(place_type, latitude, longitude, radius, policy.area_max_age_s):
+            print("♻️  Area già aggiornata: uso i locali salvati.")
+            db_places = self.locals_dao.find_places_within(place_type, latitude, longitude, radius)
+            if place_type == "bar":
+                db_places = self.google_maps.filter_nightlife_venues(db_places)
         else:
-            g_places = self.google_maps.find_places(place_type=place_type, latitude=latitude, longitude=longitude, radius_km=radius)
-        db_places = self.locals_dao.get_places_details(place_type=place_type, new_places=g_places)
-        for place in db_places.values():
-            if not place.instagram_URL:
-                if url := self.apify.get_profile_from_place(place):
-                    place.instagram_URL = url.get("url")
-        self.locals_dao.dump_db(place_type, db_places)
+            db_places = self._search_area(place_type, latitude, longitude, radius)
+            self._resolve_profiles(db_places)
+            self.locals_dao.dump_db(place_type, db_places)
 
-        posts = self.apify.get_posts_from_places(db_places)
-        events = self.gemini.get_events_from_posts(posts)
-        self.locals_dao.dump_db(place_type, db_places)
+        states = self.locals_dao.get_refresh_state(place_type, db_places.keys())
+        due = self._places_due(list(db_places.values()), states, policy)
+        print(f"🔄 {len(due)} locali su {len(db_places)} da aggiornare.")
+        if due:
+            self._collect_events(place_type, due, states)
+            self.locals_dao.dump_db(place_type, {place.id: place for place in due})
         return db_places
 
+    def stream_places_nearby(self, place_type, latitude, longitude, radius, profile_workers: int = 4,
+                             post_workers: int = 2, extraction_workers: int = 2,
+                             posts_linger_s: float = 2.0) -> Iterator[Place]:
+        """
+        Raccoglie i locali dell'area: ogni locale attraversa gli stadi (profilo, post, eventi,
+        salvataggio) collegati da code limitate, senza aspettare gli altri. I locali vengono
+        raccolti in gruppi (fino a POSTS_CHUNK_SIZE): i profili di un gruppo vengono cercati
+        insieme, con le run dell'Actor avviate tutte subito, e i post con una sola run.
+        I primi locali con i loro eventi sono disponibili subito e la memoria resta limitata
+        anche su aree grandi.
+        """
+        db_places = self._search_area(place_type, latitude, longitude, radius)
+        states = self.locals_dao.get_refresh_state(place_type, db_places.keys())
+
+        def resolve_profiles(places: List[Place]):
+            self._resolve_profiles({place.id: place for place in places}, report=False)
+            return places
+
+        def fetch_posts(places: List[Place]):
+            return places, *self._fetch_new_posts(places, states)
+
+        def extract_events(item):
+            places, new_posts, post_places, newest = item
+            self._extract_events(new_posts, post_places)
+            return places, newest
+
+        def persist(item):
+            places, newest = item
+            self.locals_dao.dump_db(place_type, {place.id: place for place in places})
+            self._save_refresh_state(place_type, newest)
+            return places
+
+        # Se uno stadio fallisce i locali proseguono senza quel dato e vengono comunque salvati;
+        # senza `newest` lo stato di aggiornamento non cambia e i post verranno riscaricati
+        pipeline = StreamingPipeline([PipelineStage("profili", resolve_profiles, profile_workers,
+                                                    batch_size=POSTS_CHUNK_SIZE, linger_s=posts_linger_s,
+                                                    on_error=lambda places, e: places),
+                                      PipelineStage("post", fetch_posts, post_workers,
+                                                    on_error=lambda places, e: (places, [], {}, {})),
+                                      PipelineStage("eventi", extract_events, extraction_workers,
+                                                    on_error=lambda item, e: (item[0], {})),
+                                      # Un solo scrittore sul database
+                                      PipelineStage("salvataggio", persist, 1)])
+        # Se chi consuma smette di leggere, la chiusura del generatore ferma anche gli stadi
+        with contextlib.closing(pipeline.run(db_places.values())) as results:
+            for places in results:
+                yield from places
+
+    @staticmethod
+    def _places_due(places: List[Place], states: Dict[str, Tuple[float, Optional[str]]],
+                    policy: FreshnessPolicy) -> List[Place]:
+        """ locali con profilo i cui post sono scaduti, ordinati per priorità """
+        now = datetime.now()
+        priorities = []
+        for place in places:
+            if not place.instagram_URL:
+                continue
+            fetched_at = states.get(place.id, (None, None))[0]
+            upcoming = [start for event in place.events if (start := _event_start(event))
+                        and now <= start <= now + timedelta(seconds=policy.upcoming_window_s)]
+            max_age_s = policy.upcoming_posts_max_age_s if upcoming else policy.posts_max_age_s
+            if fetched_at is None or time.time() - fetched_at > max_age_s:
+                # Prima i locali con l'evento più vicino, poi quelli aggiornati meno di recente
+                priorities.append(((0, min(upcoming).timestamp()) if upcoming else (1, fetched_at or 0), place))
+        priorities.sort(key=lambda item: item[0])
+        due = [place for _, place in priorities]
+        return due[:policy.max_places] if policy.max_places is not None else due
+
+    def _search_area(self, place_type, latitude, longitude, radius) -> Dict[str, Place]:
+        # Lo sweep copre tutta l'area anche oltre i 20 risultati di una singola ricerca
+        g_places, report = self.google_maps.sweep_area(place_type=place_type, latitude=latitude, longitude=longitude, radius_km=radius)
+        if report.complete:
+            self.locals_dao.record_coverage(place_type, latitude, longitude, radius)
+        if place_type == "bar":
+            g_places = self.google_maps.filter_nightlife_venues(g_places)
+        return self.locals_dao.get_places_details(place_type=place_type, new_places=g_places)
+
+    def _resolve_profiles(self, db_places: Dict[str, Place], report: bool = True):
+        # I profili mancanti vengono cercati tutti insieme, in parallelo, dalla sorgente più economica
+        missing = [place for place in db_places.values() if not place.instagram_URL]
+        urls = self.instagram_resolver.resolve_many(missing) if missing else {}
+        for place in missing:
+            if url := urls.get(place.id):
+                place.instagram_URL = url
+        if report:
+            print(f"📇 Cache dei profili: {get_profile_cache().report()}")
+            print(f"📊 Sorgenti dei profili: {self.instagram_resolver.report()}")
+
+    def _collect_events(self, place_type: str, places: List[Place], states: Dict[str, Tuple[float, Optional[str]]]):
+        """
+        Scarica i post dei locali più recenti dell'ultimo post già visto, ne estrae gli eventi,
+        li aggiunge a `place.events` e aggiorna lo stato di aggiornamento di ogni locale.
+        """
+        new_posts, post_places, newest = self._fetch_new_posts(places, states)
+        self._extract_events(new_posts, post_places)
+        self._save_refresh_state(place_type, newest)
+
+    def _fetch_new_posts(self, places: List[Place], states: Dict[str, Tuple[float, Optional[str]]]
+                         ) -> Tuple[List[dict], Dict[str, Place], Dict[str, Optional[datetime]]]:
+        """
+        Scarica i post dei locali con profilo più recenti dell'ultimo post già visto.
+        Ritorna i post nuovi, il locale di ogni post e il post più recente di ogni locale.
+        """
+        places = [place for place in places if instagram_username(place.instagram_URL)]
+        if not places:
+            return [], {}, {}
+        markers = {place.id: _parse_timestamp(states.get(place.id, (None, None))[1]) for place in places}
+        # Si scaricano i post più recenti del marker più vecchio, poi si filtra per locale
+        newer_than = None if None in markers.values() else min(markers.values()).date().isoformat()
+        posts = self.apify.get_posts_from_places(places, newer_than)
+
+        new_posts, post_places = [], {}
+        newest = dict(markers)
+        places_by_id = {place.id: place for place in places}
+        count = 0
+        for post in posts:
+            count += 1
+            place = places_by_id[post["place_id"]]
+            timestamp = _parse_timestamp(post.get("timestamp"))
+            if timestamp is None:
+                continue
+            timestamp = timestamp.replace(tzinfo=None)
+            if markers[place.id] and timestamp <= markers[place.id]:
+                continue
+            newest[place.id] = max(filter(None, [newest[place.id], timestamp]))
+            post_id = str(post.get("id") or post.get("url"))
+            if post_id in post_places:
+                # Più locali con lo stesso profilo: ognuno riceve la sua copia del post
+                post_id = f"{post_id}@{place.id}"
+            new_posts.append({"id": post_id, "text": post.get("caption") or post.get("text")})
+            post_places[post_id] = place
+        print(f"📸 {len(new_posts)} post nuovi su {count} scaricati.")
+        return new_posts, post_places, newest
+
+    def _extract_events(self, new_posts: List[dict], post_places: Dict[str, Place]):
+        """ estrae gli eventi dai post e li aggiunge al locale di ogni post """
+        for post_id, event in self.gemini.extract_events_by_post(new_posts).items():
+            if event and not any(e == event for e in post_places[post_id].events):
+                post_places[post_id].events.append(event)
+
+    def _save_refresh_state(self, place_type: str, newest: Dict[str, Optional[datetime]]):
+        fetched_at = time.time()
+        self.locals_dao.set_refresh_state(place_type, {
+            place_id: (fetched_at, newest_post.isoformat() if newest_post else None)
+            for place_id, newest_post in newest.items()})
+
 
 # --- ESEMPIO DI UTILIZZO ---
 if __name__ == '__main__':
@@ -39,6 +229,11 @@ if __name__ == '__main__':
     LONGITUDE = 11.260698962274315
     RADIUS_KM = 2
 
+    install_profiler_signal()
     c = PlacesDataCollector()
-    results = c.collect_places_nearby("bar", LATITUDE, LONGITUDE, RADIUS_KM)
-    print(results)
+    try:
+        for place in c.stream_places_nearby("bar", LATITUDE, LONGITUDE, RADIUS_KM):
+            print(f"📍 {place.name}: {len(place.events)} eventi")
+    finally:
+        # Con METRICS_TEXTFILE_PATH le durate della raccolta restano disponibili dopo la fine del processo
+        write_textfile()
@@ -0,0 +1,391 @@
+"""
+Metriche, tracce e profiler per vedere dove va il tempo, senza dipendenze esterne.
+
+- Contatori e istogrammi con etichette, esposti in formato Prometheus (`registry.render()`,
+  route `/metrics` del server). Con più worker ogni processo pubblica le sue metriche con
+  l'etichetta `worker` e uno scrape qualsiasi le restituisce tutte (`merge_families`).
+- `timed(...)` misura un blocco (durata, errori) e, se la richiesta corrente è tracciata,
+  registra anche uno span; le tracce arrivano al client nell'header `Server-Timing`.
+- `SamplingProfiler` campiona gli stack di tutti i thread; `install_profiler_signal()` lo
+  accende e lo spegne a runtime con un segnale (SIGUSR1), scrivendo gli stack in formato
+  "collapsed" pronto per un flame graph.
+"""
+import contextvars
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter as _StackCounter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# Percentuale (0-1) di richieste HTTP tracciate; una richiesta con l'header `X-Trace: 1` lo è sempre
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+PROFILER_INTERVAL_S = float(os.getenv('PROFILER_INTERVAL_S', '0.01'))
+PROFILER_OUTPUT_DIR = os.getenv('PROFILER_OUTPUT_DIR', tempfile.gettempdir())
+# Se impostato, `write_textfile()` salva qui le metriche (es. per il textfile collector di node_exporter)
+METRICS_TEXTFILE_PATH = os.getenv('METRICS_TEXTFILE_PATH')
+
+# In secondi: dalle chiamate al database (ms) alle run degli Actor (minuti)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+# Etichette aggiunte a tutti i campioni di una metrica (es. `worker`): nomi e valori
+ConstLabels = Tuple[Tuple[str, ...], Tuple[str, ...]]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self, const: ConstLabels = ((), ())) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        names = const[0] + self.labelnames
+        lines += [f"{self.name}{_format_labels(names, const[1] + key)} {_format_value(value)}" for key, value in values]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per ogni combinazione di etichette: conteggi per bucket (non cumulativi), somma, conteggio
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if (entry := self._values.get(key)) is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = entry
+            counts[next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))] += 1
+            total[0] += value
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self, const: ConstLabels = ((), ())) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(counts), total[0]) for key, (counts, total) in self._values.items())
+        names = const[0] + self.labelnames
+        for key, counts, total in values:
+            key = const[1] + key
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(names + ('le',), (*key, le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(names, key)} {cumulative}")
+        return lines
+
+
+class _Callback(NamedTuple):
+    """ metrica letta al momento dello scrape (es. le statistiche già tenute dalle cache) """
+    name: str
+    documentation: str
+    kind: str
+    labelnames: Tuple[str, ...]
+    fn: Callable[[], Iterable[Tuple[LabelValues, float]]]
+    shared: bool = False  # True: il valore è già comune a tutti i processi (es. letto dal database)
+
+    def render(self, const: ConstLabels = ((), ())) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.fn():
+            lines.append(f"{self.name}{_format_labels(const[0] + self.labelnames, const[1] + tuple(key))} "
+                         f"{_format_value(value)}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_callback(self, name: str, documentation: str, kind: str, labelnames: Sequence[str],
+                          fn: Callable[[], Iterable[Tuple[LabelValues, float]]], shared: bool = False):
+        """
+        `kind` è "counter" o "gauge"; `fn` ritorna coppie (valori delle etichette, valore).
+        `shared`: il valore è lo stesso in tutti i processi e con più worker va esposto una volta sola
+        """
+        with self._lock:
+            self._metrics[name] = _Callback(name, documentation, kind, tuple(labelnames), fn, shared)
+
+    def families(self, labels: Optional[Dict[str, str]] = None, shared: Optional[bool] = None) -> Dict[str, List[str]]:
+        """
+        righe (HELP, TYPE e campioni) di ogni metrica, per nome; `labels` viene aggiunto a ogni campione.
+        Con `shared` solo le metriche comuni a tutti i processi (True) o solo quelle del processo (False)
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        const = (tuple(labels or {}), tuple(str(value) for value in (labels or {}).values()))
+        families = {}
+        for metric in metrics:
+            if shared is not None and getattr(metric, "shared", False) != shared:
+                continue
+            try:
+                families[metric.name] = metric.render(const)
+            except Exception as e:
+                # Una metrica rotta non deve far fallire tutto lo scrape
+                print(f"⚠️  Metrica '{metric.name}' non disponibile: {e}")
+        return families
+
+    def render(self, labels: Optional[Dict[str, str]] = None) -> str:
+        return merge_families([self.families(labels)])
+
+
+def merge_families(sources: Iterable[Dict[str, List[str]]]) -> str:
+    """
+    unisce le metriche di più processi in un solo testo Prometheus: HELP e TYPE una volta sola
+    e i campioni di ogni metrica uno dopo l'altro, come richiede il formato
+    """
+    merged: Dict[str, List[str]] = {}
+    for families in sources:
+        for name, lines in families.items():
+            if name in merged:
+                merged[name] += lines[2:]
+            else:
+                merged[name] = list(lines)
+    return "".join(line + "\n" for lines in merged.values() for line in lines)
+
+
+registry = Registry()
+
+UPSTREAM_SECONDS = registry.histogram("safemo_upstream_request_seconds",
+                                      "Durata delle chiamate ai servizi esterni.", ("service", "operation"))
+UPSTREAM_ERRORS = registry.counter("safemo_upstream_errors_total",
+                                   "Chiamate ai servizi esterni fallite.", ("service", "operation"))
+DB_SECONDS = registry.histogram("safemo_db_operation_seconds", "Durata delle operazioni sul database.",
+                                ("operation",))
+DB_ERRORS = registry.counter("safemo_db_errors_total", "Operazioni sul database fallite.", ("operation",))
+HTTP_SECONDS = registry.histogram("safemo_http_request_seconds", "Durata delle richieste HTTP servite.",
+                                  ("handler", "method", "status"))
+PIPELINE_STAGE_SECONDS = registry.histogram("safemo_pipeline_stage_seconds",
+                                            "Durata di ogni elemento negli stadi della pipeline di raccolta.",
+                                            ("stage",))
+EVENT_EXTRACTION_POSTS = registry.counter("safemo_event_extraction_posts_total",
+                                          "Post esaminati dall'estrazione degli eventi, per esito "
+                                          "(skipped, cache, rules, model).", ("outcome",))
+PIPELINE_STAGE_ERRORS = registry.counter("safemo_pipeline_stage_errors_total",
+                                         "Elementi scartati per un errore in uno stadio della pipeline.", ("stage",))
+
+
+# --- Tracce ---
+
+class Span(NamedTuple):
+    name: str
+    start_s: float  # relativo all'inizio della traccia
+    duration_s: float
+    error: bool
+
+
+class Trace:
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def add(self, name: str, start: float, error: bool = False):
+        # list.append è atomica: gli span possono arrivare da più thread dell'executor
+        self.spans.append(Span(name, start - self.started_at, time.perf_counter() - start, error))
+
+    def server_timing(self) -> str:
+        """ valore dell'header `Server-Timing`: durata totale e numero di span per nome """
+        totals: Dict[str, List[float]] = {}
+        for span in self.spans:
+            entry = totals.setdefault(span.name, [0.0, 0])
+            entry[0] += span.duration_s
+            entry[1] += 1
+        return ", ".join(f'{name.replace(" ", "_")};desc="x{count}";dur={duration * 1000:.1f}'
+                         for name, (duration, count) in totals.items())
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace() -> Trace:
+    """ traccia il contesto corrente (per Tornado: la richiesta in corso) """
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str):
+    """ registra un blocco nella traccia corrente, se c'è """
+    if (trace := _current_trace.get()) is None:
+        yield
+        return
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        trace.add(name, start, error)
+
+
+@contextmanager
+def timed(histogram: Histogram, errors: Optional[Counter] = None, **labels):
+    """ misura il blocco nell'istogramma, conta gli errori e lo aggiunge alla traccia corrente """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        if errors is not None:
+            errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+        if (trace := _current_trace.get()) is not None:
+            trace.add(".".join(labels.values()), start, error)
+
+
+def instrumented(histogram: Histogram, errors: Optional[Counter] = None, **labels):
+    """ decoratore: come `timed`, per tutta la funzione """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(histogram, errors, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_textfile(path: Optional[str] = METRICS_TEXTFILE_PATH):
+    """ salva le metriche su file (scrittura atomica), per i processi che non espongono `/metrics` """
+    if not path:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+# --- Profiler ---
+
+class SamplingProfiler:
+    """
+    Ogni `interval_s` legge lo stack di tutti i thread (escluso il proprio) e conta quante
+    volte compare ogni stack: le funzioni che compaiono più spesso sono quelle dove va il tempo.
+    """
+
+    def __init__(self, interval_s: float = PROFILER_INTERVAL_S):
+        self.interval_s = interval_s
+        self.samples = _StackCounter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_forever, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """ ferma il campionamento e ritorna gli stack in formato collapsed ("f1;f2;f3 conteggio") """
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def _sample_forever(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+
+profiler = SamplingProfiler()
+
+
+def toggle_profiler(output_dir: str = PROFILER_OUTPUT_DIR) -> Optional[str]:
+    """ accende il profiler, o lo spegne e salva gli stack; ritorna il file scritto """
+    if not profiler.running:
+        profiler.start()
+        print(f"🔬 Profiler avviato (pid {os.getpid()}).")
+        return None
+    path = os.path.join(output_dir, f"profile-{os.getpid()}-{int(time.time())}.folded")
+    with open(path, "w") as f:
+        f.write(profiler.stop())
+    print(f"🔬 Profiler fermato: stack salvati in {path}")
+    return path
+
+
+def install_profiler_signal(sig: int = signal.SIGUSR1):
+    """ `kill -USR1 <pid>` accende il profiler, il segnale successivo lo spegne e salva gli stack """
+    signal.signal(sig, lambda *_: toggle_profiler())
@@ -0,0 +1,143 @@
+"""
+Pipeline a stadi in streaming: ogni elemento passa da uno stadio al successivo appena
+è pronto, senza aspettare che lo stadio precedente abbia finito con tutti gli altri.
+
+Tra uno stadio e l'altro c'è una coda limitata: se uno stadio è lento, quelli prima si
+fermano invece di accumulare elementi in memoria.
+Chiudere il generatore di `run` (o abbandonarlo) ferma gli stadi: nessun thread resta
+bloccato su una coda che non verrà più letta.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import PIPELINE_STAGE_ERRORS, PIPELINE_STAGE_SECONDS
+
+_END = object()
+# Ogni quanto un thread fermo su una coda controlla se la pipeline è stata chiusa
+_POLL_S = 0.1
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    fn: Callable[[Any], Optional[Any]]  # ritorna l'elemento per lo stadio successivo, None per scartarlo
+    workers: int = 1
+    # > 1: `fn` riceve una lista di al massimo `batch_size` elementi, raccolti aspettando
+    # al massimo `linger_s` secondi dopo il primo
+    batch_size: int = 1
+    linger_s: float = 0.0
+    # Se `fn` fallisce: riceve l'elemento e l'errore e ritorna quello da passare avanti (None per scartarlo)
+    on_error: Optional[Callable[[Any, Exception], Optional[Any]]] = None
+
+
+class StreamingPipeline:
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 16):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        avvia gli stadi e restituisce i risultati dell'ultimo stadio man mano che escono.
+        Se il generatore viene chiuso prima della fine gli stadi si fermano dopo l'elemento in corso
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop), daemon=True)]
+        for stage, in_queue, out_queue in zip(self.stages, queues, queues[1:]):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            threads += [threading.Thread(target=self._work, args=(stage, in_queue, out_queue, remaining, lock, stop),
+                                         name=f"{stage.name}-{i}", daemon=True)
+                        for i in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while (result := queues[-1].get()) is not _END:
+                yield result
+        finally:
+            # Chiusura anticipata: gli stadi smettono di leggere e scrivere le code; non li si aspetta,
+            # un thread può essere dentro una chiamata lunga e uscirà appena l'ha finita
+            stop.set()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _put(out_queue: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        """ `put` che si arrende quando la pipeline viene chiusa; False se l'elemento non è stato messo """
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=_POLL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(in_queue: queue.Queue, stop: threading.Event, timeout: Optional[float] = None) -> Any:
+        """ `get` che ritorna `_END` quando la pipeline viene chiusa; solleva `queue.Empty` dopo `timeout` """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not stop.is_set():
+            wait_s = _POLL_S if deadline is None else min(max(deadline - time.monotonic(), 0), _POLL_S)
+            try:
+                return in_queue.get(timeout=wait_s)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+        return _END
+
+    @staticmethod
+    def _feed(items: Iterable, out_queue: queue.Queue, stop: threading.Event):
+        try:
+            for item in items:
+                if not StreamingPipeline._put(out_queue, item, stop):
+                    return
+        finally:
+            StreamingPipeline._put(out_queue, _END, stop)
+
+    @staticmethod
+    def _fill_batch(stage: PipelineStage, in_queue: queue.Queue, batch: list,
+                    stop: threading.Event) -> Tuple[list, bool]:
+        """ completa il lotto con gli elementi in arrivo; ritorna il lotto e se la coda è finita """
+        deadline = time.monotonic() + stage.linger_s
+        while len(batch) < stage.batch_size:
+            try:
+                item = StreamingPipeline._get(in_queue, stop, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    @staticmethod
+    def _work(stage: PipelineStage, in_queue: queue.Queue, out_queue: queue.Queue, remaining: list,
+              lock: threading.Lock, stop: threading.Event):
+        finished = False
+        while not finished and (item := StreamingPipeline._get(in_queue, stop)) is not _END:
+            if stage.batch_size > 1:
+                item, finished = StreamingPipeline._fill_batch(stage, in_queue, [item], stop)
+            start = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                PIPELINE_STAGE_ERRORS.inc(stage=stage.name)
+                print(f"❌ Errore nello stadio '{stage.name}': {e}")
+                # L'elemento prosegue senza il lavoro di questo stadio, se lo stadio lo prevede
+                result = stage.on_error(item, e) if stage.on_error is not None else None
+            # Misurato prima di `put`: il tempo passato ad aspettare lo stadio successivo non conta
+            PIPELINE_STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage.name)
+            if result is not None and not StreamingPipeline._put(out_queue, result, stop):
+                return
+        if stop.is_set():
+            return
+        # Rimette il segnale di fine per gli altri worker dello stadio; l'ultimo lo passa avanti
+        StreamingPipeline._put(in_queue, _END, stop)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            StreamingPipeline._put(out_queue, _END, stop)
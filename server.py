@@ -1,18 +1,78 @@
+import argparse
 import asyncio
-import tornado.web
 import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
 
+from api.google_maps_api_interface import GoogleMapsApiInterface
+from db.locals_dao import LocalsDAO
+from handlers.events_handler import EventsHandler
 from handlers.find_places_handler import PLacesAroundHandler
+from handlers.health_handler import ReadinessHandler, ServerState
+from handlers.metrics_handler import METRICS_PUBLISH_INTERVAL_S, MetricsHandler, publish_worker_metrics
+from metrics import registry, toggle_profiler
 
 # --- Configurazione ---
 PORT = 8080
 # La cartella che contiene i file di produzione generati da `npm run build`
 BUILD_DIR = os.path.join(os.path.dirname(__file__), "dist")
+# Numero di processi worker: con più di uno il server gira in modalità multi-processo
+WORKERS = int(os.getenv('SERVER_WORKERS', '1'))
+# Tempo concesso alle richieste in corso quando un worker viene chiuso o ricaricato
+SHUTDOWN_GRACE_S = float(os.getenv('SERVER_SHUTDOWN_GRACE_S', '30'))
+WORKER_START_TIMEOUT_S = float(os.getenv('SERVER_WORKER_START_TIMEOUT_S', '60'))
+DEFAULT_SHARED_CACHE_PATH = "db/shared_cache.sqlite3"
+
+
+def make_app(state: ServerState, google_maps_api: Optional[GoogleMapsApiInterface] = None) -> tornado.web.Application:
+    locals_dao = LocalsDAO()
+    return tornado.web.Application([
+        (r"/api/ready", ReadinessHandler, {"state": state}),
+        (r"/metrics", MetricsHandler),
+        (r"/api/placesAround", PLacesAroundHandler, {"locals_dao": locals_dao, "google_maps_api": google_maps_api}),
+        (r"/api/events", EventsHandler, {"locals_dao": locals_dao}),
+
+        # La gestione dei file statici è già altamente ottimizzata e non
+        # richiede modifiche per funzionare in un contesto asincrono.
+        (r"/(.*)", tornado.web.StaticFileHandler, {"path": BUILD_DIR, "default_filename": "index.html"}),
+    ], loop=asyncio.get_running_loop(), state=state)
+
 
+def ssl_options() -> Optional[dict]:
+    certfile = os.path.join(os.path.dirname(__file__), "server.crt")
+    keyfile = os.path.join(os.path.dirname(__file__), "server.key")
+    if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+        return None
+    return {"certfile": certfile, "keyfile": keyfile}
 
-async def main():
+
+async def drain(http_server: tornado.httpserver.HTTPServer, state: ServerState):
+    """ smette di accettare connessioni e aspetta la fine delle richieste in corso """
+    state.draining = True
+    http_server.stop()
+    deadline = time.monotonic() + SHUTDOWN_GRACE_S
+    while state.in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    try:
+        await asyncio.wait_for(http_server.close_all_connections(), max(deadline - time.monotonic(), 0.1))
+    except asyncio.TimeoutError:
+        pass
+
+
+async def main(sockets: Optional[List[socket.socket]] = None, ready_fd: Optional[int] = None):
     """
     Coroutine principale che configura e avvia il server.
+    Con `sockets` il worker usa i socket già in ascolto aperti dal supervisore.
     """
     # Controlla se la cartella 'dist' esiste
     if not os.path.exists(BUILD_DIR):
@@ -20,33 +80,154 @@ async def main():
         print("Esegui prima `npm run build` per compilare il tuo progetto Vue.")
         return
 
-    app = tornado.web.Application([
-        # La gestione dei file statici è già altamente ottimizzata e non
-        # richiede modifiche per funzionare in un contesto asincrono.
-        (r"/api/placesAround", PLacesAroundHandler),
-
-        (r"/(.*)", tornado.web.StaticFileHandler, {"path": BUILD_DIR, "default_filename": "index.html"}),
-    ])
-
-    try:
-        ssl_options = {
-            "certfile": os.path.join(os.path.dirname(__file__), "server.crt"),
-            "keyfile": os.path.join(os.path.dirname(__file__), "server.key"),
-        }
-
-        # Crea un server HTTPS
-        http_server = tornado.httpserver.HTTPServer(app, ssl_options=ssl_options)
-        http_server.listen(PORT)
+    state = ServerState()
+    app = make_app(state)
+    registry.register_callback("safemo_http_in_flight", "Richieste HTTP in corso nel worker.", "gauge", (),
+                               lambda: [((), state.in_flight)])
 
-    except FileNotFoundError:
+    if (options := ssl_options()) is None:
         print("\n⚠️  Certificato SSL non trovato. Avvio del server in modalità HTTP (insicura).")
         print("⚠️  La geolocalizzazione potrebbe non funzionare su altri dispositivi.")
         print("   Esegui 'openssl req ...' per generare i certificati.\n")
-        app.listen(PORT)
+    # Crea un server HTTPS (o HTTP se mancano i certificati)
+    http_server = tornado.httpserver.HTTPServer(app, ssl_options=options)
+    if sockets:
+        http_server.add_sockets(sockets)
+    else:
+        http_server.listen(PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    # `kill -USR1 <pid>` accende il profiler, il secondo lo spegne e salva gli stack
+    loop.add_signal_handler(signal.SIGUSR1, toggle_profiler)
+    # Con più worker uno scrape di /metrics arriva a uno solo: gli altri pubblicano le loro metriche
+    # nella cache condivisa (la scrittura su SQLite non gira sull'event loop)
+    publisher = tornado.ioloop.PeriodicCallback(lambda: loop.run_in_executor(None, publish_worker_metrics),
+                                                METRICS_PUBLISH_INTERVAL_S * 1000)
+    publisher.start()
 
-    print(f"✅ Server avviato su https://localhost:{PORT}")
-    await asyncio.Event().wait()
+    state.ready = True
+    if ready_fd is not None:
+        # Il supervisore aspetta questo byte prima di chiudere il worker che questo sostituisce
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+    print(f"✅ Server avviato su {'https' if options else 'http'}://localhost:{PORT} (pid {os.getpid()})")
+    await stop.wait()
+    publisher.stop()
+    await drain(http_server, state)
+    print(f"👋 Worker {os.getpid()} chiuso.")
+
+
+class Supervisor:
+    """
+    Apre i socket in ascolto e avvia `workers` processi che li condividono: il kernel
+    distribuisce le connessioni tra i worker. I worker condividono anche la cache SQLite
+    (`SHARED_CACHE_PATH`), così non deve scaldarla ognuno per conto suo.
+
+    SIGHUP: riavvio graduale (un worker nuovo parte e diventa pronto prima che il vecchio
+    venga chiuso), utile anche per caricare il nuovo codice.
+    SIGTERM/SIGINT: chiusura di tutti i worker dopo le richieste in corso.
+    SIGUSR1: inoltrato a tutti i worker, accende/spegne il loro profiler.
+    I worker terminati inaspettatamente vengono riavviati.
+    """
+
+    def __init__(self, workers: int, port: int = PORT):
+        self.workers = workers
+        self.port = port
+        self.sockets: List[socket.socket] = []
+        self.processes: List[subprocess.Popen] = []
+        self._reload = False
+        self._stopping = False
+
+    def _spawn(self) -> Optional[subprocess.Popen]:
+        """ avvia un worker e aspetta che sia pronto; None se non parte in tempo """
+        read_fd, write_fd = os.pipe()
+        fds = [s.fileno() for s in self.sockets]
+        env = dict(os.environ, SHARED_CACHE_PATH=os.getenv('SHARED_CACHE_PATH', DEFAULT_SHARED_CACHE_PATH))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker-fds", ",".join(map(str, fds)),
+                                    "--ready-fd", str(write_fd)], pass_fds=(*fds, write_fd), env=env)
+        os.close(write_fd)
+        try:
+            ready, _, _ = select.select([read_fd], [], [], WORKER_START_TIMEOUT_S)
+            if ready and os.read(read_fd, 1) == b"1":
+                return process
+        finally:
+            os.close(read_fd)
+        print(f"❌ Il worker {process.pid} non è diventato pronto entro {WORKER_START_TIMEOUT_S}s.")
+        process.kill()
+        process.wait()
+        return None
+
+    @staticmethod
+    def _stop(process: subprocess.Popen, terminate: bool = True):
+        if terminate:
+            process.terminate()
+        try:
+            process.wait(SHUTDOWN_GRACE_S + 5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _forward(self, sig: int):
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(sig)
+
+    def _rolling_restart(self):
+        print("🔄 Riavvio graduale dei worker...")
+        for i, old in enumerate(list(self.processes)):
+            if (new := self._spawn()) is None:
+                print("⚠️  Riavvio interrotto: restano attivi i worker precedenti.")
+                return
+            self.processes[i] = new
+            self._stop(old)
+        print("✅ Riavvio completato.")
+
+    def run(self):
+        if not os.path.exists(BUILD_DIR):
+            print(f"❌ Errore: La cartella '{BUILD_DIR}' non esiste.")
+            return
+        self.sockets = tornado.netutil.bind_sockets(self.port)
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, "_reload", True))
+        signal.signal(signal.SIGUSR1, lambda *_: self._forward(signal.SIGUSR1))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: setattr(self, "_stopping", True))
+
+        self.processes = [p for p in (self._spawn() for _ in range(self.workers)) if p is not None]
+        print(f"✅ {len(self.processes)} worker in ascolto sulla porta {self.port}.")
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                self._rolling_restart()
+            for i, process in enumerate(self.processes):
+                if process.poll() is not None and not self._stopping:
+                    print(f"⚠️  Worker {process.pid} terminato (codice {process.returncode}), lo riavvio.")
+                    self.processes[i] = self._spawn() or process
+            time.sleep(0.5)
+
+        print("🛑 Chiusura dei worker...")
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            self._stop(process, terminate=False)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Server Tornado dell'app.")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="numero di processi worker")
+    # Usati dal supervisore per avviare i worker
+    parser.add_argument("--worker-fds", help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_fds:
+        sockets = [socket.socket(fileno=int(fd)) for fd in args.worker_fds.split(",")]
+        for s in sockets:
+            s.setblocking(False)
+        asyncio.run(main(sockets, args.ready_fd))
+    elif args.workers > 1:
+        Supervisor(args.workers).run()
+    else:
+        asyncio.run(main())
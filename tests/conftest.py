@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# Prima di importare i moduli del progetto: i test non devono toccare il database vero
+os.environ.setdefault("LOCALS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="safemo-tests-"), "locals.sqlite3"))
@@ -0,0 +1,92 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from event_extractor import HIGH_CONFIDENCE, classify_post, has_event_signal
+
+
+def test_post_without_signals_is_not_a_candidate():
+    result = classify_post("Che bella giornata al lago con gli amici 😎")
+    assert not result.is_candidate
+    assert result.event is None
+
+
+@pytest.mark.parametrize("text", ["Voto 4.5 su 5", "Media 3.8 su 10 recensioni"])
+def test_decimals_are_not_dates(text):
+    assert not has_event_signal(text)
+    assert not classify_post(text).is_candidate
+
+
+@pytest.mark.parametrize("text", ["Siamo aperti 24/7", "Aperto h24/7", "Voto 3/4", "Il 3/4 2 volte", "32/13 ore 21"])
+def test_slash_that_is_not_a_date(text):
+    assert classify_post(text).event is None
+
+
+def test_open_all_week_bar_post_goes_to_the_llm():
+    result = classify_post("APERITIVO\nSiamo aperti 24/7! Aperitivo dalle 18:00 alle 21:00, drink 5€")
+    # Nessuna data: il post resta un candidato, ma non viene salvato come evento senza l'LLM
+    assert result.is_candidate
+    assert result.event is None
+    assert result.confidence < HIGH_CONFIDENCE
+
+
+def test_slash_date_with_time():
+    result = classify_post("Festa 6/6 22:00")
+    assert (result.event.start_time.month, result.event.start_time.day, result.event.start_time.hour) == (6, 6, 22)
+
+
+def test_time_with_dot_is_not_a_date():
+    result = classify_post("12.30 pranzo")
+    # Un orario senza giorno è un candidato per l'LLM, ma non diventa una data
+    assert result.is_candidate
+    assert result.event is None
+
+
+def test_relative_day_keeps_time():
+    result = classify_post("Stasera dalle 22.00")
+    assert result.event.start_time == datetime.combine(date.today(), datetime.min.time()).replace(hour=22)
+
+
+def test_description_is_caption_without_title():
+    result = classify_post("SERATA LATINO AMERICANA\nVenerdì 6 giugno dalle 22 alle 3, ingresso 10€\nVi aspettiamo!")
+    assert result.event.description == "Venerdì 6 giugno dalle 22 alle 3, ingresso 10€ Vi aspettiamo!"
+
+
+def test_tomorrow_is_relative_to_today():
+    result = classify_post("Domani ore 21:30 aperitivo")
+    assert result.event.start_time.date() == date.today() + timedelta(days=1)
+    assert (result.event.start_time.hour, result.event.start_time.minute) == (21, 30)
+
+
+def test_dotted_date_with_year():
+    result = classify_post("Festa il 14.02.2027 ore 21")
+    assert result.event.start_time == datetime(2027, 2, 14, 21)
+
+
+def test_hour_only_range_crosses_midnight():
+    result = classify_post("FESTA DI INIZIO ESTATE\n6 giugno dalle 22 alle 2")
+    start, end = result.event.start_time, result.event.end_time
+    assert (start.month, start.day, start.hour) == (6, 6, 22)
+    assert end == start.replace(hour=2) + timedelta(days=1)
+    assert result.confidence >= HIGH_CONFIDENCE
+
+
+def test_range_with_minutes():
+    result = classify_post("Saturday 13 September\nFrom 21:00 - 23:30 at the Municipal Theater.")
+    assert (result.event.start_time.hour, result.event.start_time.minute) == (21, 0)
+    assert (result.event.end_time.hour, result.event.end_time.minute) == (23, 30)
+
+
+def test_open_range_is_not_high_confidence():
+    # Titolo, data e un "dalle" senza fine: l'orario è incompleto e il post va all'LLM
+    result = classify_post("SERATA LATINO AMERICANA\nVenerdì 6 giugno dalle 22 fino a tardi, ingresso 10€")
+    assert result.event.start_time.hour == 22
+    assert result.event.end_time is None
+    assert result.confidence < HIGH_CONFIDENCE
+
+
+def test_complete_event_is_high_confidence():
+    result = classify_post("SERATA LATINO AMERICANA\nVenerdì 6 giugno dalle 22 alle 3, ingresso 10€")
+    assert result.confidence >= HIGH_CONFIDENCE
+    assert result.event.name == "SERATA LATINO AMERICANA"
+    assert result.event.price == 10.0
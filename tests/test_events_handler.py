@@ -0,0 +1,102 @@
+import json
+import tempfile
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from db.locals_dao import LocalsDAO
+from db.places_store import PlacesStore
+from handlers.events_handler import EventsHandler
+
+CENTER = (45.438, 10.992)
+FRIDAY = datetime(2026, 10, 23, 18)
+
+
+def bar(place_id: str, latitude: float, longitude: float, *events: dict) -> dict:
+    return {"id": place_id, "name": place_id, "latitude": latitude, "longitude": longitude, "events": list(events)}
+
+
+def event(name: str, start: datetime, price: float = None) -> dict:
+    return {"name": name, "start_time": start.isoformat(), "price": price}
+
+
+class EventsWindowTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp.cleanup()
+
+    def get_app(self):
+        self.dao = LocalsDAO(PlacesStore(f"{self.tmp.name}/places.sqlite3"))
+        return Application([(r"/api/events", EventsHandler, {"locals_dao": self.dao})], loop=self.io_loop.asyncio_loop)
+
+    def events(self, **arguments) -> dict:
+        response = self.fetch("/api/events?" + urlencode(dict(lat=CENTER[0], lon=CENTER[1], **arguments)))
+        assert response.code == 200, response.body
+        return json.loads(response.body)
+
+    def names(self, **arguments) -> list:
+        return [e["name"] for e in self.events(**arguments)["events"]]
+
+    def test_window_includes_start_and_excludes_end(self):
+        self.dao.dump_db("bar", {"a": bar("a", *CENTER,
+                                          event("prima", FRIDAY - timedelta(minutes=1)),
+                                          event("inizio", FRIDAY),
+                                          event("dentro", FRIDAY + timedelta(hours=3)),
+                                          event("fine", FRIDAY + timedelta(hours=6)))})
+        window = {"from": FRIDAY.isoformat(), "to": (FRIDAY + timedelta(hours=6)).isoformat()}
+        # La finestra è [from, to): conta l'orario di inizio dell'evento
+        assert self.names(**window) == ["inizio", "dentro"]
+
+    def test_default_window_is_the_next_24_hours(self):
+        now = datetime.now()
+        self.dao.dump_db("bar", {"a": bar("a", *CENTER,
+                                          event("già iniziato", now - timedelta(hours=2)),
+                                          event("stasera", now + timedelta(hours=2)),
+                                          event("dopodomani", now + timedelta(hours=30)))})
+        assert self.names() == ["stasera"]
+        # Senza `to` la finestra dura 24 ore da `from`
+        assert self.names(**{"from": (now + timedelta(hours=12)).isoformat()}) == ["dopodomani"]
+
+    def test_window_is_capped(self):
+        self.dao.dump_db("bar", {"a": bar("a", *CENTER,
+                                          event("fra un mese", FRIDAY + timedelta(days=30)),
+                                          event("fra due mesi", FRIDAY + timedelta(days=60)))})
+        to = (FRIDAY + timedelta(days=365)).isoformat()
+        assert self.names(**{"from": FRIDAY.isoformat(), "to": to}) == ["fra un mese"]
+
+    def test_window_across_midnight_and_ordering(self):
+        self.dao.dump_db("bar", {"a": bar("a", *CENTER, event("notte", FRIDAY + timedelta(hours=7)),
+                                          event("sera", FRIDAY + timedelta(hours=4))),
+                                 "b": bar("b", CENTER[0] + 0.005, CENTER[1],
+                                          event("aperitivo", FRIDAY + timedelta(hours=1))),
+                                 # Fuori dal raggio di 2 km
+                                 "c": bar("c", CENTER[0] + 0.1, CENTER[1], event("lontano", FRIDAY + timedelta(hours=2)))})
+        window = {"from": FRIDAY.isoformat(), "to": (FRIDAY + timedelta(hours=12)).isoformat()}
+        assert self.names(**window) == ["aperitivo", "sera", "notte"]
+        assert self.names(**window, radius=20) == ["aperitivo", "lontano", "sera", "notte"]
+
+    def test_pages_follow_the_window(self):
+        self.dao.dump_db("bar", {p_id: bar(p_id, *CENTER, event(f"{p_id} alle 22", FRIDAY + timedelta(hours=4)),
+                                           event(f"{p_id} alle 23", FRIDAY + timedelta(hours=5), price=20))
+                                 for p_id in ("a", "b")})
+        window = {"from": FRIDAY.isoformat(), "to": (FRIDAY + timedelta(hours=12)).isoformat()}
+        seen, cursor = [], None
+        while True:
+            page = self.events(**window, limit=1, **({"cursor": cursor} if cursor else {}))
+            seen += [e["name"] for e in page["events"]]
+            if not (cursor := page["next_cursor"]):
+                break
+        # Gli eventi con lo stesso inizio non vengono persi né ripetuti tra le pagine
+        assert seen == ["a alle 22", "b alle 22", "a alle 23", "b alle 23"]
+        assert self.names(**window, max_price=10) == ["a alle 22", "b alle 22"]
+
+    def test_invalid_window_is_rejected(self):
+        response = self.fetch("/api/events?" + urlencode({"lat": CENTER[0], "lon": CENTER[1], "from": "venerdì"}))
+        assert response.code == 400
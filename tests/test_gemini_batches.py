@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import api.gemini_api_interface
+from api.gemini_api_interface import GeminiApiInterface
+from api.quota import QuotaManager
+
+
+@pytest.fixture(autouse=True)
+def no_quota(monkeypatch, tmp_path):
+    # Senza limiti di frequenza: i test contano le chiamate, non aspettano i token
+    quota = QuotaManager(providers={}, path=str(tmp_path / "quota.sqlite3"))
+    monkeypatch.setattr(api.gemini_api_interface, "get_quota", lambda: quota)
+
+
+class _Response:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ScriptedModel:
+    """ modello finto: `reply(prompt)` decide la risposta o solleva l'errore """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.prompts = []
+
+    def generate_content(self, prompt: str) -> _Response:
+        self.prompts.append(prompt)
+        return _Response(self.reply(prompt))
+
+
+BATCH = {str(i): f"Post numero {i}" for i in range(8)}
+
+
+def test_transport_error_does_not_split_the_batch():
+    def reply(prompt):
+        raise ConnectionError("Gemini non raggiungibile")
+
+    model = ScriptedModel(reply)
+    assert GeminiApiInterface(model=model)._extract_batch(BATCH) == {}
+    # Una sola chiamata a pagamento per tutto il batch, non 2N-1
+    assert len(model.prompts) == 1
+
+
+def test_malformed_response_is_split_until_it_is_readable():
+    def reply(prompt):
+        posts = [line.split()[-1] for line in prompt.splitlines() if line.startswith("### POST ")]
+        if len(posts) > 2:
+            return "non è JSON"
+        return json.dumps([{"post_id": p_id, "is_evento": False} for p_id in posts])
+
+    model = ScriptedModel(reply)
+    assert GeminiApiInterface(model=model)._extract_batch(BATCH) == {p_id: None for p_id in BATCH}
+    # 8 -> 4 + 4 -> quattro coppie leggibili
+    assert len(model.prompts) == 7
+
+
+def test_missing_posts_are_split_and_retried():
+    def reply(prompt):
+        posts = [line.split()[-1] for line in prompt.splitlines() if line.startswith("### POST ")]
+        if not posts:
+            # Prompt di un singolo post
+            return json.dumps({"is_evento": False})
+        # Il modello dimentica sempre l'ultimo post del batch
+        return json.dumps([{"post_id": p_id, "is_evento": False} for p_id in posts[:-1]])
+
+    model = ScriptedModel(reply)
+    events = GeminiApiInterface(model=model)._extract_batch({"a": "uno", "b": "due"})
+    assert events == {"a": None, "b": None}
+    assert len(model.prompts) == 3
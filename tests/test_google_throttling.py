@@ -0,0 +1,86 @@
+import pytest
+import requests
+
+import api.google_maps_api_interface
+from api.google_maps_api_interface import GoogleMapsApiInterface
+from api.quota import THROTTLE_RETRIES
+from bench.fakes import _FakeResponse
+from metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS
+
+
+class RecordingQuota:
+    def __init__(self):
+        self.events = []
+
+    def acquire(self, provider, cost=None, priority=None):
+        self.events.append(("acquire", cost))
+
+    def report_throttled(self, provider, retry_after=None):
+        self.events.append(("throttled", retry_after))
+
+    def report_success(self, provider):
+        self.events.append(("success", None))
+
+
+class ScriptedSession:
+    """ risponde con gli status della lista, uno per chiamata (l'ultimo si ripete) """
+
+    def __init__(self, statuses, payload):
+        self.statuses = list(statuses)
+        self.payload = payload
+        self.calls = 0
+
+    def _next(self, *args, **kwargs):
+        status = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        self.calls += 1
+        response = _FakeResponse(status, self.payload if status == 200 else {})
+        response.headers = {"Retry-After": "0"} if status == 429 else {}
+        return response
+
+    post = get = _next
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    quota = RecordingQuota()
+    monkeypatch.setattr(api.google_maps_api_interface, "get_quota", lambda: quota)
+    return quota
+
+
+GEOCODE_PAYLOAD = {"results": [{"geometry": {"location": {"lat": 45.1, "lng": 11.2}}}]}
+
+
+@pytest.mark.parametrize("operation", ["geocode", "searchNearby"])
+def test_throttled_attempts_are_retried_and_counted_as_errors(quota, operation):
+    errors_before = UPSTREAM_ERRORS.value(service="google", operation=operation)
+    samples_before = UPSTREAM_SECONDS.count(service="google", operation=operation)
+    session = ScriptedSession([429, 429, 200], GEOCODE_PAYLOAD if operation == "geocode" else {"places": []})
+    google = GoogleMapsApiInterface(session=session)
+    if operation == "geocode":
+        assert google.geocode("Piazza Bra, Verona") == (45.1, 11.2)
+    else:
+        assert google._make_request("places.id", "bar", 45.3, 11.3, 1.0) == {}
+    assert session.calls == 3
+    assert [event for event, _ in quota.events] == ["acquire", "throttled", "acquire", "throttled", "acquire", "success"]
+    assert UPSTREAM_ERRORS.value(service="google", operation=operation) - errors_before == 2
+    assert UPSTREAM_SECONDS.count(service="google", operation=operation) - samples_before == 3
+
+
+def test_geocode_gives_up_after_the_retries(quota):
+    session = ScriptedSession([429], GEOCODE_PAYLOAD)
+    with pytest.raises(requests.exceptions.HTTPError):
+        GoogleMapsApiInterface(session=session).geocode("Via Roma, Verona")
+    assert session.calls == THROTTLE_RETRIES + 1
+
+
+def test_other_errors_are_not_retried(quota):
+    session = ScriptedSession([500, 200], GEOCODE_PAYLOAD)
+    with pytest.raises(requests.exceptions.HTTPError):
+        GoogleMapsApiInterface(session=session).geocode("Via Roma, Verona")
+    assert session.calls == 1
+    assert ("throttled", None) not in quota.events
+
+
+def test_geocode_is_charged_its_own_cost(quota):
+    GoogleMapsApiInterface(session=ScriptedSession([200], GEOCODE_PAYLOAD)).geocode("Via Roma, Verona")
+    assert quota.events[0] == ("acquire", api.google_maps_api_interface.GEOCODE_COST)
@@ -0,0 +1,109 @@
+from datetime import datetime, time, timedelta
+
+import pytest
+
+from db import opening_hours
+from db.models import Place
+from db.opening_hours import (ALWAYS_OPEN, MINUTES_PER_WEEK, compile_periods, filter_open_between,
+                              filter_open_daily_between, is_open_between)
+
+# Una settimana di riferimento: lunedì 19 ottobre 2026 ... domenica 25 ottobre 2026
+MONDAY, FRIDAY, SATURDAY, SUNDAY = 19, 23, 24, 25
+# Giorni di Google: domenica = 0
+G_SUNDAY, G_MONDAY, G_FRIDAY, G_SATURDAY = 0, 1, 5, 6
+
+
+def at(day: int, hour: int, minute: int = 0) -> datetime:
+    return datetime(2026, 10, day, hour, minute)
+
+
+def period(open_day: int, open_hour: int, close_day: int = None, close_hour: int = None, close_minute: int = 0) -> dict:
+    result = {'open': {'day': open_day, 'hour': open_hour, 'minute': 0}}
+    if close_day is not None:
+        result['close'] = {'day': close_day, 'hour': close_hour, 'minute': close_minute}
+    return result
+
+
+def make_place(periods=None, place_id="p") -> Place:
+    data = {'id': place_id, 'displayName': {'text': place_id}}
+    if periods is not None:
+        data['regularOpeningHours'] = {'periods': periods}
+    return Place.load_from_google_place(data)
+
+
+def test_period_closing_after_midnight():
+    place = make_place([period(G_FRIDAY, 22, G_SATURDAY, 2)])
+    assert place.is_open_at(at(FRIDAY, 23))
+    assert place.is_open_at(at(SATURDAY, 1, 59))
+    assert not place.is_open_at(at(SATURDAY, 2))
+    assert not place.is_open_at(at(FRIDAY, 21, 59))
+
+
+def test_saturday_to_sunday():
+    place = make_place([period(G_SATURDAY, 20, G_SUNDAY, 3)])
+    assert place.is_open_at(at(SATURDAY, 23, 30))
+    assert place.is_open_at(at(SUNDAY, 2))
+    assert not place.is_open_at(at(SUNDAY, 3))
+
+
+def test_sunday_to_monday_wraps_the_week():
+    place = make_place([period(G_SUNDAY, 22, G_MONDAY, 2)])
+    # Domenica sera è la fine della settimana, lunedì notte l'inizio: l'intervallo viene diviso in due
+    assert place.weekly_hours == [0, 120, 6 * 24 * 60 + 22 * 60, MINUTES_PER_WEEK]
+    assert place.is_open_at(at(SUNDAY, 23, 59))
+    assert place.is_open_at(at(MONDAY, 0))
+    assert place.is_open_at(at(MONDAY, 1, 30))
+    assert not place.is_open_at(at(MONDAY, 2))
+    # Una finestra da domenica sera a lunedì attraversa la fine della settimana
+    monday_only = make_place([period(G_MONDAY, 0, G_MONDAY, 1)])
+    assert monday_only.is_open_between(at(SUNDAY, 23, 30), at(SUNDAY, 23, 30) + timedelta(hours=1))
+    assert not monday_only.is_open_between(at(SUNDAY, 23, 30), at(SUNDAY, 23, 30) + timedelta(minutes=30))
+
+
+def test_open_without_close_is_always_open():
+    place = make_place([period(G_SUNDAY, 0)])
+    assert place.weekly_hours == ALWAYS_OPEN
+    assert place.is_open_at(at(MONDAY, 0))
+    assert place.is_open_at(at(SUNDAY, 23, 59))
+
+
+@pytest.mark.parametrize("periods", [None, []])
+def test_place_without_opening_hours_is_never_open(periods):
+    place = make_place(periods)
+    assert place.weekly_intervals() == []
+    assert not place.is_open_at(at(FRIDAY, 22))
+    assert filter_open_between({place.id: place}, at(FRIDAY, 0), at(SATURDAY, 0)) == {}
+
+
+def test_overlapping_periods_are_merged():
+    assert compile_periods([period(G_MONDAY, 10, G_MONDAY, 14), period(G_MONDAY, 12, G_MONDAY, 18)]) == [600, 1080]
+
+
+def test_filter_open_between_window_edges():
+    places = {"early": make_place([period(G_FRIDAY, 18, G_FRIDAY, 22)], "early"),
+              "late": make_place([period(G_FRIDAY, 23, G_SATURDAY, 2)], "late")}
+    # La finestra è [start, end): chi chiude all'inizio della finestra è fuori, chi apre alla fine pure
+    assert set(filter_open_between(places, at(FRIDAY, 22), at(FRIDAY, 23))) == set()
+    assert set(filter_open_between(places, at(FRIDAY, 21, 59), at(FRIDAY, 23))) == {"early"}
+    assert set(filter_open_between(places, at(FRIDAY, 22), at(FRIDAY, 23, 1))) == {"late"}
+    assert set(filter_open_between(places, at(SATURDAY, 1, 59), at(SATURDAY, 3))) == {"late"}
+
+
+def test_open_between_past_the_end_of_the_week():
+    intervals = compile_periods([period(G_MONDAY, 0, G_MONDAY, 1)])
+    start = MINUTES_PER_WEEK - 30
+    assert is_open_between(intervals, start, start + 60)
+    assert not is_open_between(intervals, start, start + 30)
+
+
+def test_filter_open_daily_between_does_not_depend_on_the_day():
+    places = {"evening": make_place([period(G_MONDAY, 18, G_MONDAY, 22, 30)], "evening"),
+              "daytime": make_place([period(day, 8, day, 17) for day in range(7)], "daytime"),
+              "weekend": make_place([period(G_SATURDAY, 23, G_SUNDAY, 1)], "weekend"),
+              "unknown": make_place(None, "unknown")}
+    assert set(filter_open_daily_between(places, time(22), time(5))) == {"evening", "weekend"}
+
+
+def test_minute_of_week_starts_on_monday():
+    assert opening_hours.minute_of_week(at(MONDAY, 0)) == 0
+    assert opening_hours.minute_of_week(at(SUNDAY, 23, 59)) == MINUTES_PER_WEEK - 1
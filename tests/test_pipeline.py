@@ -0,0 +1,117 @@
+import threading
+import time
+
+from metrics import PIPELINE_STAGE_ERRORS
+from pipeline import PipelineStage, StreamingPipeline
+
+
+class CountingSource:
+    """ generatore di input che conta quanti elementi la pipeline ha già letto """
+
+    def __init__(self, n: int):
+        self.n = n
+        self.consumed = 0
+
+    def __iter__(self):
+        for i in range(self.n):
+            self.consumed += 1
+            yield i
+
+
+def fail_on_odd(item):
+    if item % 2:
+        raise ValueError(f"dispari: {item}")
+    return item
+
+
+def test_failed_item_is_dropped_without_on_error():
+    errors_before = PIPELINE_STAGE_ERRORS.value(stage="scarta")
+    results = list(StreamingPipeline([PipelineStage("scarta", fail_on_odd)]).run(range(6)))
+    assert results == [0, 2, 4]
+    assert PIPELINE_STAGE_ERRORS.value(stage="scarta") - errors_before == 3
+
+
+def test_on_error_passes_the_item_on():
+    seen = []
+
+    def on_error(item, error):
+        seen.append((item, type(error)))
+        return -item
+
+    stages = [PipelineStage("prosegue", fail_on_odd, on_error=on_error), PipelineStage("dopo", lambda item: item * 10)]
+    assert list(StreamingPipeline(stages).run(range(4))) == [0, -10, 20, -30]
+    assert seen == [(1, ValueError), (3, ValueError)]
+
+
+def test_slow_stage_stops_the_feeder():
+    source, started, release = CountingSource(100), threading.Event(), threading.Event()
+
+    def blocked(item):
+        started.set()
+        release.wait(5)
+        return item
+
+    results = StreamingPipeline([PipelineStage("lento", blocked)], queue_size=1).run(source)
+    seen = []
+    consumer = threading.Thread(target=lambda: seen.extend(results))
+    consumer.start()
+    assert started.wait(5)
+    # Tempo per correre avanti, se la coda non la fermasse
+    time.sleep(0.3)
+    # Uno nello stadio, uno in coda, uno in mano al feeder in attesa di spazio
+    assert source.consumed <= 3
+    release.set()
+    consumer.join(5)
+    assert seen == list(range(100))
+
+
+def test_slow_consumer_stops_the_stages():
+    source = CountingSource(100)
+    results = StreamingPipeline([PipelineStage("veloce", lambda item: item)], queue_size=1).run(source)
+    assert next(results) == 0
+    time.sleep(0.3)
+    # Il chiamante non legge: restano pieni solo due code da 1 e i due elementi in attesa di spazio
+    assert source.consumed <= 5
+    assert list(results) == list(range(1, 100))
+
+
+def test_closing_the_generator_stops_the_threads():
+    results = StreamingPipeline([PipelineStage("chiusura", lambda item: item, workers=3)],
+                                queue_size=1).run(iter(range(1000)))
+    assert next(results) == 0
+    results.close()
+    deadline = time.monotonic() + 5
+    while any(t.name.startswith("chiusura-") for t in threading.enumerate()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not any(t.name.startswith("chiusura-") for t in threading.enumerate())
+
+
+def test_all_items_pass_through_several_workers():
+    stages = [PipelineStage("primo", lambda item: item + 1, workers=4),
+              PipelineStage("secondo", lambda item: item * 2, workers=3)]
+    assert sorted(StreamingPipeline(stages, queue_size=2).run(range(200))) == [(i + 1) * 2 for i in range(200)]
+
+
+def test_end_of_input_flushes_the_last_batch():
+    stage = PipelineStage("lotti", lambda batch: list(batch), batch_size=3, linger_s=5.0)
+    start = time.monotonic()
+    batches = list(StreamingPipeline([stage]).run(range(7)))
+    # L'ultimo lotto parte alla fine dell'input, senza aspettare `linger_s`
+    assert time.monotonic() - start < 1.0
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_partial_batch_leaves_after_linger():
+    more = threading.Event()
+
+    def source():
+        yield 0
+        more.wait(5)
+        yield from (1, 2)
+
+    results = StreamingPipeline([PipelineStage("attesa", lambda batch: list(batch), batch_size=3,
+                                               linger_s=0.05)]).run(source())
+    # Il primo elemento non aspetta gli altri oltre `linger_s`
+    assert next(results) == [0]
+    more.set()
+    assert list(results) == [[1, 2]]
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+from api import places_cache
+from api.places_cache import GeoTileCache
+from db.shared_cache import SharedCache
+
+MASK = "places.id"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ orologio finto: i test avanzano il tempo a mano """
+    now = [1000.0]
+    monkeypatch.setattr(places_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+class Loader:
+    """ loader che conta le chiamate; `size` è la dimensione dichiarata del valore """
+
+    def __init__(self, value=None, size: int = 10):
+        self.value = value if value is not None else [{"id": "a"}]
+        self.size = size
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value, self.size
+
+
+def key(cache: GeoTileCache, n: int):
+    return cache.exact_key(MASK, "bar", 45.0 + n / 100, 11.0, 1.0)
+
+
+def test_entry_expires_after_the_ttl(clock):
+    cache, loader = GeoTileCache(ttl_s=60), Loader()
+    cache.get_or_load(key(cache, 0), loader)
+    clock[0] += 60
+    assert cache.get_or_load(key(cache, 0), loader) == loader.value
+    assert loader.calls == 1
+    clock[0] += 0.1
+    cache.get_or_load(key(cache, 0), loader)
+    assert loader.calls == 2
+    # La voce scaduta non occupa più memoria
+    assert cache.info()["entries"] == 1 and cache.info()["bytes"] == 10
+
+
+def test_least_recently_used_is_evicted_by_bytes():
+    cache = GeoTileCache(max_bytes=100)
+    for n in range(3):
+        cache.get_or_load(key(cache, n), Loader([{"id": str(n)}], size=40))
+    # 3 x 40 byte non stanno in 100: esce la prima voce
+    assert cache.get(key(cache, 0)) is None
+    assert cache.info()["bytes"] == 80 and cache.stats["evictions"] == 1
+    # Letta di recente, la voce 1 sopravvive all'inserimento successivo al posto della 2
+    cache.get(key(cache, 1))
+    cache.get_or_load(key(cache, 3), Loader([{"id": "3"}], size=40))
+    assert cache.get(key(cache, 2)) is None
+    assert cache.get(key(cache, 1)) == [{"id": "1"}]
+
+
+def test_value_larger_than_the_budget_is_not_cached():
+    cache = GeoTileCache(max_bytes=100)
+    cache.get_or_load(key(cache, 0), Loader(size=40))
+    assert cache.get_or_load(key(cache, 1), Loader(size=101)) == [{"id": "a"}]
+    assert cache.get(key(cache, 1)) is None
+    # Le voci già presenti non vengono sacrificate per un valore che comunque non entra
+    assert cache.get(key(cache, 0)) is not None
+
+
+def test_concurrent_misses_call_the_loader_once():
+    cache, release, calls = GeoTileCache(), threading.Event(), []
+
+    def slow_loader():
+        calls.append(1)
+        release.wait(5)
+        return [{"id": "a"}], 10
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load(key(cache, 0), slow_loader)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # Aspetta che tutti i thread siano in attesa del primo prima di sbloccare il loader
+    deadline = time.monotonic() + 5
+    while cache.stats["coalesced"] < 7 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == [[{"id": "a"}]] * 8
+    assert (cache.stats["misses"], cache.stats["coalesced"]) == (1, 7)
+
+
+def test_loader_error_is_shared_and_not_cached():
+    cache, release = GeoTileCache(), threading.Event()
+
+    def failing_loader():
+        release.wait(5)
+        raise ConnectionError("Google non raggiungibile")
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_load(key(cache, 0), failing_loader)
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while cache.stats["coalesced"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    # Chi aspettava riceve lo stesso errore, senza ripetere la chiamata
+    assert len(errors) == 3 and len({id(e) for e in errors}) == 1
+    loader = Loader()
+    assert cache.get_or_load(key(cache, 0), loader) == loader.value
+    assert loader.calls == 1
+
+
+def test_nearby_points_share_a_tile():
+    cache = GeoTileCache(tile_m=250, radius_step_km=0.5)
+    here = cache.make_key(MASK, "bar", 45.43800, 10.99200, 0.8)
+    assert cache.make_key(MASK, "bar", 45.43810, 10.99210, 1.0) == here
+    assert here.radius_km == 1.0
+    assert cache.make_key(MASK, "bar", 45.45, 10.99200, 0.8) != here
+    assert cache.make_key(MASK, "restaurant", 45.43800, 10.99200, 0.8) != here
+    # Il centro della tile è abbastanza vicino al punto richiesto
+    center = cache.tile_center(here)
+    assert abs(center[0] - 45.438) * 111.32 <= cache.max_center_offset_km()
+
+
+def test_shared_cache_serves_other_processes(tmp_path):
+    shared = SharedCache(str(tmp_path / "shared.sqlite3"))
+    first, second = GeoTileCache(shared=shared), GeoTileCache(shared=shared)
+    loader = Loader()
+    first.get_or_load(key(first, 0), loader)
+    assert second.get_or_load(key(second, 0), loader) == loader.value
+    assert loader.calls == 1
+    assert second.stats["shared_hits"] == 1
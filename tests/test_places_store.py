@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pytest
+
+from db.places_store import PlacesStore, grid_cell
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PlacesStore(str(tmp_path / "places.sqlite3"))
+
+
+def place(place_id: str, latitude: float = 45.43, longitude: float = 10.99, **fields) -> dict:
+    return dict({"id": place_id, "name": place_id, "latitude": latitude, "longitude": longitude}, **fields)
+
+
+def event(start: datetime, **fields) -> dict:
+    return dict({"name": "Serata", "start_time": start.isoformat()}, **fields)
+
+
+def test_every_write_stamps_a_new_version(store):
+    assert store.get_version() == 0
+    first = store.upsert_many("bar", {"a": place("a"), "b": place("b")})
+    second = store.upsert_many("bar", {"c": place("c")})
+    assert (first, second) == (1, 2)
+    assert store.get_version() == 2
+    # Solo le righe scritte dopo la versione vista
+    assert {row[1] for row in store.iter_locations_since(first)} == {"c"}
+    assert {row[1] for row in store.iter_locations_since(0)} == {"a", "b", "c"}
+
+
+def test_upsert_replaces_data_cell_and_version(store):
+    store.upsert_many("bar", {"a": place("a", 45.43, 10.99)})
+    version = store.upsert_many("bar", {"a": place("a", 45.50, 11.10, name="Nuovo nome")})
+    assert store.get("bar", "a")["name"] == "Nuovo nome"
+    # La riga si sposta nella nuova cella: la vecchia area torna vuota
+    assert store.cells_version("bar", [grid_cell(45.43, 10.99)]) == 0
+    assert store.cells_version("bar", [grid_cell(45.50, 11.10)]) == version
+    assert [row[1] for row in store.iter_locations_since(version - 1)] == ["a"]
+
+
+def test_place_without_coordinates_has_no_cell(store):
+    version = store.upsert_many("bar", {"a": place("a", None, None)})
+    assert store.get("bar", "a") is not None
+    assert list(store.iter_locations()) == []
+    # Resta tra le modifiche, così gli indici in memoria lo tolgono
+    assert list(store.iter_locations_since(version - 1)) == [("bar", "a", None, None)]
+
+
+def test_cells_version_is_per_area_and_type(store):
+    here, there = grid_cell(45.43, 10.99), grid_cell(45.10, 11.50)
+    first = store.upsert_many("bar", {"a": place("a", 45.43, 10.99)})
+    store.upsert_many("bar", {"b": place("b", 45.10, 11.50)})
+    store.upsert_many("restaurant", {"c": place("c", 45.43, 10.99)})
+    # Le scritture in un'altra area o di un altro tipo non cambiano la versione dell'area
+    assert store.cells_version("bar", [here]) == first
+    assert store.cells_version("bar", [here, there]) == first + 1
+    assert store.cells_version("bar", []) == 0
+
+
+def test_get_many_beyond_the_parameter_limit(store):
+    places = {str(i): place(str(i)) for i in range(1200)}
+    store.upsert_many("bar", places)
+    found = store.get_many("bar", [*places, "mancante"])
+    assert found == places
+    assert store.get_many("restaurant", places) == {}
+
+
+def test_upsert_reindexes_events(store):
+    friday = datetime(2026, 10, 23, 22)
+    store.upsert_many("bar", {"a": place("a", events=[event(friday), event(friday.replace(day=30), price=15)])})
+    cell = [grid_cell(45.43, 10.99)]
+    window = (datetime(2026, 10, 1).timestamp(), datetime(2026, 11, 1).timestamp())
+    assert len(list(store.iter_events("bar", cell, *window))) == 2
+    assert len(list(store.iter_events("bar", cell, *window, max_price=10))) == 1
+    # Il nuovo upsert sostituisce gli eventi: quelli tolti dal luogo spariscono dall'indice
+    store.upsert_many("bar", {"a": place("a", events=[event(friday, start_time="non è una data")])})
+    assert list(store.iter_events("bar", cell, *window)) == []
+
+
+def test_store_reopens_existing_database(tmp_path):
+    path = str(tmp_path / "places.sqlite3")
+    PlacesStore(path).upsert_many("bar", {"a": place("a", events=[event(datetime(2026, 10, 23, 22))])})
+    reopened = PlacesStore(path)
+    assert reopened.get_version() == 1
+    assert reopened.get("bar", "a")["name"] == "a"
+    # L'indice degli eventi non viene ricostruito (né duplicato) a ogni apertura
+    assert len(list(reopened.iter_events("bar", [grid_cell(45.43, 10.99)], 0, float("inf")))) == 1
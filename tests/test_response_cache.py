@@ -0,0 +1,125 @@
+import tempfile
+import time
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+import handlers.find_places_handler
+from db.locals_dao import LocalsDAO
+from db.models import Place
+from db.places_store import PlacesStore
+from handlers.find_places_handler import PLacesAroundHandler
+from handlers.response_cache import ResponseCache
+
+
+def test_entry_of_an_older_version_is_a_miss():
+    cache = ResponseCache(ttl_s=60)
+    rendered = cache.put("k", {"places": []}, version=3)
+    assert cache.get("k", 3) == rendered
+    assert cache.get("k", 4) is None
+    # La voce vecchia viene scartata: anche tornando alla versione precedente non si rilegge
+    assert cache.get("k", 3) is None
+    assert cache.stats == {"hits": 1, "misses": 2, "shared_hits": 0}
+
+
+def test_entry_expires_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = ResponseCache(ttl_s=60)
+    cache.put("k", {"places": []}, version=1)
+    now[0] += 60
+    assert cache.get("k", 1) is not None
+    now[0] += 0.1
+    assert cache.get("k", 1) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(ttl_s=60, max_entries=2)
+    cache.put("a", {"n": 1}, version=1)
+    cache.put("b", {"n": 2}, version=1)
+    cache.get("a", 1)
+    cache.put("c", {"n": 3}, version=1)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is not None and cache.get("c", 1) is not None
+
+
+def test_same_body_same_etag_and_large_bodies_are_gzipped():
+    cache = ResponseCache(ttl_s=60)
+    small = cache.put("a", {"places": []}, version=1)
+    assert small.etag == cache.put("b", {"places": []}, version=2).etag
+    assert small.gzipped is None
+    large = cache.put("c", {"places": [{"name": f"Bar {i}"} for i in range(100)]}, version=1)
+    assert large.gzipped is not None and large.etag != small.etag
+
+
+class UnusedGoogle:
+    """ le aree dei test sono già coperte: Google non deve essere chiamato """
+
+    async def sweep_area_async(self, *args, **kwargs):
+        raise AssertionError("area già coperta, Google non va chiamato")
+
+    @staticmethod
+    def filter_nightlife(places):
+        return places
+
+
+def bar(place_id: str, latitude: float, longitude: float, name: str = None) -> Place:
+    return Place.load_from_google_place({'id': place_id, 'displayName': {'text': name or place_id},
+                                         'location': {'latitude': latitude, 'longitude': longitude}})
+
+
+class PlacesAroundCacheTest(AsyncHTTPTestCase):
+    URL = "/api/placesAround?lat=45.438&lon=10.992&radius=1"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_cache = handlers.find_places_handler.places_responses
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        handlers.find_places_handler.places_responses = self.original_cache
+        self.tmp.cleanup()
+
+    def get_app(self):
+        self.cache = ResponseCache(ttl_s=60)
+        handlers.find_places_handler.places_responses = self.cache
+        self.dao = LocalsDAO(PlacesStore(f"{self.tmp.name}/places.sqlite3"))
+        self.dao.dump_db("bar", {"a": bar("a", 45.438, 10.992)})
+        self.dao.record_coverage("bar", 45.438, 10.992, 5.0)
+        return Application([(r"/api/placesAround", PLacesAroundHandler,
+                             {"locals_dao": self.dao, "google_maps_api": UnusedGoogle()})],
+                           loop=self.io_loop.asyncio_loop)
+
+    def test_matching_etag_gets_304(self):
+        first = self.fetch(self.URL)
+        assert first.code == 200
+        assert b'"a"' in first.body
+        etag = first.headers["Etag"]
+        second = self.fetch(self.URL, headers={"If-None-Match": etag})
+        assert second.code == 304
+        assert second.body == b""
+        assert self.cache.stats["hits"] == 1
+        # Un ETag diverso riceve il corpo intero
+        assert self.fetch(self.URL, headers={"If-None-Match": '"altro"'}).code == 200
+
+    def test_write_in_the_area_invalidates_the_response(self):
+        etag = self.fetch(self.URL).headers["Etag"]
+        self.dao.dump_db("bar", {"b": bar("b", 45.439, 10.993)})
+        response = self.fetch(self.URL, headers={"If-None-Match": etag})
+        assert response.code == 200
+        assert b'"b"' in response.body
+        assert response.headers["Etag"] != etag
+
+    def test_write_in_another_area_keeps_the_response(self):
+        etag = self.fetch(self.URL).headers["Etag"]
+        # Una scrittura a decine di km cambia la versione del database, non quella dell'area
+        self.dao.dump_db("bar", {"lontano": bar("lontano", 45.9, 11.5)})
+        assert self.fetch(self.URL, headers={"If-None-Match": etag}).code == 304
+        assert self.cache.stats["hits"] == 1
+
+    def test_unchanged_rewrite_keeps_the_response(self):
+        etag = self.fetch(self.URL).headers["Etag"]
+        # Gli stessi dati non vengono riscritti: la versione dell'area non cambia
+        self.dao.dump_db("bar", {"a": bar("a", 45.438, 10.992)})
+        assert self.fetch(self.URL, headers={"If-None-Match": etag}).code == 304
@@ -0,0 +1,89 @@
+import math
+import random
+
+import pytest
+
+from db.places_store import GRID_CELL_DEG
+from db.spatial_index import EARTH_RADIUS_KM, GridIndex, cells_in_radius, haversine_km
+
+
+def destination(latitude: float, longitude: float, bearing_deg: float, distance_km: float):
+    """ punto a `distance_km` dal centro nella direzione `bearing_deg` (0 = nord, 90 = est) """
+    angle, bearing = distance_km / EARTH_RADIUS_KM, math.radians(bearing_deg)
+    phi1, lambda1 = math.radians(latitude), math.radians(longitude)
+    phi2 = math.asin(math.sin(phi1) * math.cos(angle) + math.cos(phi1) * math.sin(angle) * math.cos(bearing))
+    lambda2 = lambda1 + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(phi1),
+                                   math.cos(angle) - math.sin(phi1) * math.sin(phi2))
+    return math.degrees(phi2), math.degrees(lambda2)
+
+
+def test_place_just_across_a_cell_border():
+    index = GridIndex()
+    border = 45.01
+    # Il centro è messo in modo che il bordo nord del cerchio cada appena oltre il bordo della cella
+    latitude = border - math.degrees(1.0 / EARTH_RADIUS_KM) + 2e-6
+    index.upsert("bar", "nord", border + 1e-6, 11.0)
+    assert haversine_km(latitude, 11.0, border + 1e-6, 11.0) < 1.0
+    assert [p_id for _, p_id in index.query_radius("bar", latitude, 11.0, 1.0)] == ["nord"]
+
+
+@pytest.mark.parametrize("latitude", [45.0, 60.0, 78.0, 85.0])
+@pytest.mark.parametrize("bearing", [0, 45, 90, 135, 180, 225, 270, 315])
+def test_points_on_the_edge_of_the_circle(latitude, bearing):
+    index = GridIndex()
+    inside = destination(latitude, 11.0, bearing, 1.999)
+    outside = destination(latitude, 11.0, bearing, 2.001)
+    index.upsert("bar", "dentro", *inside)
+    index.upsert("bar", "fuori", *outside)
+    assert [p_id for _, p_id in index.query_radius("bar", latitude, 11.0, 2.0)] == ["dentro"]
+
+
+def test_high_latitude_finds_neighbours_several_cells_away():
+    index = GridIndex()
+    # A 78° un grado di longitudine è ~23 km: 2 km verso est sono ~8 celle
+    east, west = destination(78.0, 15.0, 90, 1.9), destination(78.0, 15.0, 270, 1.9)
+    assert abs(east[1] - 15.0) > 5 * GRID_CELL_DEG
+    index.upsert("bar", "est", *east)
+    index.upsert("bar", "ovest", *west)
+    assert {p_id for _, p_id in index.query_radius("bar", 78.0, 15.0, 2.0)} == {"est", "ovest"}
+    assert len(cells_in_radius(78.0, 15.0, 2.0)) > len(cells_in_radius(45.0, 15.0, 2.0))
+
+
+def test_matches_a_linear_scan():
+    rng = random.Random(7)
+    index, points = GridIndex(), {}
+    for i in range(2000):
+        points[str(i)] = (45.4 + rng.uniform(-0.05, 0.05), 11.0 + rng.uniform(-0.05, 0.05))
+        index.upsert("bar", str(i), *points[str(i)])
+    for _ in range(50):
+        latitude, longitude = 45.4 + rng.uniform(-0.03, 0.03), 11.0 + rng.uniform(-0.03, 0.03)
+        radius = rng.uniform(0.1, 3.0)
+        expected = sorted((haversine_km(latitude, longitude, *point), p_id) for p_id, point in points.items()
+                          if haversine_km(latitude, longitude, *point) <= radius)
+        assert index.query_radius("bar", latitude, longitude, radius) == expected
+
+
+def test_results_are_sorted_by_distance():
+    index = GridIndex()
+    for p_id, km in (("lontano", 1.5), ("vicino", 0.2), ("medio", 0.8)):
+        index.upsert("bar", p_id, *destination(45.0, 11.0, 60, km))
+    results = index.query_radius("bar", 45.0, 11.0, 2.0)
+    assert [p_id for _, p_id in results] == ["vicino", "medio", "lontano"]
+    assert [round(distance, 3) for distance, _ in results] == [0.2, 0.8, 1.5]
+
+
+def test_upsert_moves_and_remove_deletes():
+    index = GridIndex()
+    index.upsert("bar", "a", 45.0, 11.0)
+    index.upsert("restaurant", "a", 45.0, 11.0)
+    # Lo stesso luogo si sposta in un'altra cella: non resta nella vecchia
+    index.upsert("bar", "a", 45.2, 11.2)
+    assert len(index) == 2
+    assert index.query_radius("bar", 45.0, 11.0, 1.0) == []
+    assert [p_id for _, p_id in index.query_radius("bar", 45.2, 11.2, 1.0)] == ["a"]
+    # Senza coordinate il luogo esce dall'indice
+    index.upsert("bar", "a", None, None)
+    assert index.query_radius("bar", 45.2, 11.2, 1.0) == []
+    index.remove("restaurant", "a")
+    index.remove("restaurant", "a")
+    assert len(index) == 0
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import api.google_maps_api_interface
+from api.google_maps_api_interface import GoogleMapsApiInterface
+from api.places_cache import places_cache
+from api.quota import QuotaManager
+from bench.fakes import FakePlacesSession, LatencyModel, _FakeResponse
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    quota = QuotaManager(providers={}, path=str(tmp_path / "quota.sqlite3"))
+    monkeypatch.setattr(api.google_maps_api_interface, "get_quota", lambda: quota)
+    # Ogni test parte senza risposte in cache
+    places_cache.clear()
+
+
+class FailingAfterFirstCall(FakePlacesSession):
+    """ la prima ricerca riesce, le celle successive falliscono con un 500 """
+
+    def post(self, url, data, headers, timeout=None):
+        if self.calls["searchNearby"]:
+            self.calls["searchNearby"] += 1
+            return _FakeResponse(500, {"error": {"message": "errore simulato"}})
+        return super().post(url, data, headers, timeout)
+
+
+def sweep(session, latitude, longitude, radius_km, **kwargs):
+    return asyncio.run(GoogleMapsApiInterface(session=session).sweep_area_async("bar", latitude, longitude,
+                                                                                radius_km, **kwargs))
+
+
+def test_dense_area_is_saturated_but_complete():
+    # 400 luoghi per km² e celle minime da 0.5 km: le celle più piccole restano piene
+    session = FakePlacesSession(LatencyModel(0, 0), places_per_km2=400)
+    _, report = sweep(session, 45.0, 11.0, 0.8, min_radius_km=0.5)
+    assert report.saturated_cells > 0
+    assert report.errors == 0
+    assert report.complete
+
+
+def test_failed_cell_makes_the_report_incomplete():
+    session = FailingAfterFirstCall(LatencyModel(0, 0), places_per_km2=400)
+    places, report = sweep(session, 45.2, 11.2, 0.8, min_radius_km=0.1)
+    assert places
+    assert report.errors > 0
+    assert not report.complete
+
+
+def test_sparse_area_needs_one_call():
+    session = FakePlacesSession(LatencyModel(0, 0), places_per_km2=2)
+    places, report = sweep(session, 45.4, 11.4, 1.0)
+    assert report.calls == 1
+    assert (report.split_cells, report.saturated_cells) == (0, 0)
+    assert report.complete and report.places == len(places)